@@ -0,0 +1,18 @@
+"""
+Enstore to CTA migration
+
+Embedding the migration::
+
+    import enstore2cta
+
+    for result in enstore2cta.migrate_labels(["VR0001L8"], config):
+        print(result["label"], result["status"])
+"""
+from enstore2cta.migration import (bootstrap_cta, get_bootstrap_plan,
+                                   migrate_label, migrate_labels, preflight,
+                                   update_cta_copy_counts)
+from enstore2cta.verify import verify_labels
+
+__all__ = ["bootstrap_cta", "get_bootstrap_plan", "migrate_label",
+           "migrate_labels", "preflight", "update_cta_copy_counts",
+           "verify_labels"]
@@ -0,0 +1,8 @@
+"""
+python -m enstore2cta, same as the enstore2cta command
+"""
+from enstore2cta.cli import main
+
+
+if __name__ == "__main__":
+    main()
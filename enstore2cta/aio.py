@@ -0,0 +1,493 @@
+"""
+asyncio migration engine. Instead of a process per label with three
+blocking connections it keeps many labels in flight in one process,
+sharing a bounded pool of connections per database between them.
+Files of a volume are written with executemany, which psycopg 3 sends
+in pipeline mode without waiting for each statement to complete.
+Requires psycopg 3 (pip install psycopg).
+"""
+from __future__ import print_function
+import asyncio
+import contextlib
+import os
+import time
+
+try:
+    import psycopg
+    from psycopg.rows import dict_row
+except ImportError:
+    psycopg = None
+
+from enstore2cta.db import (get_application_name, get_connection_parameters,
+                            get_session_profile, open_connection)
+from enstore2cta.migration import (INSERT_CHIMERA_LOCATION, INSERT_CTA_TAPE,
+                                   INSERT_TAPE_FILE, SELECT_ARCHIVE_FILE_IDS,
+                                   SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY,
+                                   STOPPER, TAPE_POOL_NAMING, CtaDimensions,
+                                   archive_file_values, check_dimensions,
+                                   check_media_types, cta_tape_values,
+                                   get_enstore_media_types,
+                                   label_result, skip_duplicates,
+                                   tape_file_copy_values, tape_file_values,
+                                   update_cta_copy_counts)
+from enstore2cta.snapshot import Snapshot
+from enstore2cta.util import QueueStats, print_error, print_message
+
+
+#
+# same as INSERT_ARCHIVE_FILE, archive_file_id is allocated beforehand
+# so that all statements of a volume can be sent at once
+#
+INSERT_ARCHIVE_FILE_WITH_ID = """
+insert into archive_file (
+  archive_file_id,
+  disk_instance_name,
+  disk_file_id,
+  disk_file_uid,
+  disk_file_gid,
+  size_in_bytes,
+  checksum_blob,
+  checksum_adler32,
+  storage_class_id,
+  creation_time,
+  reconciliation_time,
+  is_deleted,
+  collocation_hint
+) values (
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  null,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  null
+)
+"""
+
+
+async def insert_copy_tape(cta_db, enstore_file, config, dimensions):
+    """
+    Insert tape holding copies, returns False if it already exists
+    """
+    try:
+        async with cta_db.transaction():
+            await cta_db.execute(INSERT_CTA_TAPE,
+                                 cta_tape_values(enstore_file, config,
+                                                 dimensions))
+        return True
+    except psycopg.IntegrityError:
+        return False
+
+
+async def insert_files(cta_db, label, rows, result):
+    """
+    Insert archive_file and tape_file records of a volume in one
+    transaction. If it fails, e.g. on a duplicate pnfsid, files are
+    inserted one by one and failing files are skipped
+
+    :param rows: tuples (enstore file, archive_file values, tape_file
+                 values, copy tape_file values or None)
+    :type rows: list
+    :return: inserted rows
+    :rtype: list
+    """
+    try:
+        async with cta_db.transaction():
+            async with cta_db.cursor() as cursor:
+                await cursor.executemany(INSERT_ARCHIVE_FILE_WITH_ID,
+                                         [row[1] for row in rows])
+                await cursor.executemany(INSERT_TAPE_FILE,
+                                         [row[2] for row in rows])
+        inserted = rows
+    except psycopg.Error as e:
+        print_error("%s, failed to insert files in one transaction, %s, "
+                    "inserting one by one" % (label, str(e), ))
+        inserted = []
+        for row in rows:
+            try:
+                async with cta_db.transaction():
+                    await cta_db.execute(INSERT_ARCHIVE_FILE_WITH_ID, row[1])
+                    await cta_db.execute(INSERT_TAPE_FILE, row[2])
+                inserted.append(row)
+            except psycopg.IntegrityError:
+                result["errors"] += 1
+                print_error("%s, failed to insert archive_file, multiple "
+                            "pnfsid, skipping %s" % (label, row[0]["pnfs_id"], ))
+
+    copies = [row for row in inserted if row[3]]
+    if copies:
+        try:
+            async with cta_db.transaction():
+                async with cta_db.cursor() as cursor:
+                    await cursor.executemany(INSERT_TAPE_FILE,
+                                             [row[3] for row in copies])
+        except psycopg.Error:
+            for row in copies:
+                try:
+                    async with cta_db.transaction():
+                        await cta_db.execute(INSERT_TAPE_FILE, row[3])
+                except psycopg.Error as e:
+                    result["errors"] += 1
+                    print_error("%s Failed to insert tape_file, %s"
+                                " %s %s %s, skipping %s" %
+                                (label,
+                                 row[0]["label"],
+                                 row[0]["pnfs_id"],
+                                 row[0]["bfid"],
+                                 row[0]["copy_bfid"],
+                                 str(e)))
+    return inserted
+
+
+async def migrate_label(lane, label):
+    """
+    Migrate single Enstore volume, asyncio counterpart of
+    migration.migrate_label
+
+    :param lane: connection pools and state of one in-flight label
+    :type lane: Lane
+    :param label: Enstore volume label
+    :type label: str
+    :return: result, see migration.label_result
+    :rtype: dict
+    """
+    config = lane.config
+    dimensions = lane.dimensions
+    print_message("Doing label %s" % (label, ))
+    enstore_volume = await lane.get_volume(label)
+    if not enstore_volume:
+        print_error("No such volume %s" % (label, ))
+        return label_result(label, "failed", message="no such volume")
+    try:
+        check_dimensions(enstore_volume, config, dimensions)
+        async with lane.cta.connection(label) as cta_db:
+            async with cta_db.transaction():
+                await cta_db.execute(INSERT_CTA_TAPE,
+                                     cta_tape_values(enstore_volume, config,
+                                                     dimensions))
+    except KeyError as e:
+        print_error("Failed to insert tape label %s, %s" % (label, e.args[0],))
+        return label_result(label, "failed", message=e.args[0])
+    except psycopg.IntegrityError:
+        print_error(f"{label} Done, aleady exists, skipping")
+        return label_result(label, "exists")
+
+    result = label_result(label, "done")
+    files = skip_duplicates(await lane.get_files(label), label, config, result)
+    result["files"] = len(files)
+    if not files:
+        print_message("%s Done, %d files" % (label, len(files),))
+        return result
+
+    async with lane.cta.connection(label) as cta_db:
+        inserted = await insert_label_files(lane, cta_db, label, files,
+                                            result)
+
+    if config["skip_locations"]:
+        print_message("%s Done, %d files" % (label, len(files),))
+        return result
+
+    locations = [("cta://cta/%s?archiveid=%d" % (row[0]["pnfs_id"], row[1][0]),
+                  row[0]["pnfs_id"])
+                 for row in inserted]
+    try:
+        async with lane.chimera.connection(label) as chimera_db:
+            async with chimera_db.transaction():
+                async with chimera_db.cursor() as cursor:
+                    await cursor.executemany(INSERT_CHIMERA_LOCATION,
+                                             locations)
+                    result["locations_inserted"] = max(cursor.rowcount, 0)
+        result["locations_skipped"] = (len(locations) -
+                                       result["locations_inserted"])
+    except psycopg.Error as e:
+        result["errors"] += len(locations)
+        print_error("%s failed to insert locations into chimera DB, %s" %
+                    (label, str(e),))
+    print_message("%s Done, %d files, locations inserted %d, "
+                  "skipped %d (exist or no such file)" %
+                  (label, len(files),
+                   result["locations_inserted"],
+                   result["locations_skipped"],))
+    return result
+
+
+async def insert_label_files(lane, cta_db, label, files, result):
+    """
+    Allocate archive_file_ids of files of a volume, insert tapes
+    holding their copies and the files, on one CTA connection
+
+    :return: inserted rows, see insert_files
+    :rtype: list
+    """
+    config = lane.config
+    dimensions = lane.dimensions
+    cta_label = label[:6]
+    async with cta_db.cursor() as cursor:
+        await cursor.execute(SELECT_ARCHIVE_FILE_IDS, (len(files), ))
+        ids = [row[0] for row in await cursor.fetchall()]
+
+    rows = []
+    for f, archive_file_id in zip(files, ids):
+        try:
+            values = (archive_file_id, ) + archive_file_values(f, config,
+                                                               dimensions)
+        except KeyError as e:
+            result["errors"] += 1
+            print_error("%s, failed to insert archive_file %s, %s" %
+                        (label, f["pnfs_id"], e.args[0], ))
+            continue
+        copy = None
+        copy_label = f.get("label")
+        if copy_label:
+            if copy_label not in lane.added_copy_volumes:
+                lane.added_copy_volumes.add(copy_label)
+                try:
+                    if await insert_copy_tape(cta_db, f, config,
+                                              dimensions):
+                        print_message("%s added label containing "
+                                      "copies  %s" % (label, copy_label,))
+                except KeyError as e:
+                    result["errors"] += 1
+                    print_error("%s failed to insert label containing "
+                                "copies %s, %s" % (label, copy_label,
+                                                   e.args[0],))
+            if f["copy_deleted"] == "n":
+                copy = tape_file_copy_values(f, archive_file_id)
+        rows.append((f, values,
+                     tape_file_values(f, cta_label, archive_file_id),
+                     copy))
+
+    return await insert_files(cta_db, label, rows, result)
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of connections to one database shared by all lanes.
+    Connections are opened on demand up to size, a lane holds one only
+    while it talks to the database, and a connection is tagged with the
+    label it is used for in its application_name
+    """
+    def __init__(self, config, name, size):
+        self.config = config
+        self.name = name
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.labels = {}
+
+    async def open_connection(self):
+        return await psycopg.AsyncConnection.connect(
+            autocommit=True,
+            **get_connection_parameters(
+                self.config.get(self.name),
+                get_session_profile(self.config, self.name),
+                get_application_name(self.config, "async")))
+
+    async def get(self, label):
+        """
+        Wait for a free slot, reuse an idle connection or open a new one
+        """
+        await self.slots.acquire()
+        try:
+            connection = None
+            while self.idle and not connection:
+                connection = self.idle.pop()
+                if connection.closed:
+                    self.labels.pop(connection, None)
+                    connection = None
+            if not connection:
+                connection = await self.open_connection()
+            if self.labels.get(connection) != label:
+                self.labels.pop(connection, None)
+                await connection.execute(
+                    "select set_config('application_name', %s, false)",
+                    (get_application_name(self.config, "async", label), ))
+                self.labels[connection] = label
+            return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def put(self, connection):
+        """
+        Return connection to the pool, a closed one is dropped and
+        a new one is opened instead when needed
+        """
+        if connection.closed:
+            self.labels.pop(connection, None)
+        else:
+            self.idle.append(connection)
+        self.slots.release()
+
+    @contextlib.asynccontextmanager
+    async def connection(self, label):
+        """
+        Context manager holding a connection of the pool for label
+        """
+        connection = await self.get(label)
+        try:
+            yield connection
+        finally:
+            self.put(connection)
+
+    async def close(self):
+        for connection in self.idle:
+            try:
+                await connection.close()
+            except Exception:
+                pass
+        self.idle = []
+        self.labels = {}
+
+
+class Lane(object):
+    """
+    One in-flight label, databases are reached through pools shared
+    by all lanes, snapshot files are read in the default executor so
+    that they do not block the event loop
+    """
+    def __init__(self, config, dimensions, pools, snapshot=None):
+        self.config = config
+        self.dimensions = dimensions
+        self.enstore, self.cta, self.chimera = pools
+        self.snapshot = snapshot
+        self.added_copy_volumes = set()
+        self.name = None
+
+    async def get_volume(self, label):
+        if self.snapshot:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.snapshot.get_volume, label)
+        async with self.enstore.connection(label) as enstore_db:
+            async with enstore_db.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute("select * from volume where label=%s",
+                                     (label,))
+                return await cursor.fetchone()
+
+    async def get_files(self, label):
+        if self.snapshot:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.snapshot.get_files, label)
+        async with self.enstore.connection(label) as enstore_db:
+            async with enstore_db.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute(SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY,
+                                     {"label": label,
+                                      "media_types": get_enstore_media_types(
+                                          self.config)})
+                return await cursor.fetchall()
+
+    async def run(self, name, queue, results):
+        self.name = name
+        stats = QueueStats(name, "get", self.config["telemetry_interval"])
+        try:
+            while True:
+                t0 = time.time()
+                label = await queue.get()
+                stats.waited(time.time() - t0)
+                if label is None:
+                    break
+                if os.path.exists(STOPPER):
+                    print_error(f"Found {STOPPER} file. Quitting...")
+                    break
+                stats.report()
+                t0 = time.time()
+                try:
+                    result = await migrate_label(self, label)
+                except Exception as e:
+                    result = label_result(label, "failed", message=str(e))
+                    print_error("%s failed, %s" % (label, str(e), ))
+                result["seconds"] = time.time() - t0
+                stats.worked(result["seconds"])
+                results[label] = result
+            stats.summary()
+        except Exception as e:
+            print_message("Exception %s" % (str(e)))
+
+
+async def run_lanes(labels, config, concurrency, dimensions):
+    queue = asyncio.Queue()
+    for label in labels:
+        queue.put_nowait(label)
+    for i in range(concurrency):
+        queue.put_nowait(None)
+    size = max(1, min(config["pool_size"], concurrency))
+    pools = [None if name == "enstore_db" and config.get("enstore_snapshot")
+             else ConnectionPool(config, name, size)
+             for name in ("enstore_db", "cta_db", "chimera_db")]
+    snapshot = None
+    if config.get("enstore_snapshot"):
+        snapshot = Snapshot(config.get("enstore_snapshot"))
+        await asyncio.get_running_loop().run_in_executor(
+            None, snapshot.load_volumes)
+    results = {}
+    try:
+        await asyncio.gather(*[Lane(config, dimensions, pools,
+                                    snapshot).run("lane %d" % (i, ),
+                                                  queue, results)
+                               for i in range(concurrency)])
+    finally:
+        for pool in pools:
+            if pool:
+                await pool.close()
+    return results
+
+
+def migrate_labels(labels, config, concurrency=None, update_copy_counts=True):
+    """
+    Same as migration.migrate_labels, but migrates up to concurrency
+    labels at a time in the calling process using asyncio
+
+    :param labels: Enstore volume labels
+    :type labels: list
+    :param config: migration configuration, same keys as enstore2cta.yaml
+    :type config: dict
+    :param concurrency: number of labels in flight, default 64. The labels
+                        share pool_size (configuration, default 16)
+                        connections per database
+    :type concurrency: int
+    :param update_copy_counts: recalculate tape copy counts when done
+    :type update_copy_counts: bool
+    :return: one result per label in the order of labels
+    :rtype: list
+    """
+    if psycopg is None:
+        raise ImportError("async engine requires psycopg 3, "
+                          "pip install psycopg")
+    config = dict(config)
+    config.setdefault("skip_locations", False)
+    config.setdefault("tape_pool_naming", "storage_class")
+    config.setdefault("telemetry_interval", 60)
+    config["pool_size"] = config.get("pool_size") or 16
+    if config["tape_pool_naming"] not in TAPE_POOL_NAMING:
+        raise ValueError("Unknown tape_pool_naming %s, expected one of %s" %
+                         (config["tape_pool_naming"],
+                          ", ".join(sorted(TAPE_POOL_NAMING.keys()))))
+    problems = check_media_types(config)
+    if problems:
+        raise ValueError(", ".join(problems))
+    if not concurrency:
+        concurrency = 64
+
+    cta_db = open_connection(config, "cta_db")
+    try:
+        dimensions = CtaDimensions(cta_db)
+    finally:
+        cta_db.close()
+
+    results = asyncio.run(run_lanes(labels, config, concurrency, dimensions))
+
+    if update_copy_counts and not os.path.exists(STOPPER):
+        print_message("Finished file migration, bootstrapping tapes copies counts")
+        cta_db = open_connection(config, "cta_db")
+        try:
+            update_cta_copy_counts(cta_db)
+        finally:
+            cta_db.close()
+
+    return [results.get(label, label_result(label, "not_processed"))
+            for label in labels]
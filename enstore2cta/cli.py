@@ -0,0 +1,583 @@
+"""
+Command line interface of the enstore2cta migration
+"""
+from __future__ import print_function
+import argparse
+import errno
+import multiprocessing
+import os
+import sys
+import time
+
+import psycopg2
+import yaml
+
+from enstore2cta import aio, shard
+from enstore2cta.db import get_session_profile, open_connection
+from enstore2cta.digest import compare_digests
+from enstore2cta.duplicates import (POLICIES, find_duplicates,
+                                    resolve_duplicates)
+from enstore2cta.freshload import finish_fresh_load, prepare_fresh_load
+from enstore2cta.migration import (STOPPER, TAPE_POOL_NAMING, as_list,
+                                   bootstrap_cta, check_media_types,
+                                   get_bootstrap_plan,
+                                   get_enstore_media_types, get_labels,
+                                   insert_storage_class, migrate_labels,
+                                   preflight)
+from enstore2cta.snapshot import Snapshot, export_snapshot
+from enstore2cta.staging import stage_labels
+from enstore2cta.sync import sync_labels
+from enstore2cta.util import print_error, print_message
+from enstore2cta.verify import verify_labels
+
+
+CONFIG_FILE = os.getenv("MIGRATION_CONFIG")
+if not CONFIG_FILE:
+    CONFIG_FILE = "enstore2cta.yaml"
+
+
+def load_configuration(config_file=CONFIG_FILE):
+    """
+    Load YAML configuration, quit if it does not exist, can not
+    be parsed or is readable by others
+
+    :param config_file: path to configuration file
+    :type config_file: str
+
+    :return: configuration
+    :rtype: dict
+    """
+    configuration = None
+    try:
+        mode = os.stat(config_file).st_mode
+        if mode != 33152:
+            print_error("Access to config file file %s is too permissive, do chmod 0600" %
+                        (config_file,))
+            sys.exit(1)
+        with open(config_file, "r") as f:
+            configuration = yaml.safe_load(f)
+    except (OSError, IOError) as e:
+        if e.errno == errno.ENOENT:
+            print_error("Config file %s does not exist" % (config_file,))
+        sys.exit(1)
+
+    if not configuration:
+        print_error("Failed to load configuration %s" % (config_file,))
+        sys.exit(1)
+    return configuration
+
+
+def main(tape_pool_naming="storage_class"):
+    """
+    main function
+    """
+    if os.path.exists(STOPPER):
+        print_error(f"Found {STOPPER} file. Quitting...")
+        sys.exit(1)
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="This script converts Enstore metadata to CTA metadata. "
+        "It looks for YAML configuration file pointed to by MIGRATION_CONFIG "
+        "environment variable or, if it is not defined, it looks for file enstore2cta.yaml "
+        "in current directory. Script will quit if configuration YAML is not found. "
+        )
+
+    parser.add_argument(
+        "--label",
+        help="comma separated list of labels")
+
+    parser.add_argument(
+        "--all",
+        help="do all labels",
+        action="store_true")
+
+    parser.add_argument(
+        "--select_vo",
+        help="with --all, comma separated list of VOs (storage groups) "
+        "of labels. Overrides label_filters configuration parameter vo")
+
+    parser.add_argument(
+        "--select_library",
+        help="with --all, comma separated list of Enstore libraries "
+        "of labels. Overrides label_filters configuration parameter library")
+
+    parser.add_argument(
+        "--select_media_type",
+        help="with --all, comma separated list of Enstore media types "
+        "of labels. Overrides label_filters configuration parameter media_type")
+
+    parser.add_argument(
+        "--select_file_family",
+        help="with --all, file family pattern (SQL like, e.g. raw%%) "
+        "of labels. Overrides label_filters configuration parameter file_family")
+
+    parser.add_argument(
+        "--select_label_range",
+        help="with --all, comma separated list of label ranges "
+        "<first>:<last>, e.g. VR0000:VR0999. Overrides label_filters "
+        "configuration parameter label_ranges")
+
+    parser.add_argument(
+        "--min_active_files",
+        type=int,
+        help="with --all, select labels having at least this number of "
+        "active files")
+
+    parser.add_argument(
+        "--max_active_files",
+        type=int,
+        help="with --all, select labels having at most this number of "
+        "active files")
+
+    parser.add_argument(
+        "--skip_locations",
+        help="skip filling chimera locations (good for testing)",
+        action="store_true")
+
+    parser.add_argument(
+        "--add",
+        help="add volume(s) to existing system, do not create vos, pools, archive_routes etc. These need to pre-exist in CTA db",
+        action="store_true")
+
+    parser.add_argument(
+        "--storage_class",
+        help="Add storage class corresponding to volume. Needed when adding single volume to existing system using --add option")
+
+    parser.add_argument(
+        "--vo",
+        help="vo corresponding to storage_class. Needed when adding single volume to existing system using --add option")
+
+    parser.add_argument(
+        "--tape_pool_naming",
+        choices=sorted(TAPE_POOL_NAMING.keys()),
+        help="tape pool per storage class (<vo>.<file_family>) or per VO "
+        "(\"Pool for <vo> copy <n>\"). Overrides tape_pool_naming "
+        "configuration parameter, default is %s" % (tape_pool_naming, ))
+
+    parser.add_argument(
+        "--plan",
+        help="check volumes against configuration and CTA, print migration "
+        "plan and exit. Nothing is written",
+        action="store_true")
+
+    parser.add_argument(
+        "--sync",
+        help="apply changes of labels already migrated to CTA (new, deleted "
+        "files, new copies), migrate labels not in CTA yet",
+        action="store_true")
+
+    parser.add_argument(
+        "--verify",
+        help="compare migrated labels with Enstore, write discrepancies "
+        "to report file and exit. Nothing is written to CTA or chimera",
+        action="store_true")
+
+    parser.add_argument(
+        "--verify_all_files",
+        help="in --verify mode compare files of all labels, not only of "
+        "labels which Enstore and CTA digests differ",
+        action="store_true")
+
+    parser.add_argument(
+        "--report",
+        default="enstore2cta_verify.csv",
+        help="report file written in --verify mode")
+
+    parser.add_argument(
+        "--cpu_count",
+        action  = "store",
+        type = int,
+        default =  multiprocessing.cpu_count(),
+        help="override cpu count - number of simultaneously processed labels")
+
+    parser.add_argument(
+        "--telemetry_interval",
+        action  = "store",
+        type = int,
+        default = 60,
+        help="interval in seconds between queue wait time reports")
+
+    parser.add_argument(
+        "--batch_size",
+        action  = "store",
+        type = int,
+        default = 1000,
+        help="number of files of a volume inserted with one multi row "
+        "statement per table, 1 inserts file by file")
+
+    parser.add_argument(
+        "--export_snapshot",
+        metavar="DIR",
+        help="export Enstore volumes and files of labels into directory "
+        "DIR and exit")
+
+    parser.add_argument(
+        "--snapshot",
+        metavar="DIR",
+        help="read Enstore volumes and files from snapshot directory DIR "
+        "made with --export_snapshot instead of Enstore DB. Overrides "
+        "enstore_snapshot configuration parameter")
+
+    parser.add_argument(
+        "--volume_cache",
+        metavar="DIR",
+        help="keep file lists of volumes in directory DIR and reuse them "
+        "in later runs while the volume does not change. Overrides "
+        "volume_cache configuration parameter")
+
+    parser.add_argument(
+        "--engine",
+        choices=("process", "async"),
+        default="process",
+        help="process per label or asyncio engine (requires psycopg 3) "
+        "keeping --cpu_count labels in flight in one process")
+
+    parser.add_argument(
+        "--pool_size",
+        action  = "store",
+        type = int,
+        default = 16,
+        help="number of connections per database shared by the labels in "
+        "flight with --engine async")
+
+    parser.add_argument(
+        "--staging",
+        help="workers COPY files into unlogged staging tables in CTA db, "
+        "staged files are merged into CTA and duplicate pnfsids reported "
+        "when all labels are staged",
+        action="store_true")
+
+    parser.add_argument(
+        "--fresh_load",
+        help="initial load into empty CTA catalogue: drop secondary indexes "
+        "and constraints of archive_file and tape_file, rebuild them in "
+        "parallel after migration and report violations",
+        action="store_true")
+
+    parser.add_argument(
+        "--duplicate_policy",
+        choices=sorted(POLICIES.keys()),
+        help="find pnfsids of files of labels that are on more than one "
+        "active primary volume before migration and migrate none of them "
+        "(skip), the file with the newest bfid (newest) or the newest file "
+        "of the first VO of --prefer_vo (vo). Overrides duplicate_policy "
+        "configuration parameter")
+
+    parser.add_argument(
+        "--prefer_vo",
+        help="comma separated VOs in order of preference for "
+        "--duplicate_policy vo. Overrides prefer_vo configuration parameter")
+
+    parser.add_argument(
+        "--shard_coordinator",
+        help="share labels with other hosts running with this option "
+        "through a work table in CTA db. Each label is migrated by one host",
+        action="store_true")
+
+
+    args = parser.parse_args()
+
+    configuration = load_configuration()
+
+    configuration["skip_locations"] = args.skip_locations
+    if args.tape_pool_naming:
+        configuration["tape_pool_naming"] = args.tape_pool_naming
+    configuration.setdefault("tape_pool_naming", tape_pool_naming)
+    if configuration["tape_pool_naming"] not in TAPE_POOL_NAMING:
+        print_error("Unknown tape_pool_naming %s, expected one of %s" %
+                    (configuration["tape_pool_naming"],
+                     ", ".join(sorted(TAPE_POOL_NAMING.keys()))))
+        sys.exit(1)
+    problems = check_media_types(configuration)
+    if problems:
+        for problem in problems:
+            print_error(problem)
+        sys.exit(1)
+    media_types = get_enstore_media_types(configuration)
+    for name in ("cta_db", "enstore_db", "chimera_db"):
+        try:
+            get_session_profile(configuration, name)
+        except ValueError as e:
+            print_error(str(e))
+            sys.exit(1)
+    label_filters = configuration.get("label_filters") or {}
+    for key, value in (("vo", args.select_vo),
+                       ("library", args.select_library),
+                       ("media_type", args.select_media_type),
+                       ("file_family", args.select_file_family),
+                       ("label_ranges", args.select_label_range),
+                       ("min_active_files", args.min_active_files),
+                       ("max_active_files", args.max_active_files)):
+        if value is not None:
+            label_filters[key] = value
+    configuration["label_filters"] = label_filters
+    if args.duplicate_policy:
+        configuration["duplicate_policy"] = args.duplicate_policy
+    if args.prefer_vo:
+        configuration["prefer_vo"] = args.prefer_vo
+    configuration["prefer_vo"] = as_list(configuration.get("prefer_vo") or [])
+    if (configuration.get("duplicate_policy") and
+            configuration["duplicate_policy"] not in POLICIES):
+        print_error("Unknown duplicate_policy %s, expected one of %s" %
+                    (configuration["duplicate_policy"],
+                     ", ".join(sorted(POLICIES.keys()))))
+        sys.exit(1)
+    if (configuration.get("duplicate_policy") == "vo" and
+            not configuration["prefer_vo"]):
+        print_error("duplicate_policy vo requires prefer_vo")
+        sys.exit(1)
+    configuration["telemetry_interval"] = args.telemetry_interval
+    configuration["batch_size"] = args.batch_size
+    configuration["pool_size"] = args.pool_size
+    if args.snapshot:
+        configuration["enstore_snapshot"] = args.snapshot
+    if args.volume_cache:
+        configuration["volume_cache"] = args.volume_cache
+    snapshot = None
+    if configuration.get("enstore_snapshot") and not args.export_snapshot:
+        try:
+            snapshot = Snapshot(configuration.get("enstore_snapshot"))
+            print_message("Using Enstore snapshot %s exported %s" %
+                          (configuration.get("enstore_snapshot"),
+                           time.ctime(snapshot.exported)))
+        except (OSError, IOError, ValueError) as e:
+            print_error("Failed to open Enstore snapshot %s, %s" %
+                        (configuration.get("enstore_snapshot"), str(e)))
+            sys.exit(1)
+    print (configuration)
+
+    if args.label and args.all:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    if not args.label and not args.all:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    if args.sync and args.shard_coordinator:
+        print_error("--sync can not be used with --shard_coordinator")
+        sys.exit(1)
+
+    if args.sync and configuration.get("enstore_snapshot"):
+        print_error("--sync reads the current state of Enstore DB and can "
+                    "not be used with --snapshot")
+        sys.exit(1)
+
+    if args.staging and (args.sync or args.shard_coordinator or
+                         args.engine == "async"):
+        print_error("--staging can not be used with --sync, "
+                    "--shard_coordinator or --engine async")
+        sys.exit(1)
+
+    if args.fresh_load and (args.sync or args.add or args.shard_coordinator):
+        print_error("--fresh_load can not be used with --sync, --add or "
+                    "--shard_coordinator")
+        sys.exit(1)
+
+    if args.engine == "async":
+        if args.shard_coordinator:
+            print_error("--engine async can not be used with --shard_coordinator")
+            sys.exit(1)
+        if args.sync:
+            print_error("--engine async can not be used with --sync")
+            sys.exit(1)
+        if configuration.get("volume_cache"):
+            print_error("--engine async does not use volume cache, use "
+                        "--snapshot or the process engine")
+            sys.exit(1)
+        if aio.psycopg is None:
+            print_error("--engine async requires psycopg 3, pip install psycopg")
+            sys.exit(1)
+
+    cta_db, enstore_db, chimera_db = None, None, None
+
+    try:
+        cta_db = open_connection(configuration, "cta_db")
+    except:
+        print_error("Failed to initialize connection to cta_db, quitting")
+        sys.exit(1)
+
+    #
+    # with a snapshot labels, bootstrap and pre-flight check are served
+    # from it, Enstore DB is not used at all
+    #
+    if not snapshot:
+        try:
+            enstore_db = open_connection(configuration, "enstore_db")
+        except:
+            print_error("Failed to initialize connection to enstore_db, quitting")
+            sys.exit(1)
+
+    try:
+        chimera_db = open_connection(configuration, "chimera_db")
+        chimera_db.close()
+    except:
+        print_error("Failed to initialize connection to chimera_db, quitting")
+        sys.exit(1)
+
+    if args.add:
+        if args.storage_class and args.vo:
+            insert_storage_class(cta_db, args.storage_class, args.vo, 1)
+
+    labels = None
+    if args.label:
+        labels = [i.upper() for i in args.label.strip().split(",")]
+
+    if args.all:
+        try:
+            labels = get_labels(enstore_db, media_types,
+                                configuration["label_filters"], snapshot)
+        except (ValueError, psycopg2.Error, OSError, IOError) as e:
+            print_error("Failed to select labels, %s" % (str(e).strip(), ))
+            sys.exit(1)
+        print_message("Selected %d labels" % (len(labels), ))
+
+    if not labels:
+         print_error("**** No labels found, quitting ***")
+         sys.exit(1)
+
+    if args.export_snapshot:
+        try:
+            export_snapshot(enstore_db, args.export_snapshot, labels,
+                            media_types)
+        except Exception as e:
+            print_error("Failed to export snapshot, %s" % (str(e), ))
+            sys.exit(1)
+        sys.exit(0)
+
+    if configuration.get("duplicate_policy"):
+        try:
+            duplicates = find_duplicates(enstore_db, labels, media_types,
+                                         configuration["label_filters"],
+                                         snapshot)
+        except (ValueError, psycopg2.Error, OSError, IOError) as e:
+            print_error("Failed to find duplicate pnfsids, %s" %
+                        (str(e).strip(), ))
+            sys.exit(1)
+        configuration["skip_bfids"] = resolve_duplicates(
+            duplicates,
+            configuration["duplicate_policy"],
+            configuration["prefer_vo"])
+
+    if args.verify:
+        t0 = time.time()
+        if not args.verify_all_files:
+            try:
+                labels = compare_digests(enstore_db, cta_db, labels,
+                                         media_types, snapshot,
+                                         configuration.get("skip_bfids"))
+            except Exception as e:
+                print_error("Failed to compare digests, %s" % (str(e), ))
+                sys.exit(1)
+        if enstore_db:
+            enstore_db.close()
+        cta_db.close()
+        summaries = verify_labels(labels, configuration, args.cpu_count,
+                                  args.report)
+        bad = [i for i in summaries if i["discrepancies"]]
+        print_message("Verified %d labels, %d files, %d labels with "
+                      "discrepancies, %d discrepancies in %d seconds" %
+                      (len(summaries), sum([i["files"] for i in summaries]),
+                       len(bad), sum([i["discrepancies"] for i in bad]),
+                       int(time.time() - t0 + 0.5)))
+        sys.exit(1 if bad or len(summaries) != len(labels) else 0)
+
+    if args.plan:
+        expected = None
+        try:
+            if not args.add:
+                expected = get_bootstrap_plan(enstore_db, configuration,
+                                              snapshot)
+        except ValueError as e:
+            print_error("Failed to derive CTA objects, %s" % (str(e), ))
+            sys.exit(1)
+        problems = preflight(enstore_db, cta_db, labels, configuration,
+                             expected, snapshot)
+        sys.exit(1 if problems else 0)
+
+    if args.shard_coordinator:
+        try:
+            shard.prepare(enstore_db, cta_db, labels, configuration,
+                          skip_bootstrap=args.add, snapshot=snapshot)
+        except Exception as e:
+            print_error("Failed to prepare work table, %s" % (str(e), ))
+            sys.exit(1)
+    elif not args.add:
+        try:
+            bootstrap_cta(enstore_db, cta_db, configuration, snapshot)
+        except Exception as e:
+            print_error("Failed to bootstrap CTA objects, %s" % (str(e), ))
+            sys.exit(1)
+
+    if preflight(enstore_db, cta_db, labels, configuration,
+                 snapshot=snapshot):
+        print_error("**** Some volumes can not be migrated, fix configuration "
+                    "or CTA and try again, quitting ***")
+        sys.exit(1)
+
+    if args.fresh_load:
+        try:
+            prepare_fresh_load(cta_db)
+        except Exception as e:
+            print_error("Failed to prepare fresh load, %s" % (str(e), ))
+            sys.exit(1)
+
+    if enstore_db:
+        enstore_db.close()
+    cta_db.close()
+
+    print_message("**** Start processing %d  labels ****" % (len(labels), ))
+    t0 = time.time()
+    fresh_load_problems = []
+
+    try:
+        if args.shard_coordinator:
+            results = shard.migrate_shard(configuration, args.cpu_count)
+        elif args.engine == "async":
+            results = aio.migrate_labels(labels, configuration, args.cpu_count)
+        elif args.sync:
+            results = sync_labels(labels, configuration, args.cpu_count)
+        elif args.staging:
+            results = stage_labels(labels, configuration, args.cpu_count)
+        else:
+            results = migrate_labels(labels, configuration, args.cpu_count)
+    except psycopg2.Error as e:
+        print_error("Migration failed, %s" % (str(e), ))
+        sys.exit(1)
+    finally:
+        if args.fresh_load:
+            fresh_load_problems = finish_fresh_load(configuration,
+                                                    args.cpu_count)
+            for problem in fresh_load_problems:
+                print_error("Fresh load, %s" % (problem, ))
+            if fresh_load_problems:
+                print_error("**** Fix violations and run with --fresh_load "
+                            "again to rebuild remaining indexes and "
+                            "constraints ***")
+
+    if os.path.exists(STOPPER):
+        print_error(f"Found {STOPPER} file. Quitting...")
+        sys.exit(1)
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    print_message("Labels: %s" % (", ".join(["%s %d" % (k, v) for k, v
+                                             in sorted(counts.items())]), ))
+    if configuration.get("skip_bfids"):
+        print_message("Files skipped as duplicate pnfsid: %d" %
+                      (sum([result.get("duplicates", 0)
+                            for result in results]), ))
+
+    print_message("**** FINISH ****")
+    print_message("Took %d seconds" % (int(time.time()-t0+0.5),))
+    if fresh_load_problems:
+        sys.exit(1)
+
+
+def main_one_tape_pool_per_vo():
+    """
+    Same as main with one tape pool per VO and copy
+    """
+    main(tape_pool_naming="vo")
@@ -0,0 +1,268 @@
+"""
+Thin helpers around psycopg2 connections used by the migration
+"""
+from __future__ import print_function
+import psycopg2
+import psycopg2.extras
+
+try:
+    import urlparse
+except ModuleNotFoundError:
+    import urllib.parse as urlparse
+
+
+APPLICATION_NAME = "enstore2cta"
+
+# libpq connection parameters, other profile entries are session
+# settings passed with "-c" in options
+CONNECTION_PARAMETERS = ("connect_timeout",
+                         "keepalives",
+                         "keepalives_idle",
+                         "keepalives_interval",
+                         "keepalives_count",
+                         "sslmode")
+
+# session profile presets
+SESSION_PROFILES = {
+    "default": {},
+    # bulk load into CTA and chimera. A crash can lose the last
+    # transactions, labels of an interrupted run are migrated again
+    "bulk": {
+        "synchronous_commit": "off",
+        "work_mem": "64MB",
+        "maintenance_work_mem": "1GB",
+        "statement_timeout": "0",
+        "idle_in_transaction_session_timeout": "0",
+        "keepalives": 1,
+        "keepalives_idle": 60,
+        "keepalives_interval": 10,
+        "keepalives_count": 6,
+    },
+}
+
+
+def get_session_profile(config, name):
+    """
+    Session profile of database from session_profiles configuration.
+    Profile is a name of a preset in SESSION_PROFILES or a dictionary
+    of settings overriding those of its "preset" entry
+
+    :param config: configuration
+    :type config: dict
+    :param name: database, key of configuration, e.g. cta_db
+    :type name: str
+    :return: dictionary setting -> value
+    :rtype: dict
+    """
+    profile = (config.get("session_profiles") or {}).get(name)
+    if not profile:
+        return {}
+    if not isinstance(profile, dict):
+        profile = {"preset": profile}
+    preset = profile.get("preset", "default")
+    if preset not in SESSION_PROFILES:
+        raise ValueError("Unknown session profile %s of %s, expected one of %s" %
+                         (preset, name, ", ".join(sorted(SESSION_PROFILES))))
+    settings = dict(SESSION_PROFILES[preset])
+    settings.update((key, value) for key, value in profile.items()
+                    if key != "preset")
+    return settings
+
+
+def get_connection_parameters(uri, profile=None, application_name=None):
+    """
+    Keyword arguments of psycopg2.connect (and psycopg.connect) for
+    database URI and session profile
+
+    :param uri: database URI
+    :type uri: str
+    :param profile: session profile, see get_session_profile
+    :type profile: dict
+    :param application_name: application_name of the session
+    :type application_name: str
+    :return: connection parameters
+    :rtype: dict
+    """
+    result = urlparse.urlparse(uri)
+    parameters = {"dbname": result.path[1:],
+                  "user": result.username,
+                  "password": result.password,
+                  "host": result.hostname,
+                  "port": result.port,
+                  "application_name": application_name or APPLICATION_NAME}
+    options = []
+    for key, value in sorted((profile or {}).items()):
+        if key in CONNECTION_PARAMETERS:
+            parameters[key] = value
+        else:
+            options.append("-c %s=%s" % (key, str(value).replace(
+                "\\", "\\\\").replace(" ", "\\ ")))
+    if options:
+        parameters["options"] = " ".join(options)
+    return parameters
+
+
+# create DB connection from URI
+def create_connection(uri, profile=None, application_name=None):
+    connection = psycopg2.connect(**get_connection_parameters(
+        uri, profile, application_name))
+    return connection
+
+
+def open_connection(config, name, tag=None):
+    """
+    Connection to database of configuration with its session profile
+
+    :param config: configuration
+    :type config: dict
+    :param name: database, key of configuration, e.g. cta_db
+    :type name: str
+    :param tag: appended to application_name, e.g. worker name
+    :type tag: str
+    :return: connection
+    :rtype: Connection
+    """
+    return create_connection(config.get(name),
+                             get_session_profile(config, name),
+                             get_application_name(config, tag))
+
+
+def get_application_name(config, *tags):
+    """
+    application_name configuration (default enstore2cta) followed
+    by tags, e.g. worker name and label
+    """
+    return " ".join([config.get("application_name") or APPLICATION_NAME] +
+                    [str(i) for i in tags if i])
+
+
+def set_application_name(con, application_name):
+    """
+    Change application_name of session, e.g. to label being processed
+    """
+    update(con, "select set_config('application_name', %s, false)",
+           (application_name, ))
+
+
+def update(con, sql, pars=None):
+    """
+    Update database record
+
+    :param con: database connection
+    :type con: Connection
+
+    :param sql: SQL statement
+    :type sql: str
+
+    :param pars: query parameters
+    :type pars: tuple
+
+    :return: result
+    :rtype: object
+    """
+    return insert(con, sql, pars)
+
+
+def insert(con, sql, pars=None):
+    """
+    Insert database record
+
+    :param con: database connection
+    :type con: Connection
+
+    :param sql: SQL statement
+    :type sql: str
+
+    :param pars: query parameters
+    :type pars: tuple
+
+    :return: number of rows inserted
+    :rtype: int
+    """
+    cursor = None
+    try:
+        cursor = con.cursor()
+        if pars:
+            cursor.execute(sql, pars)
+        else:
+            cursor.execute(sql)
+        con.commit()
+        return cursor.rowcount
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+def insert_returning(con, sql, pars=None):
+    """
+    Insert database record
+
+    :param con: database connection
+    :type con: Connection
+
+    :param sql: SQL statement
+    :type sql: str
+
+    :param pars: query parameters
+    :type pars: tuple
+
+    :return: result
+    :rtype: object
+    """
+    cursor = None
+    try:
+        sql +=  "returning *"
+        cursor = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        if pars:
+            cursor.execute(sql, pars)
+        else:
+            cursor.execute(sql)
+        res = cursor.fetchone()
+        con.commit()
+        return res
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
+def select(con, sql, pars=None):
+    """
+    Select  database records
+
+    :param con: database connection
+    :type con: Connection
+
+    :param sql: SQL statement
+    :type sql: str
+
+    :param pars: query parameters
+    :type pars: tuple
+
+    :return: result
+    :rtype: object
+    """
+    cursor = None
+    try:
+        cursor = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        if pars:
+            cursor.execute(sql, pars)
+        else:
+            cursor.execute(sql)
+        return cursor.fetchall()
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
@@ -0,0 +1,273 @@
+"""
+Per-volume digests of Enstore and CTA. A digest is the count and the sum
+of 64 bit hashes of (pnfs_id, size, adler32, fseq) of the files of a
+volume, computed in SQL on both sides. The sum does not depend on row
+order, so equal digests mean equal file sets and re-verification only
+needs to look at files of volumes whose digests differ. A file counts
+once however many copies it has, files of skip_bfids (duplicate pnfsids
+that are not migrated) are left out. Digests are kept in table
+enstore2cta_digest in CTA database together with the fingerprint of the
+Enstore volume and of skip_bfids; Enstore digests of volumes that did
+not change are not computed again.
+"""
+from __future__ import print_function
+import hashlib
+
+import psycopg2.extras
+
+from enstore2cta.db import insert, select
+from enstore2cta.migration import (HOSTNAME, enstore_checksum,
+                                   get_switch_epoch, tape_file_values)
+from enstore2cta.snapshot import get_fingerprint
+from enstore2cta.util import print_message
+
+
+# number of labels per digest query
+CHUNK = 1000
+
+CREATE_DIGEST_TABLE = """
+create table if not exists enstore2cta_digest (
+  label varchar(100) primary key,
+  fingerprint varchar(16),
+  enstore_files bigint,
+  enstore_digest numeric,
+  cta_files bigint,
+  cta_digest numeric,
+  verified timestamp with time zone not null default now()
+)
+"""
+
+#
+# same files as migration.SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY,
+# once per bfid (it returns a row per copy) and without skip_bfids,
+# adler32 and fseq converted the way migration converts them
+#
+SELECT_ENSTORE_DIGESTS = """
+select f.label,
+       count(*) as files,
+       coalesce(sum(('x'||substr(md5(f.pnfs_id||':'||f.size::bigint||':'||
+          (case when substr(f.bfid, 5, 10)::bigint < %(switch_epoch)s
+           then ((((f.size::bigint %% 65521) + ((f.crc::bigint >> 16) & 65535)) %% 65521) << 16)
+                + (((f.crc::bigint & 65535) + 1) %% 65521)
+           else f.crc::bigint end)||':'||
+          (case when f.wrapper = 'cern'
+           then (split_part(f.location_cookie, '_', 3)::bigint - 2) / 3 + 1
+           else split_part(f.location_cookie, '_', 3)::bigint end)),
+          1, 16))::bit(64)::bigint::numeric), 0) as digest
+from (select distinct v.label, v.wrapper, f.bfid, f.pnfs_id, f.size, f.crc,
+             f.location_cookie
+      from file f
+      inner join volume v on v.id = f.volume
+      left outer join file_copies_map fcm on fcm.bfid = f.bfid
+      left outer join file f1 on f1.bfid = fcm.alt_bfid
+        where
+              v.media_type = any(%(media_types)s)
+              and v.system_inhibit_0 = 'none'
+              and v.label = any(%(labels)s)
+              and v.active_files > 0
+              and (f1.deleted is null or f1.deleted = 'n')
+              and f.deleted = 'n'
+              and not (f.bfid = any(%(skip_bfids)s))) f
+group by f.label
+"""
+
+SELECT_CTA_DIGESTS = """
+select tf.vid,
+       count(*) as files,
+       coalesce(sum(('x'||substr(md5(af.disk_file_id||':'||af.size_in_bytes||':'||
+          af.checksum_adler32||':'||tf.fseq), 1, 16))::bit(64)::bigint::numeric),
+          0) as digest
+from tape_file tf
+inner join archive_file af on af.archive_file_id = tf.archive_file_id
+where tf.vid = any(%s) and tf.copy_nb = 1
+group by tf.vid
+"""
+
+SELECT_VOLUMES = """
+select * from volume where label = any(%s)
+"""
+
+SELECT_STORED_DIGESTS = """
+select * from enstore2cta_digest where label = any(%s)
+"""
+
+UPSERT_DIGESTS = """
+insert into enstore2cta_digest (label, fingerprint, enstore_files,
+  enstore_digest, cta_files, cta_digest, verified)
+values %s
+on conflict (label) do update set
+  fingerprint = excluded.fingerprint,
+  enstore_files = excluded.enstore_files,
+  enstore_digest = excluded.enstore_digest,
+  cta_files = excluded.cta_files,
+  cta_digest = excluded.cta_digest,
+  verified = excluded.verified
+"""
+
+
+def chunks(items, size=CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def file_hash(pnfs_id, size, crc, fseq):
+    """
+    Same hash as computed in SQL: first 64 bits of md5 as signed integer
+    """
+    value = int(hashlib.md5(("%s:%d:%d:%d" % (pnfs_id, size, crc, fseq)).encode(
+        "utf-8")).hexdigest()[:16], 16)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def get_skip_fingerprint(volume_fingerprint, skip_bfids):
+    """
+    Fingerprint of volume combined with skip_bfids, so that a stored
+    Enstore digest is computed again when the set of skipped files changes
+    """
+    if not skip_bfids:
+        return volume_fingerprint
+    return hashlib.sha1(("%s|%s" % (volume_fingerprint,
+                                    ",".join(sorted(skip_bfids)))
+                         ).encode("utf-8")).hexdigest()[:16]
+
+
+def get_enstore_digests(enstore_db, labels, media_types, skip_bfids=None):
+    """
+    Digests of Enstore volumes computed in Enstore DB
+
+    :return: dictionary label -> (files, digest)
+    :rtype: dict
+    """
+    switch_epoch = get_switch_epoch() if HOSTNAME.endswith(".fnal.gov") else 0
+    digests = {}
+    for chunk in chunks(labels):
+        for row in select(enstore_db, SELECT_ENSTORE_DIGESTS,
+                          {"labels": chunk,
+                           "media_types": media_types,
+                           "switch_epoch": switch_epoch,
+                           "skip_bfids": sorted(skip_bfids or [])}):
+            digests[row["label"]] = (row["files"], int(row["digest"]))
+    return digests
+
+
+def get_snapshot_digests(snapshot, labels, skip_bfids=None):
+    """
+    Digests of Enstore volumes computed from snapshot files, a file
+    counts once however many copy rows it has
+
+    :return: dictionary label -> (files, digest)
+    :rtype: dict
+    """
+    skip_bfids = skip_bfids or set()
+    digests = {}
+    for label in labels:
+        files = dict((f["bfid"], f) for f in snapshot.get_files(label)
+                     if f["bfid"] not in skip_bfids).values()
+        if files:
+            digests[label] = (len(files),
+                              sum([file_hash(f["pnfs_id"],
+                                             f["size"],
+                                             enstore_checksum(f),
+                                             tape_file_values(f, label[:6],
+                                                              None)[1])
+                                   for f in files]))
+    return digests
+
+
+def get_cta_digests(cta_db, labels):
+    """
+    Digests of CTA tapes of labels
+
+    :return: dictionary label -> (files, digest)
+    :rtype: dict
+    """
+    vids = dict((label[:6], label) for label in labels)
+    digests = {}
+    for chunk in chunks(list(vids.keys())):
+        for row in select(cta_db, SELECT_CTA_DIGESTS, (chunk, )):
+            digests[vids[row["vid"]]] = (row["files"], int(row["digest"]))
+    return digests
+
+
+def compare_digests(enstore_db, cta_db, labels, media_types,
+                    snapshot=None, skip_bfids=None):
+    """
+    Compare digests of Enstore volumes and CTA tapes and store them.
+    Enstore digests are taken from enstore2cta_digest for volumes which
+    fingerprint did not change since they were stored
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param cta_db: cta database connection
+    :type cta_db: Connection
+    :param labels: Enstore volume labels
+    :type labels: list
+    :param media_types: Enstore media types to migrate
+    :type media_types: list
+    :param snapshot: compute Enstore digests from snapshot instead
+    :type snapshot: snapshot.Snapshot
+    :param skip_bfids: bfids of files that are not migrated
+    :type skip_bfids: set
+    :return: labels which digests differ
+    :rtype: list
+    """
+    insert(cta_db, CREATE_DIGEST_TABLE)
+    fingerprints = {}
+    stored = {}
+    for chunk in chunks(labels):
+        if snapshot:
+            volumes = [snapshot.get_volume(label) for label in chunk]
+        else:
+            volumes = select(enstore_db, SELECT_VOLUMES, (chunk, ))
+        for volume in volumes:
+            if volume:
+                fingerprints[volume["label"]] = get_skip_fingerprint(
+                    get_fingerprint(volume), skip_bfids)
+        for row in select(cta_db, SELECT_STORED_DIGESTS, (chunk, )):
+            stored[row["label"]] = row
+
+    enstore_digests = {}
+    changed = []
+    for label in labels:
+        row = stored.get(label)
+        if row and row["fingerprint"] == fingerprints.get(label):
+            enstore_digests[label] = (row["enstore_files"],
+                                      int(row["enstore_digest"]))
+        else:
+            changed.append(label)
+    if snapshot:
+        enstore_digests.update(get_snapshot_digests(snapshot, changed,
+                                                    skip_bfids))
+    else:
+        enstore_digests.update(get_enstore_digests(enstore_db, changed,
+                                                   media_types, skip_bfids))
+    cta_digests = get_cta_digests(cta_db, labels)
+
+    differ = []
+    values = []
+    for label in labels:
+        enstore_files, enstore_digest = enstore_digests.get(label, (0, 0))
+        cta_files, cta_digest = cta_digests.get(label, (0, 0))
+        if (enstore_files, enstore_digest) != (cta_files, cta_digest):
+            differ.append(label)
+        values.append((label, fingerprints.get(label), enstore_files,
+                       enstore_digest, cta_files, cta_digest))
+
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        psycopg2.extras.execute_values(cursor, UPSERT_DIGESTS, values,
+                                       template="(%s, %s, %s, %s, %s, %s, now())")
+        cta_db.commit()
+    except Exception:
+        cta_db.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+
+    print_message("Digests: %d labels, %d Enstore digests computed, "
+                  "%d reused, %d differ" %
+                  (len(labels), len(changed), len(labels) - len(changed),
+                   len(differ)))
+    return differ
@@ -0,0 +1,171 @@
+"""
+Pre-detection of pnfsids that are on more than one Enstore volume to
+migrate. CTA allows one archive file per pnfsid, so all but one
+of such files would fail to insert. Duplicates of the files of the
+labels to migrate are found with one grouped query before migration
+and a policy decides which of the files, if any, is migrated. Workers
+drop the others from their file lists, see migration.skip_duplicates.
+"""
+from __future__ import print_function
+
+from enstore2cta.db import select
+from enstore2cta.migration import get_volume_filter, get_volume_predicate
+from enstore2cta.util import print_error, print_message
+
+
+#
+# files of volumes to migrate, see migration.get_volume_filter, which
+# pnfsid is on more than one of them, limited to pnfsids of files of
+# labels. Files are those migration.SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY
+# returns: files which copy was deleted are not migrated either
+#
+SELECT_DUPLICATE_PNFSIDS = """
+select distinct f.pnfs_id, f.bfid, v.label, v.storage_group
+from file f
+inner join volume v on v.id = f.volume
+left outer join file_copies_map fcm on fcm.bfid = f.bfid
+left outer join file f1 on f1.bfid = fcm.alt_bfid
+  where f.volume in (select id from volume where {volume_filter})
+        and (f1.deleted is null or f1.deleted = 'n')
+        and f.deleted = 'n'
+        and f.pnfs_id in (
+          select f.pnfs_id
+          from file f
+          left outer join file_copies_map fcm on fcm.bfid = f.bfid
+          left outer join file f1 on f1.bfid = fcm.alt_bfid
+            where f.volume in (select id from volume where {volume_filter})
+                  and (f1.deleted is null or f1.deleted = 'n')
+                  and f.deleted = 'n'
+                  and f.pnfs_id in (
+                    select f.pnfs_id
+                    from file f
+                    inner join volume v on v.id = f.volume
+                      where v.label = any(%(labels)s)
+                            and f.deleted = 'n'
+                            and f.pnfs_id <> '')
+          group by f.pnfs_id
+          having count(distinct f.bfid) > 1)
+order by f.pnfs_id, f.bfid
+"""
+
+
+def bfid_time(row):
+    try:
+        return (int(row["bfid"][4:14]), row["bfid"])
+    except ValueError:
+        return (0, row["bfid"])
+
+
+def keep_none(rows, prefer_vo):
+    return None
+
+
+def keep_newest(rows, prefer_vo):
+    return max(rows, key=bfid_time)
+
+
+def keep_vo(rows, prefer_vo):
+    for vo in prefer_vo:
+        candidates = [row for row in rows if row["storage_group"] == vo]
+        if candidates:
+            return keep_newest(candidates, prefer_vo)
+    return keep_newest(rows, prefer_vo)
+
+
+# policy -> function choosing file of duplicate pnfsid that is migrated
+POLICIES = {
+    # none of them
+    "skip": keep_none,
+    # file with the newest bfid
+    "newest": keep_newest,
+    # newest file on a volume of the first VO of prefer_vo that has
+    # one, newest file if none has
+    "vo": keep_vo,
+}
+
+
+def find_snapshot_duplicates(snapshot, labels, media_types, filters=None):
+    """
+    Same as find_duplicates among volumes and files of snapshot
+    """
+    predicate = get_volume_predicate(filters, media_types)
+    volumes = [volume for volume in snapshot.get_volumes()
+               if predicate(volume)]
+    pnfs_ids = set()
+    for label in labels:
+        pnfs_ids.update([f["pnfs_id"] for f in snapshot.get_files(label)
+                         if f["pnfs_id"]])
+    rows = {}
+    for volume in volumes:
+        for f in snapshot.get_files(volume["label"]):
+            if f["pnfs_id"] in pnfs_ids:
+                rows.setdefault(f["pnfs_id"], {})[f["bfid"]] = {
+                    "pnfs_id": f["pnfs_id"],
+                    "bfid": f["bfid"],
+                    "label": volume["label"],
+                    "storage_group": volume["storage_group"]}
+    return dict((pnfs_id, [files[bfid] for bfid in sorted(files)])
+                for pnfs_id, files in rows.items() if len(files) > 1)
+
+
+def find_duplicates(enstore_db, labels, media_types, filters=None,
+                    snapshot=None):
+    """
+    Find pnfsids of files of labels that are on more than one Enstore
+    volume to migrate. Only files that are migrated are candidates,
+    so the file a policy keeps does reach CTA
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param labels: Enstore volume labels
+    :type labels: list
+    :param media_types: Enstore media types to migrate
+    :type media_types: list
+    :param filters: label filters, see migration.get_volume_filter
+    :type filters: dict
+    :param snapshot: search volumes of snapshot instead of Enstore DB
+    :type snapshot: snapshot.Snapshot
+    :return: dictionary pnfs_id -> rows (pnfs_id, bfid, label, storage_group)
+    :rtype: dict
+    """
+    if snapshot:
+        return find_snapshot_duplicates(snapshot, labels, media_types, filters)
+    condition, pars = get_volume_filter(filters, media_types)
+    pars["labels"] = labels
+    duplicates = {}
+    for row in select(enstore_db,
+                      SELECT_DUPLICATE_PNFSIDS.format(volume_filter=condition),
+                      pars):
+        duplicates.setdefault(row["pnfs_id"], []).append(row)
+    return duplicates
+
+
+def resolve_duplicates(duplicates, policy, prefer_vo=None):
+    """
+    Apply policy to duplicate pnfsids and print them in one list
+
+    :param duplicates: as returned by find_duplicates
+    :type duplicates: dict
+    :param policy: key of POLICIES
+    :type policy: str
+    :param prefer_vo: VOs in order of preference for policy vo
+    :type prefer_vo: list
+    :return: bfids of files not to migrate
+    :rtype: set
+    """
+    if policy not in POLICIES:
+        raise ValueError("Unknown duplicate policy %s, expected one of %s" %
+                         (policy, ", ".join(sorted(POLICIES))))
+    skip = set()
+    for pnfs_id, rows in sorted(duplicates.items()):
+        kept = POLICIES[policy](rows, prefer_vo or [])
+        skipped = [row for row in rows if row is not kept]
+        skip.update([row["bfid"] for row in skipped])
+        print_error("%s, multiple pnfsid, migrating %s, skipping %s" %
+                    (pnfs_id,
+                     "%s %s" % (kept["label"], kept["bfid"]) if kept else "none",
+                     ", ".join(["%s %s" % (row["label"], row["bfid"])
+                                for row in skipped])))
+    print_message("%d duplicate pnfsids, %d files skipped, policy %s" %
+                  (len(duplicates), len(skip), policy))
+    return skip
@@ -0,0 +1,323 @@
+"""
+Fresh load mode for the initial migration into an empty CTA catalogue.
+Secondary indexes, unique constraints and foreign keys of archive_file
+and tape_file are dropped before the load, so inserts only maintain
+the primary keys and the unique index on (disk_instance_name,
+disk_file_id), which is kept to reject duplicate pnfsids as they are
+inserted. After the load indexes are built in parallel
+connections, unique constraints are attached to their indexes and
+foreign keys are added NOT VALID and validated. Rows violating
+a constraint are reported and the constraint is left out (unique) or
+not validated (foreign key).
+"""
+from __future__ import print_function
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from enstore2cta.db import open_connection, select
+from enstore2cta.util import print_error, print_message
+
+
+# index name -> statement, see sql/cta_schema.sql
+INDEXES = (
+    ("archive_file_dfi_idx",
+     "create index archive_file_dfi_idx on archive_file "
+     "using btree (disk_file_id)"),
+    ("archive_file_din_idx",
+     "create index archive_file_din_idx on archive_file "
+     "using btree (disk_instance_name)"),
+    ("archive_file_sci_idx",
+     "create index archive_file_sci_idx on archive_file "
+     "using btree (storage_class_id)"),
+    ("tape_file_archive_file_id_idx",
+     "create index tape_file_archive_file_id_idx on tape_file "
+     "using btree (archive_file_id)"),
+    ("tape_file_vid_idx",
+     "create index tape_file_vid_idx on tape_file using btree (vid)"),
+    ("archive_file_din_dfi_un",
+     "create unique index archive_file_din_dfi_un on archive_file "
+     "using btree (disk_instance_name, disk_file_id)"),
+    ("tape_file_vid_block_id_un",
+     "create unique index tape_file_vid_block_id_un on tape_file "
+     "using btree (vid, block_id)"),
+)
+
+# dropped by no fresh load, rebuilt if an earlier fresh load dropped them
+KEPT = ("archive_file_din_dfi_un", )
+
+# unique constraints using unique index of the same name
+UNIQUE_CONSTRAINTS = (
+    ("archive_file", "archive_file_din_dfi_un", "deferrable"),
+    ("tape_file", "tape_file_vid_block_id_un", ""),
+)
+
+FOREIGN_KEYS = (
+    ("archive_file", "archive_file_din_fk",
+     "foreign key (disk_instance_name) "
+     "references disk_instance(disk_instance_name)"),
+    ("archive_file", "archive_file_storage_class_fk",
+     "foreign key (storage_class_id) "
+     "references storage_class(storage_class_id)"),
+    ("tape_file", "tape_file_archive_file_fk",
+     "foreign key (archive_file_id) "
+     "references archive_file(archive_file_id)"),
+    ("tape_file", "tape_file_tape_fk",
+     "foreign key (vid) references tape(vid)"),
+)
+
+# constraint -> rows violating it
+VIOLATIONS = {
+    "archive_file_din_dfi_un": """
+select disk_instance_name||':'||disk_file_id as key, count(*) as nb_rows
+from archive_file
+group by disk_instance_name, disk_file_id
+having count(*) > 1
+""",
+    "tape_file_vid_block_id_un": """
+select vid||':'||block_id as key, count(*) as nb_rows
+from tape_file
+group by vid, block_id
+having count(*) > 1
+""",
+    "archive_file_din_fk": """
+select af.disk_instance_name as key, count(*) as nb_rows
+from archive_file af
+left outer join disk_instance di on di.disk_instance_name = af.disk_instance_name
+where di.disk_instance_name is null
+group by af.disk_instance_name
+""",
+    "archive_file_storage_class_fk": """
+select af.storage_class_id::text as key, count(*) as nb_rows
+from archive_file af
+left outer join storage_class sc on sc.storage_class_id = af.storage_class_id
+where sc.storage_class_id is null
+group by af.storage_class_id
+""",
+    "tape_file_archive_file_fk": """
+select tf.archive_file_id::text as key, count(*) as nb_rows
+from tape_file tf
+left outer join archive_file af on af.archive_file_id = tf.archive_file_id
+where af.archive_file_id is null
+group by tf.archive_file_id
+""",
+    "tape_file_tape_fk": """
+select tf.vid as key, count(*) as nb_rows
+from tape_file tf
+left outer join tape t on t.vid = tf.vid
+where t.vid is null
+group by tf.vid
+""",
+}
+
+SELECT_OBJECTS = """
+select 'constraint' as kind, conname as name, convalidated as valid
+from pg_constraint
+  where conrelid in ('archive_file'::regclass, 'tape_file'::regclass)
+union all
+select 'index', indexname, true from pg_indexes
+  where tablename in ('archive_file', 'tape_file')
+"""
+
+# number of violating keys printed per constraint
+EXAMPLES = 10
+
+
+def get_deferred_objects():
+    """
+    Indexes and constraints of fresh load as (kind, name)
+    """
+    return (set([("index", i[0]) for i in INDEXES]) |
+            set([("constraint", i[1]) for i in UNIQUE_CONSTRAINTS]) |
+            set([("constraint", i[1]) for i in FOREIGN_KEYS]))
+
+
+def get_objects(cta_db):
+    """
+    Indexes and constraints of archive_file and tape_file
+
+    :return: dictionary (kind, name) -> valid
+    :rtype: dict
+    """
+    return dict(((row["kind"], row["name"]), row["valid"])
+                for row in select(cta_db, SELECT_OBJECTS))
+
+
+def prepare_fresh_load(cta_db):
+    """
+    Drop foreign keys, unique constraints and secondary indexes of
+    archive_file and tape_file. archive_file must be empty unless
+    a previous fresh load did not finish
+
+    :param cta_db: cta database connection
+    :type cta_db: Connection
+    :return: number of objects dropped
+    :rtype: int
+    """
+    objects = get_objects(cta_db)
+    missing = get_deferred_objects() - set(objects)
+    if missing:
+        print_message("Resuming fresh load, %d indexes and constraints "
+                      "already dropped" % (len(missing), ))
+    elif select(cta_db, "select archive_file_id from archive_file limit 1"):
+        cta_db.rollback()
+        raise ValueError("archive_file is not empty, fresh load is only "
+                         "for the initial load into an empty CTA catalogue")
+    statements = []
+    for table, name, _ in FOREIGN_KEYS + UNIQUE_CONSTRAINTS:
+        if ("constraint", name) in objects and name not in KEPT:
+            statements.append("alter table %s drop constraint %s" %
+                              (table, name))
+    for name, _ in INDEXES:
+        if ("index", name) in objects and name not in KEPT:
+            # index of unique constraint is dropped with it
+            statements.append("drop index if exists %s" % (name, ))
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cta_db.commit()
+    except Exception:
+        cta_db.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+    print_message("Fresh load, dropped %d indexes and constraints of "
+                  "archive_file and tape_file" % (len(statements), ))
+    return len(statements)
+
+
+def get_violations(config, name):
+    """
+    Rows violating constraint name, see VIOLATIONS
+    """
+    cta_db = open_connection(config, "cta_db", "fresh load check")
+    try:
+        return select(cta_db, VIOLATIONS[name])
+    finally:
+        cta_db.close()
+
+
+def execute(config, name, statement):
+    """
+    Execute statement in its own autocommit connection, return error
+    message or None
+    """
+    cta_db = None
+    t0 = time.time()
+    try:
+        cta_db = open_connection(config, "cta_db", "fresh load %s" % (name, ))
+        cta_db.autocommit = True
+        cursor = cta_db.cursor()
+        cursor.execute(statement)
+        cursor.close()
+        print_message("Fresh load, %s done in %d seconds" %
+                      (name, int(time.time() - t0 + 0.5)))
+        return None
+    except Exception as e:
+        print_error("Fresh load, %s failed, %s" % (name, str(e).strip()))
+        return str(e).strip()
+    finally:
+        if cta_db:
+            cta_db.close()
+
+
+def report(name, violations):
+    print_error("Fresh load, %s violated by %d keys (%d rows), e.g. %s" %
+                (name, len(violations),
+                 sum([row["nb_rows"] for row in violations]),
+                 ", ".join([row["key"] for row in violations[:EXAMPLES]])))
+
+
+def finish_fresh_load(config, concurrency):
+    """
+    Check constraints, build indexes in parallel, add unique constraints
+    and foreign keys and validate the latter. Only objects that do not
+    exist are created, so it can be run again after fixing violations
+
+    :param config: migration configuration
+    :type config: dict
+    :param concurrency: number of parallel connections
+    :type concurrency: int
+    :return: problems found, empty if all indexes and constraints exist
+    :rtype: list
+    """
+    t0 = time.time()
+    cta_db = open_connection(config, "cta_db", "fresh load")
+    try:
+        objects = get_objects(cta_db)
+    finally:
+        cta_db.close()
+    missing = set([name for kind, name in get_deferred_objects()
+                   if not objects.get((kind, name))])
+    if not missing:
+        return []
+    print_message("Fresh load, building %d indexes and constraints" %
+                  (len(missing), ))
+
+    problems = []
+    with ThreadPoolExecutor(max(concurrency, 1)) as executor:
+        checks = dict((name, executor.submit(get_violations, config, name))
+                      for name in VIOLATIONS if name in missing)
+        violated = set()
+        for name, future in sorted(checks.items()):
+            violations = future.result()
+            if violations:
+                report(name, violations)
+                problems.append("%s violated by %d keys" %
+                                (name, len(violations)))
+                violated.add(name)
+
+        # indexes of one table can be built at the same time
+        builds = [(name, executor.submit(execute, config, name, statement))
+                  for name, statement in INDEXES
+                  if ("index", name) not in objects and name not in violated]
+        built = set()
+        for name, future in builds:
+            error = future.result()
+            if error:
+                problems.append("%s not built, %s" % (name, error))
+                if name in VIOLATIONS:
+                    violations = get_violations(config, name)
+                    if violations:
+                        report(name, violations)
+            else:
+                built.add(name)
+
+        for table, name, properties in UNIQUE_CONSTRAINTS:
+            if name in missing and (name in built or
+                                    ("index", name) in objects):
+                error = execute(config, name,
+                                "alter table %s add constraint %s unique "
+                                "using index %s %s" %
+                                (table, name, name, properties))
+                if error:
+                    problems.append("%s not added, %s" % (name, error))
+
+        validations = []
+        for table, name, definition in FOREIGN_KEYS:
+            if name not in missing:
+                continue
+            error = None
+            if ("constraint", name) not in objects:
+                error = execute(config, name,
+                                "alter table %s add constraint %s %s "
+                                "not valid" % (table, name, definition))
+            if error:
+                problems.append("%s not added, %s" % (name, error))
+            elif name not in violated:
+                validations.append(
+                    (name, executor.submit(execute, config,
+                                           "validate %s" % (name, ),
+                                           "alter table %s validate "
+                                           "constraint %s" % (table, name))))
+        for name, future in validations:
+            error = future.result()
+            if error:
+                problems.append("%s not validated, %s" % (name, error))
+
+    print_message("Fresh load, indexes and constraints done in %d seconds, "
+                  "%d problems" % (int(time.time() - t0 + 0.5),
+                                   len(problems)))
+    return problems
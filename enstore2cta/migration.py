@@ -0,0 +1,2005 @@
+"""
+Enstore to CTA migration engine
+"""
+from __future__ import print_function
+import getpass
+import multiprocessing
+import os
+import re
+import socket
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+import psycopg2
+import psycopg2.extras
+
+from enstore2cta.db import (get_application_name, insert, insert_returning,
+                            open_connection, select, set_application_name,
+                            update)
+from enstore2cta.snapshot import Snapshot, VolumeCache
+from enstore2cta.util import (QueueStats, convert_0_adler32_to_1_adler32,
+                              extract_eod, extract_file_number,
+                              get_switch_epoch, print_error, print_message)
+
+
+HOSTNAME = socket.getfqdn()
+
+STOPPER="/tmp/STOP"
+
+# attributes of CTA media types defined in media_types configuration
+MEDIA_TYPE_ATTRIBUTES = ("cartridge",
+                         "capacity_in_bytes",
+                         "primary_density_code",
+                         "secondary_density_code",
+                         "nb_wraps",
+                         "min_lpos",
+                         "max_lpos",
+                         "user_comment")
+
+
+def get_cta_media_types(config):
+    """
+    CTA media types defined in media_types configuration
+
+    :param config: configuration
+    :type config: dict
+    :return: dictionary media type name -> attributes
+    :rtype: dict
+    """
+    media_types = {}
+    for name, value in (config.get("media_types") or {}).items():
+        media_type = dict((key, (value or {}).get(key))
+                          for key in MEDIA_TYPE_ATTRIBUTES)
+        media_type["media_type_name"] = name
+        media_types[name] = media_type
+    return media_types
+
+
+def get_enstore_media_types(config):
+    """
+    Enstore media types to migrate, keys of media_type_map configuration
+
+    :param config: configuration
+    :type config: dict
+    :return: Enstore media types sorted
+    :rtype: list
+    """
+    return sorted((config.get("media_type_map") or {}).keys())
+
+
+def check_media_types(config):
+    """
+    Check media_type_map and media_types configuration
+
+    :param config: configuration
+    :type config: dict
+    :return: list of problems found, empty if configuration is usable
+    :rtype: list
+    """
+    problems = []
+    if not config.get("media_type_map"):
+        problems.append("media_type_map is not configured")
+    for name, media_type in sorted(get_cta_media_types(config).items()):
+        for key in ("cartridge", "capacity_in_bytes"):
+            if media_type[key] is None:
+                problems.append("media type %s: %s is not configured" %
+                                (name, key))
+    return problems
+
+
+INSERT_MEDIA_TYPES = """
+insert into media_type (
+  media_type_id,
+  media_type_name,
+  cartridge,
+  capacity_in_bytes,
+  primary_density_code,
+  secondary_density_code,
+  nb_wraps,
+  min_lpos,
+  max_lpos,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time
+) values (
+  (select nextval('media_type_id_seq')),
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s
+)
+"""
+
+
+#
+# pick up only "primary" volmes that do nopt have
+# '_copy_1' suffix in file_family name. {filters} is replaced
+# by conditions built from label_filters configuration
+#
+VOLUME_FILTER = """media_type = any(%(media_types)s)
+        and system_inhibit_0 = 'none'
+        and library not like 'shelf%%'
+        and file_family not like '%%_copy_1'
+        and active_files > 0
+        {filters}"""
+
+SELECT_ALL_ENSTORE_VOLUMES = """
+select label from volume
+  where {volume_filter}
+        order by label asc
+"""
+
+# label filter -> condition on volume table
+LABEL_FILTERS = {
+    "vo": "storage_group = any(%(vo)s)",
+    "library": "library = any(%(library)s)",
+    "media_type": "media_type = any(%(media_type)s)",
+    "file_family": "file_family like %(file_family)s",
+    "min_active_files": "active_files >= %(min_active_files)s",
+    "max_active_files": "active_files <= %(max_active_files)s",
+}
+
+LABEL_RANGE = ("(label >= %(label_from_{0})s and "
+               "left(label, length(%(label_to_{0})s)) <= %(label_to_{0})s)")
+
+
+def as_list(value):
+    """
+    Comma separated string or list to list of strings
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(i).strip() for i in value if str(i).strip()]
+
+
+def get_volume_filter(filters, media_types):
+    """
+    Build condition on volume table selecting volumes to migrate
+
+    :param filters: label filters, keys are those of LABEL_FILTERS and
+                    label_ranges - list of "<first>:<last>" label ranges,
+                    <last> is compared with label prefix of same length
+    :type filters: dict
+    :param media_types: Enstore media types to migrate
+    :type media_types: list
+    :return: SQL condition and its parameters
+    :rtype: tuple
+    """
+    conditions = []
+    pars = {"media_types": media_types}
+    for key, value in (filters or {}).items():
+        if value is None or value == [] or value == "":
+            continue
+        if key == "label_ranges":
+            ranges = []
+            for i, label_range in enumerate(as_list(value)):
+                first, sep, last = label_range.partition(":")
+                if not sep or not first or not last:
+                    raise ValueError("Invalid label range %s, expected "
+                                     "<first>:<last>" % (label_range, ))
+                ranges.append(LABEL_RANGE.format(i))
+                pars["label_from_%d" % (i, )] = first.upper()
+                pars["label_to_%d" % (i, )] = last.upper()
+            conditions.append("(%s)" % (" or ".join(ranges), ))
+        elif key not in LABEL_FILTERS:
+            raise ValueError("Unknown label filter %s, expected one of %s" %
+                             (key, ", ".join(sorted(list(LABEL_FILTERS.keys()) +
+                                                    ["label_ranges"]))))
+        elif key in ("vo", "library", "media_type"):
+            conditions.append(LABEL_FILTERS[key])
+            pars[key] = as_list(value)
+        elif key in ("min_active_files", "max_active_files"):
+            conditions.append(LABEL_FILTERS[key])
+            pars[key] = int(value)
+        else:
+            conditions.append(LABEL_FILTERS[key])
+            pars[key] = value
+    condition = VOLUME_FILTER.format(
+        filters="".join(["and %s\n        " % (i, ) for i in conditions]))
+    return condition, pars
+
+
+def like(value, pattern):
+    """
+    SQL LIKE of value and pattern, backslash escapes % and _
+    """
+    regex = ""
+    escaped = False
+    for c in pattern:
+        if escaped:
+            regex += re.escape(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        else:
+            regex += ".*" if c == "%" else "." if c == "_" else re.escape(c)
+    return value is not None and re.match(regex + r"\Z", value,
+                                          re.DOTALL) is not None
+
+
+def get_volume_predicate(filters, media_types):
+    """
+    Build function telling whether a volume row is selected by the
+    condition of get_volume_filter, for volumes that are not read
+    from Enstore DB (snapshot)
+
+    :param filters: label filters, see get_volume_filter
+    :type filters: dict
+    :param media_types: Enstore media types to migrate
+    :type media_types: list
+    :return: function of volume row returning bool
+    :rtype: function
+    """
+    condition, pars = get_volume_filter(filters, media_types)
+    ranges = []
+    while "label_from_%d" % (len(ranges), ) in pars:
+        ranges.append((pars["label_from_%d" % (len(ranges), )],
+                       pars["label_to_%d" % (len(ranges), )]))
+
+    def predicate(volume):
+        if (volume["media_type"] not in pars["media_types"]
+                or volume["system_inhibit_0"] != "none"
+                or like(volume["library"], "shelf%")
+                or like(volume["file_family"], "%_copy_1")
+                or not volume["active_files"] > 0):
+            return False
+        if "vo" in pars and volume["storage_group"] not in pars["vo"]:
+            return False
+        if "library" in pars and volume["library"] not in pars["library"]:
+            return False
+        if ("media_type" in pars and
+                volume["media_type"] not in pars["media_type"]):
+            return False
+        if ("file_family" in pars and
+                not like(volume["file_family"], pars["file_family"])):
+            return False
+        if ("min_active_files" in pars and
+                volume["active_files"] < pars["min_active_files"]):
+            return False
+        if ("max_active_files" in pars and
+                volume["active_files"] > pars["max_active_files"]):
+            return False
+        if ranges and not [first for first, last in ranges
+                           if volume["label"] >= first and
+                           volume["label"][:len(last)] <= last]:
+            return False
+        return True
+    return predicate
+
+
+def get_label_query(filters, media_types):
+    """
+    Build query selecting labels of volumes to migrate
+
+    :param filters: label filters, see get_volume_filter
+    :type filters: dict
+    :param media_types: Enstore media types to migrate
+    :type media_types: list
+    :return: SQL and its parameters
+    :rtype: tuple
+    """
+    condition, pars = get_volume_filter(filters, media_types)
+    return SELECT_ALL_ENSTORE_VOLUMES.format(volume_filter=condition), pars
+
+
+def get_labels(enstore_db, media_types, filters=None, snapshot=None):
+    """
+    Labels of volumes to migrate, narrowed by label filters
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param media_types: Enstore media types to migrate
+    :type media_types: list
+    :param filters: label filters, see get_label_query
+    :type filters: dict
+    :param snapshot: select among volumes of snapshot instead
+    :type snapshot: snapshot.Snapshot
+    :return: labels sorted
+    :rtype: list
+    """
+    if snapshot:
+        predicate = get_volume_predicate(filters, media_types)
+        return [volume["label"] for volume in snapshot.get_volumes()
+                if predicate(volume)]
+    sql, pars = get_label_query(filters, media_types)
+    cursor = None
+    try:
+        cursor = enstore_db.cursor()
+        cursor.execute(sql, pars)
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
+SELECT_ENSTORE_FILES_FOR_VOLUME = """
+select f.*,
+       v.storage_group||'.'||v.file_family||'@cta' as storage_class,
+       v.wrapper
+from file f inner join volume v
+  on v.id = f.volume
+  where
+        v.media_type = any(%(media_types)s)
+        and v.system_inhibit_0 = 'none'
+        and v.label = %(label)s
+        and v.active_files > 0
+        and f.deleted = 'n'
+        order by f.location_cookie
+"""
+
+SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY = """
+select f.*,
+       v.storage_group||'.'||v.file_family||'@cta' as storage_class,
+       v.wrapper as original_wrapper,
+       f1.bfid as copy_bfid,
+       f1.location_cookie as copy_location_cookie,
+       f1.deleted as copy_deleted,
+       v1.*
+from file f
+inner join volume v on v.id = f.volume
+left outer join file_copies_map fcm on fcm.bfid = f.bfid
+left outer join file f1 on f1.bfid = fcm.alt_bfid
+left outer join volume v1 on v1.id = f1.volume
+  where
+        v.media_type = any(%(media_types)s)
+        and v.system_inhibit_0 = 'none'
+        and v.label = %(label)s
+        and v.active_files > 0
+        and (f1.deleted is null or f1.deleted = 'n')
+        and f.deleted = 'n'
+        order by f.pnfs_id
+"""
+
+INSERT_DISK_INSTANCE = """
+insert into disk_instance (
+  disk_instance_name,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time
+) values (
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s
+)
+"""
+
+INSERT_STORAGE_CLASS = """
+insert into storage_class (
+  storage_class_id,
+  storage_class_name,
+  nb_copies,
+  virtual_organization_id,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time
+) values (
+  (select nextval('storage_class_id_seq')),
+  %s,
+  %s,
+  (select virtual_organization_id from virtual_organization where virtual_organization_name = %s),
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s
+)
+"""
+
+def insert_storage_class(cta_db, storage_class, vo, number_of_copies=1):
+    try:
+        insert(cta_db,
+               INSERT_STORAGE_CLASS,
+               (storage_class+"@cta",
+                number_of_copies,
+                vo,
+                "Imported from Enstore",
+                getpass.getuser(),
+                HOSTNAME,
+                int(time.time()),
+                getpass.getuser(),
+                HOSTNAME,
+                int(time.time())))
+    except psycopg2.IntegrityError:
+        print_message(f"Storage class {storage_class} already exists")
+
+
+#
+# Bootstrap of CTA objects (VOs, logical libraries, storage classes,
+# tape pools, archive routes). Everything needed is derived from a single
+# Enstore query, compared with what already exists in CTA (single query)
+# and missing objects are created with one statement per object type
+# in one transaction.
+#
+
+SELECT_ENSTORE_COMBINATIONS = """
+select distinct storage_group, file_family, library, media_type
+from volume
+  where active_files>0
+        and system_inhibit_0 = 'none'
+        and library not like 'shelf%'
+"""
+
+SELECT_CTA_OBJECTS = """
+select 'media_type' as kind, media_type_name as name from media_type
+union all
+select 'disk_instance', disk_instance_name from disk_instance
+union all
+select 'virtual_organization', virtual_organization_name from virtual_organization
+union all
+select 'logical_library', logical_library_name from logical_library
+union all
+select 'storage_class', storage_class_name from storage_class
+union all
+select 'tape_pool', tape_pool_name from tape_pool
+union all
+select 'archive_route', sc.storage_class_name||':'||ar.copy_nb
+from archive_route ar
+  inner join storage_class sc on sc.storage_class_id = ar.storage_class_id
+"""
+
+BOOTSTRAP_VOS = """
+insert into virtual_organization (
+  virtual_organization_id,
+  virtual_organization_name,
+  read_max_drives,
+  write_max_drives,
+  max_file_size,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time,
+  disk_instance_name
+) select
+  nextval('virtual_organization_id_seq'),
+  v.name,
+  2, --FIXME read_max_drives
+  2, --FIXME write_max_drives
+  %(max_file_size)s,
+  'Imported from Enstore',
+  %(user)s,
+  %(host)s,
+  %(time)s,
+  %(user)s,
+  %(host)s,
+  %(time)s,
+  %(disk_instance_name)s
+from unnest(%(names)s::varchar[]) as v(name)
+"""
+
+BOOTSTRAP_LOGICAL_LIBRARIES = """
+insert into logical_library (
+  logical_library_id,
+  logical_library_name,
+  is_disabled,
+  disabled_reason,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time
+) select
+  nextval('logical_library_id_seq'),
+  v.name,
+  '0',
+  null,
+  'Imported from Enstore '||v.name,
+  %(user)s,
+  %(host)s,
+  %(time)s,
+  %(user)s,
+  %(host)s,
+  %(time)s
+from unnest(%(names)s::varchar[]) as v(name)
+"""
+
+BOOTSTRAP_STORAGE_CLASSES = """
+insert into storage_class (
+  storage_class_id,
+  storage_class_name,
+  nb_copies,
+  virtual_organization_id,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time
+) select
+  nextval('storage_class_id_seq'),
+  v.name,
+  v.nb_copies,
+  vo.virtual_organization_id,
+  'Imported from Enstore',
+  %(user)s,
+  %(host)s,
+  %(time)s,
+  %(user)s,
+  %(host)s,
+  %(time)s
+from unnest(%(names)s::varchar[],
+            %(copies)s::integer[],
+            %(vos)s::varchar[]) as v(name, nb_copies, vo)
+  inner join virtual_organization vo on vo.virtual_organization_name = v.vo
+"""
+
+BOOTSTRAP_TAPE_POOLS = """
+insert into tape_pool (
+  tape_pool_id,
+  tape_pool_name,
+  virtual_organization_id,
+  nb_partial_tapes,
+  is_encrypted,
+  supply,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time,
+  encryption_key_name
+) select
+  nextval('tape_pool_id_seq'),
+  v.name,
+  vo.virtual_organization_id,
+  0,
+  '0',
+  null,
+  v.comment,
+  %(user)s,
+  %(host)s,
+  %(time)s,
+  %(user)s,
+  %(host)s,
+  %(time)s,
+  null
+from unnest(%(names)s::varchar[],
+            %(vos)s::varchar[],
+            %(comments)s::varchar[]) as v(name, vo, comment)
+  inner join virtual_organization vo on vo.virtual_organization_name = v.vo
+"""
+
+BOOTSTRAP_ARCHIVE_ROUTES = """
+insert into archive_route (
+  storage_class_id,
+  copy_nb,
+  tape_pool_id,
+  user_comment,
+  creation_log_user_name,
+  creation_log_host_name,
+  creation_log_time,
+  last_update_user_name,
+  last_update_host_name,
+  last_update_time
+) select
+  sc.storage_class_id,
+  v.copy_nb,
+  tp.tape_pool_id,
+  v.comment,
+  %(user)s,
+  %(host)s,
+  %(time)s,
+  %(user)s,
+  %(host)s,
+  %(time)s
+from unnest(%(storage_classes)s::varchar[],
+            %(copies)s::integer[],
+            %(pools)s::varchar[],
+            %(comments)s::varchar[]) as v(storage_class, copy_nb, pool, comment)
+  inner join storage_class sc on sc.storage_class_name = v.storage_class
+  inner join tape_pool tp on tp.tape_pool_name = v.pool
+"""
+
+
+#
+# Tape pool naming strategies. Each takes VO, file family (without
+# "_copy_1" suffix) and copy number (1 based) and returns tape pool
+# name and comment
+#
+
+def pool_per_storage_class(vo, file_family, copy_nb):
+    """
+    One tape pool per storage class and copy: <vo>.<file_family>
+    for the first copy, <vo>.<file_family>_copy_<n> for additional copies
+    """
+    storage_class = "%s.%s" % (vo, file_family)
+    if copy_nb == 1:
+        return storage_class, "Pool for %s" % (storage_class,)
+    return ("%s_copy_%d" % (storage_class, copy_nb - 1),
+            "Pool for %s copy %d" % (storage_class, copy_nb - 1))
+
+
+def pool_per_vo(vo, file_family, copy_nb):
+    """
+    One tape pool per VO and copy: "Pool for <vo> copy <n>"
+    """
+    pool = "Pool for %s copy %d" % (vo, copy_nb)
+    return pool, pool
+
+
+TAPE_POOL_NAMING = {
+    "storage_class": pool_per_storage_class,
+    "vo": pool_per_vo,
+}
+
+
+def get_tape_pool_name(config, vo, file_family, copy_nb=1):
+    """
+    Tape pool name according to "tape_pool_naming" configuration
+    (default is pool per storage class). Enstore file families of
+    volumes holding second copies have "_copy_1" suffix
+
+    :return: (tape pool name, comment)
+    :rtype: tuple
+    """
+    if file_family.endswith("_copy_1"):
+        # len("_copy_1") = 7
+        file_family = file_family[:-7]
+        copy_nb = 2
+    naming = TAPE_POOL_NAMING[config.get("tape_pool_naming", "storage_class")]
+    return naming(vo, file_family, copy_nb)
+
+
+def get_volume_tape_pool_name(enstore_volume, config):
+    """
+    Tape pool of Enstore volume, "tape_pool_name" configuration
+    overrides naming strategy
+    """
+    if config.get("tape_pool_name"):
+        return config.get("tape_pool_name")
+    return get_tape_pool_name(config,
+                              enstore_volume["storage_group"],
+                              enstore_volume["file_family"])[0]
+
+
+def get_bootstrap_plan(enstore_db, config, snapshot=None):
+    """
+    Derive CTA objects corresponding to active Enstore volumes
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param config: configuration
+    :type config: dict
+    :param snapshot: use volumes of snapshot instead of Enstore DB
+    :type snapshot: snapshot.Snapshot
+    :return: dictionary object kind -> {name : attributes}
+    :rtype: dict
+    """
+    if snapshot:
+        rows = snapshot.get_combinations()
+    else:
+        rows = select(enstore_db, SELECT_ENSTORE_COMBINATIONS)
+    media_types = config.get("media_type_map") or {}
+
+    vos = set()
+    libraries = set()
+    storage_classes = {}
+    for row in rows:
+        vo, file_family = row["storage_group"], row["file_family"]
+        is_copy = file_family.endswith("_copy_1")
+        if not is_copy:
+            vos.add(vo)
+        if row["media_type"] not in media_types:
+            continue
+        libraries.add(row["library"])
+        if is_copy:
+            # len("_copy_1") = 7
+            storage_classes["%s.%s" % (vo, file_family[:-7])] = 2
+        else:
+            storage_class = "%s.%s" % (vo, file_family)
+            storage_classes.setdefault(storage_class, 1)
+
+    if config.get("library_map"):
+        libraries = set(config.get("library_map").values())
+
+    plan = {
+        "media_type": get_cta_media_types(config),
+        "disk_instance": {config.get("disk_instance_name"): None},
+        "virtual_organization": {},
+        "logical_library": dict((library, None) for library in libraries),
+        "storage_class": {},
+        "tape_pool": {},
+        "archive_route": {},
+    }
+    for storage_class, number_of_copies in storage_classes.items():
+        vo, file_family = storage_class.split(".", 1)
+        vos.add(vo)
+        plan["storage_class"][storage_class + "@cta"] = (number_of_copies, vo)
+        for copy_nb in range(1, number_of_copies + 1):
+            tape_pool_name, user_comment = get_tape_pool_name(config,
+                                                              vo,
+                                                              file_family,
+                                                              copy_nb)
+            plan["tape_pool"][tape_pool_name] = (vo, user_comment)
+            plan["archive_route"]["%s@cta:%d" % (storage_class, copy_nb)] = (
+                storage_class + "@cta",
+                copy_nb,
+                tape_pool_name,
+                "Archive route for tape pool %s, %d" % (storage_class, copy_nb))
+    plan["virtual_organization"] = dict((vo, None) for vo in vos)
+    return plan
+
+
+def get_cta_objects(cta_db):
+    """
+    Names of existing CTA objects
+
+    :param cta_db: cta database connection
+    :type cta_db: Connection
+    :return: dictionary object kind -> set of names
+    :rtype: dict
+    """
+    objects = {}
+    for row in select(cta_db, SELECT_CTA_OBJECTS):
+        objects.setdefault(row["kind"], set()).add(row["name"])
+    return objects
+
+
+def bootstrap_cta(enstore_db, cta_db, config, snapshot=None):
+    """
+    Create CTA objects corresponding to active Enstore volumes that do
+    not yet exist in CTA. All objects are created in one transaction
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param cta_db: cta database connection
+    :type cta_db: Connection
+    :param config: configuration
+    :type config: dict
+    :param snapshot: use volumes of snapshot instead of Enstore DB
+    :type snapshot: snapshot.Snapshot
+    :return: dictionary object kind -> number of objects created
+    :rtype: dict
+    """
+    plan = get_bootstrap_plan(enstore_db, config, snapshot)
+    existing = get_cta_objects(cta_db)
+    missing = dict((kind, dict((name, value) for name, value in objects.items()
+                               if name not in existing.get(kind, ())))
+                   for kind, objects in plan.items())
+
+    now = int(time.time())
+    user = getpass.getuser()
+    pars = {"user": user,
+            "host": HOSTNAME,
+            "time": now}
+    created = {}
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        for value in missing["media_type"].values():
+            cursor.execute(INSERT_MEDIA_TYPES,
+                           (value["media_type_name"],
+                            value["cartridge"],
+                            value["capacity_in_bytes"],
+                            value["primary_density_code"],
+                            value["secondary_density_code"],
+                            value["nb_wraps"],
+                            value["min_lpos"],
+                            value["max_lpos"],
+                            value["user_comment"],
+                            user,
+                            HOSTNAME,
+                            now,
+                            user,
+                            HOSTNAME,
+                            now))
+        created["media_type"] = len(missing["media_type"])
+
+        for disk_instance_name in missing["disk_instance"]:
+            cursor.execute(INSERT_DISK_INSTANCE,
+                           (disk_instance_name,
+                            disk_instance_name,
+                            user,
+                            HOSTNAME,
+                            now,
+                            user,
+                            HOSTNAME,
+                            now))
+        created["disk_instance"] = len(missing["disk_instance"])
+
+        vos = missing["virtual_organization"]
+        storage_classes = missing["storage_class"]
+        tape_pools = missing["tape_pool"]
+        archive_routes = missing["archive_route"]
+        statements = (
+            ("virtual_organization", BOOTSTRAP_VOS,
+             {"names": list(vos.keys()),
+              "max_file_size": 10*(1<<40), # 10 TB
+              "disk_instance_name": config.get("disk_instance_name")}),
+            ("logical_library", BOOTSTRAP_LOGICAL_LIBRARIES,
+             {"names": list(missing["logical_library"].keys())}),
+            ("storage_class", BOOTSTRAP_STORAGE_CLASSES,
+             {"names": list(storage_classes.keys()),
+              "copies": [v[0] for v in storage_classes.values()],
+              "vos": [v[1] for v in storage_classes.values()]}),
+            ("tape_pool", BOOTSTRAP_TAPE_POOLS,
+             {"names": list(tape_pools.keys()),
+              "vos": [v[0] for v in tape_pools.values()],
+              "comments": [v[1] for v in tape_pools.values()]}),
+            ("archive_route", BOOTSTRAP_ARCHIVE_ROUTES,
+             {"storage_classes": [v[0] for v in archive_routes.values()],
+              "copies": [v[1] for v in archive_routes.values()],
+              "pools": [v[2] for v in archive_routes.values()],
+              "comments": [v[3] for v in archive_routes.values()]}),
+        )
+        for kind, sql, statement_pars in statements:
+            created[kind] = 0
+            if missing[kind]:
+                statement_pars.update(pars)
+                cursor.execute(sql, statement_pars)
+                created[kind] = cursor.rowcount
+        cta_db.commit()
+    except Exception:
+        cta_db.rollback()
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    for kind in plan:
+        print_message("%s: %d needed, %d existed, %d created" %
+                      (kind, len(plan[kind]),
+                       len(plan[kind]) - len(missing[kind]),
+                       created[kind]))
+    return created
+
+
+INSERT_ARCHIVE_FILE = """
+insert into archive_file (
+  archive_file_id,
+  disk_instance_name,
+  disk_file_id,
+  disk_file_uid,
+  disk_file_gid,
+  size_in_bytes,
+  checksum_blob,
+  checksum_adler32,
+  storage_class_id,
+  creation_time,
+  reconciliation_time,
+  is_deleted,
+  collocation_hint
+) values (
+  (select nextval ('archive_file_id_seq')),
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  null,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  null
+)
+"""
+
+INSERT_TAPE_FILE = """
+insert into tape_file (
+  vid,
+  fseq,
+  block_id,
+  logical_size_in_bytes,
+  copy_nb,
+  creation_time,
+  archive_file_id
+) values (
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s
+)
+"""
+
+#
+# multi row variants of INSERT_ARCHIVE_FILE and INSERT_TAPE_FILE
+# for psycopg2.extras.execute_values
+#
+INSERT_ARCHIVE_FILES = """
+insert into archive_file (
+  archive_file_id,
+  disk_instance_name,
+  disk_file_id,
+  disk_file_uid,
+  disk_file_gid,
+  size_in_bytes,
+  checksum_blob,
+  checksum_adler32,
+  storage_class_id,
+  creation_time,
+  reconciliation_time,
+  is_deleted,
+  collocation_hint
+) values %s
+returning disk_file_id, archive_file_id
+"""
+
+#
+# archive_file_ids allocated beforehand for a volume
+#
+SELECT_ARCHIVE_FILE_IDS = """
+select nextval('archive_file_id_seq') as archive_file_id
+from generate_series(1, %s)
+"""
+
+ARCHIVE_FILE_TEMPLATE = """(
+  nextval('archive_file_id_seq'),
+  %s, %s, %s, %s, %s, null, %s, %s, %s, %s, %s, null
+)"""
+
+INSERT_TAPE_FILES = """
+insert into tape_file (
+  vid,
+  fseq,
+  block_id,
+  logical_size_in_bytes,
+  copy_nb,
+  creation_time,
+  archive_file_id
+) values %s
+"""
+
+
+def enstore_checksum(enstore_file):
+    """
+    Adler32 of Enstore file as stored in CTA
+    """
+    file_create_time = int(enstore_file["bfid"][4:14])
+    file_crc = enstore_file["crc"]
+    #
+    # take care of "adler32 seeed 0" nonsense
+    #
+    if file_create_time < get_switch_epoch() and HOSTNAME.endswith(".fnal.gov"):
+        file_crc =  convert_0_adler32_to_1_adler32(file_crc, enstore_file["size"])
+    return file_crc
+
+
+def archive_file_values(enstore_file, config, dimensions):
+    """
+    Values of INSERT_ARCHIVE_FILE for Enstore file, except archive_file_id
+
+    :return: tuple of values
+    :rtype: tuple
+    """
+    file_create_time = int(enstore_file["bfid"][4:14])
+    file_size = enstore_file["size"]
+    file_crc = enstore_checksum(enstore_file)
+
+    # CTA does not allow to write UID=0 (root owned) files
+    # Files in Enstore may be owned by root
+    # When re-packing tapes, UID=0 becomes an issue
+    # To avoid that, change UID (and GID) to 1
+    # NB: when dCache writes files to CTA, it passes 1:1
+    # as UID:GID because UID:GID is not available to cta-driver
+    # this may change in the future
+
+    uid = enstore_file["uid"] if enstore_file["uid"] > 0 else 1
+    gid = enstore_file["gid"] if enstore_file["gid"] > 0 else 1
+
+    return (dimensions.get("disk_instance",
+                           config.get("disk_instance_name")),
+            enstore_file["pnfs_id"],
+            uid,
+            gid,
+            file_size,
+            file_crc,
+            dimensions.get("storage_class",
+                           enstore_file["storage_class"]),
+            file_create_time,
+            int(time.time()),
+            '0')
+
+
+def tape_file_values(enstore_file, cta_label, archive_file_id):
+    """
+    Values of INSERT_TAPE_FILE for the primary copy of Enstore file
+
+    :return: tuple of values
+    :rtype: tuple
+    """
+    fseq = extract_file_number(enstore_file["location_cookie"],
+                               enstore_file["original_wrapper"])
+    return (cta_label,
+            fseq,
+            fseq,
+            enstore_file["size"],
+            1,
+            int(enstore_file["bfid"][4:14]),
+            archive_file_id)
+
+
+def tape_file_copy_values(enstore_file, archive_file_id):
+    """
+    Values of INSERT_TAPE_FILE for the copy of Enstore file
+
+    :return: tuple of values
+    :rtype: tuple
+    """
+    fseq = extract_file_number(enstore_file["copy_location_cookie"],
+                               enstore_file["wrapper"])
+    return (enstore_file["label"][:6],
+            fseq,
+            fseq,
+            enstore_file["size"],
+            2, # copy number
+            int(enstore_file["copy_bfid"][4:14]),
+            archive_file_id)
+
+
+def insert_cta_file(connection, enstore_file, cta_label, config, dimensions):
+    cta_file = insert_returning(connection,
+                                INSERT_ARCHIVE_FILE,
+                                archive_file_values(enstore_file,
+                                                    config,
+                                                    dimensions))
+    archive_file_id = int(cta_file["archive_file_id"])
+    insert(connection,
+           INSERT_TAPE_FILE,
+           tape_file_values(enstore_file, cta_label, archive_file_id))
+    return archive_file_id
+
+def insert_cta_tape_file_copy(connection,
+                              archive_file_id,
+                              enstore_file,
+                              config):
+    insert(connection,
+           INSERT_TAPE_FILE,
+           tape_file_copy_values(enstore_file, archive_file_id))
+
+INSERT_CTA_TAPE = """
+insert into tape (
+   vid,  media_type_id, vendor, logical_library_id, tape_pool_id,
+   encryption_key_name, data_in_bytes, last_fseq, nb_master_files,
+   master_data_in_bytes, is_full, is_from_castor, dirty,
+   nb_copy_nb_1, copy_nb_1_in_bytes,  nb_copy_nb_gt_1,
+   copy_nb_gt_1_in_bytes, label_format, label_drive, label_time,
+   last_read_drive, last_read_time, last_write_drive, last_write_time,
+   read_mount_count, write_mount_count, user_comment,
+   tape_state, state_reason, state_update_time, state_modified_by,
+   creation_log_user_name, creation_log_host_name, creation_log_time,
+   last_update_user_name, last_update_host_name, last_update_time,
+   verification_status)
+   values (%s,
+           %s,
+           'Unknown',
+           %s,
+           %s,
+           '',
+           %s,
+           %s,
+           %s,
+           %s,
+           '1',
+           '0',
+           '0',
+           %s,
+           %s,
+           0,
+           0,
+           %s,
+           'Enstore',
+           %s,
+           '',
+           %s,
+           'Enstore',
+           %s,
+           %s,
+           %s,
+           %s,
+           'ACTIVE',
+           'Migrated from Enstore',
+           %s,
+           %s,
+           %s,
+           %s,
+           %s,
+           %s,
+           %s,
+           %s,
+           ''
+   )
+"""
+
+# label_format is just before 'Enstore' above
+
+
+SELECT_CTA_DIMENSIONS = """
+select 'storage_class' as kind, storage_class_name as name, storage_class_id as id
+from storage_class
+union all
+select 'tape_pool', tape_pool_name, tape_pool_id from tape_pool
+union all
+select 'media_type', media_type_name, media_type_id from media_type
+union all
+select 'logical_library', logical_library_name, logical_library_id from logical_library
+union all
+select 'disk_instance', disk_instance_name, null from disk_instance
+"""
+
+
+class CtaDimensions(object):
+    """
+    Maps names of CTA storage classes, tape pools, media types and
+    logical libraries to their ids. Loaded once per process so that
+    inserts into archive_file and tape carry literal ids instead of
+    sub-selects. Disk instances map to their names.
+    """
+    def __init__(self, cta_db):
+        self.ids = {}
+        for row in select(cta_db, SELECT_CTA_DIMENSIONS):
+            self.ids.setdefault(row["kind"], {})[row["name"]] = (
+                row["name"] if row["kind"] == "disk_instance" else row["id"])
+
+    def get(self, kind, name):
+        """
+        Get id of CTA object, raises KeyError if it does not exist
+
+        :param kind: object kind, e.g. "storage_class"
+        :type kind: str
+        :param name: object name
+        :type name: str
+        :return: object id
+        :rtype: int
+        """
+        try:
+            return self.ids[kind][name]
+        except KeyError:
+            raise KeyError("%s %s does not exist in CTA" % (kind, name))
+
+
+def cta_tape_values(enstore_volume, config, dimensions):
+    """
+    Values of INSERT_CTA_TAPE for Enstore volume
+
+    :return: tuple of values
+    :rtype: tuple
+    """
+    logical_library_name = enstore_volume["library"]
+    tape_pool_name = get_volume_tape_pool_name(enstore_volume, config)
+
+    if config.get("library_map"):
+        try:
+            logical_library_name = config.get("library_map")[logical_library_name]
+        except KeyError:
+            raise KeyError("mapping for library %s does not exist" %
+                           (logical_library_name, ))
+
+    label_format = "2"
+    if enstore_volume["wrapper"] == "cern":
+        label_format = "3"
+
+    return (enstore_volume["label"][:6],
+            dimensions.get("media_type",
+                           config.get("media_type_map")[enstore_volume["media_type"]]),
+            dimensions.get("logical_library", logical_library_name),
+            dimensions.get("tape_pool", tape_pool_name),
+            enstore_volume["active_bytes"],
+            #extract_file_number(enstore_volume["eod_cookie"]) - 1,
+            extract_eod(enstore_volume),
+            enstore_volume["active_files"],
+            enstore_volume["active_bytes"],
+            enstore_volume["active_files"],
+            enstore_volume["active_bytes"],
+            label_format,
+            int(time.mktime(enstore_volume["declared"].timetuple())),
+            int(time.mktime(enstore_volume["last_access"].timetuple())),
+            int(time.mktime(enstore_volume["last_access"].timetuple())),
+            min(enstore_volume["sum_rd_access"], enstore_volume["sum_mounts"]),
+            min(enstore_volume["sum_wr_access"], enstore_volume["sum_mounts"]),
+            ("Migrated from Enstore: %s" % (enstore_volume["comment"],))[:1000],
+            int(time.time()),
+            getpass.getuser(),
+            getpass.getuser(),
+            HOSTNAME,
+            int(time.time()),
+            getpass.getuser(),
+            HOSTNAME,
+            int(time.time()))
+
+
+def check_dimensions(enstore_volume, config, dimensions):
+    """
+    Check that the CTA disk instance and storage class of the files of
+    Enstore volume exist, so that a label fails once before its tape
+    is inserted rather than once per file. Raises KeyError if not
+    """
+    dimensions.get("disk_instance", config.get("disk_instance_name"))
+    dimensions.get("storage_class",
+                   "%s.%s@cta" % (enstore_volume["storage_group"],
+                                  enstore_volume["file_family"]))
+
+
+def insert_cta_tape(connection, enstore_volume, config, dimensions):
+    res = insert(connection,
+                 INSERT_CTA_TAPE,
+                 cta_tape_values(enstore_volume, config, dimensions))
+    return res
+
+
+SELECT_VOLUMES_FOR_PLAN = """
+select label, storage_group, file_family, library, media_type,
+       active_files, active_bytes
+from volume
+  where label = any(%s)
+"""
+
+
+def preflight(enstore_db, cta_db, labels, config, expected=None,
+              snapshot=None):
+    """
+    Check all volumes to be migrated against library_map, media_type_map
+    and existing CTA media types, logical libraries, tape pools and
+    storage classes. Print migration plan: number of labels, files and
+    bytes per VO, tape pool and library
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param cta_db: cta database connection
+    :type cta_db: Connection
+    :param labels: labels to be migrated
+    :type labels: list
+    :param config: configuration
+    :type config: dict
+    :param expected: CTA objects that do not exist yet but are going to
+                     be created by bootstrap (as returned by get_bootstrap_plan)
+    :type expected: dict
+    :param snapshot: read volumes from snapshot instead of Enstore DB
+    :type snapshot: snapshot.Snapshot
+    :return: list of problems found, empty if all volumes can be migrated
+    :rtype: list
+    """
+    if snapshot:
+        volumes = [volume for volume in [snapshot.get_volume(label)
+                                         for label in labels] if volume]
+    else:
+        volumes = select(enstore_db, SELECT_VOLUMES_FOR_PLAN, (labels, ))
+    existing = get_cta_objects(cta_db)
+    if expected:
+        for kind, objects in expected.items():
+            existing.setdefault(kind, set()).update(objects)
+
+    problems = []
+    missing_labels = set(labels) - set(v["label"] for v in volumes)
+    for label in sorted(missing_labels):
+        problems.append("%s: no such volume in Enstore" % (label, ))
+
+    library_map = config.get("library_map")
+    media_types = config.get("media_type_map", {})
+    plan = {}
+    for volume in volumes:
+        label = volume["label"]
+        vo = volume["storage_group"]
+        file_family = volume["file_family"]
+        library = volume["library"]
+        if library_map:
+            library = library_map.get(library)
+            if not library:
+                problems.append("%s: no library_map entry for library %s" %
+                                (label, volume["library"]))
+        if library and library not in existing.get("logical_library", ()):
+            problems.append("%s: logical library %s does not exist in CTA" %
+                            (label, library))
+
+        media_type = media_types.get(volume["media_type"])
+        if not media_type:
+            problems.append("%s: no media_type_map entry for media type %s" %
+                            (label, volume["media_type"]))
+        elif media_type not in existing.get("media_type", ()):
+            problems.append("%s: media type %s does not exist in CTA" %
+                            (label, media_type))
+
+        tape_pool_name = get_volume_tape_pool_name(volume, config)
+        if tape_pool_name not in existing.get("tape_pool", ()):
+            problems.append("%s: tape pool %s does not exist in CTA" %
+                            (label, tape_pool_name))
+
+        storage_class = "%s.%s@cta" % (vo, file_family,)
+        if storage_class not in existing.get("storage_class", ()):
+            problems.append("%s: storage class %s does not exist in CTA" %
+                            (label, storage_class))
+
+        key = (vo, tape_pool_name, library or volume["library"])
+        entry = plan.setdefault(key, [0, 0, 0])
+        entry[0] += 1
+        entry[1] += volume["active_files"]
+        entry[2] += volume["active_bytes"]
+
+    print_message("%-16s %-40s %-16s %8s %12s %18s" %
+                  ("VO", "TAPE POOL", "LIBRARY", "LABELS", "FILES", "BYTES"))
+    totals = [0, 0, 0]
+    for key in sorted(plan):
+        entry = plan[key]
+        print_message("%-16s %-40s %-16s %8d %12d %18d" % (key + tuple(entry)))
+        totals = [i + j for i, j in zip(totals, entry)]
+    print_message("%-16s %-40s %-16s %8d %12d %18d" %
+                  (("TOTAL", "", "") + tuple(totals)))
+
+    for problem in problems:
+        print_error(problem)
+    return problems
+
+
+#
+# existing locations and files missing in chimera are skipped
+#
+INSERT_CHIMERA_LOCATION = """
+insert into t_locationinfo (inumber, itype, ipriority, ictime, iatime, istate, ilocation)
+   select inumber,
+   0,
+   10,
+   now(),
+   now(),
+   1,
+   %s
+   from t_inodes where ipnfsid = %s
+   on conflict do nothing
+"""
+
+INSERT_CHIMERA_LOCATIONS = """
+insert into t_locationinfo (inumber, itype, ipriority, ictime, iatime, istate, ilocation)
+   select i.inumber,
+   0,
+   10,
+   now(),
+   now(),
+   1,
+   l.location
+   from (values %s) as l(location, pnfsid)
+   inner join t_inodes i on i.ipnfsid = l.pnfsid
+   on conflict do nothing
+"""
+
+def insert_chimera_location(connection, enstore_file, location):
+    """
+    Insert CTA location of a file into chimera. Returns
+    number of rows inserted, 0 if location already exists
+    or file does not exist in chimera
+    """
+    res = insert(connection,
+                 INSERT_CHIMERA_LOCATION,
+                 (location,
+                  enstore_file["pnfs_id"],))
+    return res
+
+
+UPDATE_COPY_COUNTS = """
+update tape
+   set nb_copy_nb_1 = t.nb_copy_nb_1,
+       copy_nb_1_in_bytes = t.copy_nb_1_in_bytes,
+       nb_copy_nb_gt_1 = t.nb_copy_nb_gt_1,
+       copy_nb_gt_1_in_bytes = t.copy_nb_gt_1_in_bytes
+from
+   (select tf.vid as vid,
+      sum(case when tf.copy_nb > 1 then af.size_in_bytes else 0 end) as copy_nb_gt_1_in_bytes,
+      sum(case when tf.copy_nb = 1 then af.size_in_bytes else 0 end) as copy_nb_1_in_bytes,
+      sum(case when tf.copy_nb > 1 then 1 else 0 end) as nb_copy_nb_gt_1,
+      sum(case when tf.copy_nb = 1 then 1 else 0 end) as nb_copy_nb_1
+    from archive_file af
+       inner join tape_file tf on tf.archive_file_id = af.archive_file_id
+    group by tf.vid) as t
+    where t.vid = tape.vid
+"""
+
+def update_cta_copy_counts(cta_db):
+    res = update(cta_db, UPDATE_COPY_COUNTS)
+    return res
+
+
+def label_result(label, status, files=0, message=None):
+    """
+    Structured outcome of migrating a single Enstore volume
+
+    :param label: Enstore volume label
+    :type label: str
+
+    :param status: one of done, exists, failed, not_processed
+    :type status: str
+
+    :param files: number of files on the volume
+    :type files: int
+
+    :param message: reason of failure if any
+    :type message: str
+
+    :return: result
+    :rtype: dict
+    """
+    return {"label": label,
+            "status": status,
+            "files": files,
+            "errors": 0,
+            "locations_inserted": 0,
+            "locations_skipped": 0,
+            "duplicates": 0,
+            "message": message,
+            "seconds": 0.}
+
+
+def skip_duplicates(files, label, config, result=None):
+    """
+    Drop files which pnfsid is on another active primary volume and
+    that the duplicate policy does not migrate, see
+    duplicates.resolve_duplicates
+
+    :param files: Enstore files of label
+    :type files: list
+    :param label: Enstore volume label
+    :type label: str
+    :param config: migration configuration, skip_bfids holds the bfids
+    :type config: dict
+    :param result: counts dropped files in duplicates if given
+    :type result: dict
+    :return: files to migrate
+    :rtype: list
+    """
+    skip_bfids = config.get("skip_bfids")
+    if not skip_bfids:
+        return files
+    kept = [f for f in files if f["bfid"] not in skip_bfids]
+    if len(kept) < len(files):
+        print_message("%s skipping %d files with duplicate pnfsid" %
+                      (label, len(files) - len(kept)))
+        if result is not None:
+            result["duplicates"] = len(files) - len(kept)
+    return kept
+
+
+def insert_files(cta_db, chimera_db, label, files, config,
+                 added_copy_volumes, dimensions, result):
+    """
+    Insert Enstore files of a volume into CTA and their locations into
+    chimera one file at a time. Files that fail are skipped and counted
+    in result["errors"]
+    """
+    cta_label = label[:6]
+    for f in files:
+        try:
+            archive_file_id = insert_cta_file(cta_db,
+                                              f,
+                                              cta_label,
+                                              config,
+                                              dimensions)
+            #
+            # do we have a copy
+            #
+            copy_label = f.get("label")
+            if copy_label:
+                if copy_label not in added_copy_volumes:
+                    added_copy_volumes.add(copy_label)
+                    try:
+                        insert_cta_tape(cta_db, f, config, dimensions)
+                        print_message("%s added label containing "
+                                      "copies  %s" % (label,
+                                                      copy_label,))
+                    except psycopg2.IntegrityError:
+                        pass
+                    except KeyError as e:
+                        result["errors"] += 1
+                        print_error("%s failed to insert label containing "
+                                    "copies %s, %s" % (label,
+                                                       copy_label,
+                                                       e.args[0],))
+                try:
+                    if f["copy_deleted"] == "n":
+                        insert_cta_tape_file_copy(cta_db,
+                                                  archive_file_id,
+                                                  f,
+                                                  config)
+                except Exception as e:
+                    result["errors"] += 1
+                    print_error("%s Failed to insert tape_file, %s"
+                                " %s %s %s, skipping %s" %
+                                (label,
+                                 f["label"],
+                                 f["pnfs_id"],
+                                 f["bfid"],
+                                 f["copy_bfid"],
+                                 str(e)))
+                    pass
+
+            if not config["skip_locations"]:
+
+                location = "cta://cta/%s?archiveid=%d" % (f["pnfs_id"],
+                                                          archive_file_id,)
+                try:
+                    if insert_chimera_location(chimera_db, f, location):
+                        result["locations_inserted"] += 1
+                    else:
+                        result["locations_skipped"] += 1
+                except Exception as e:
+                    result["errors"] += 1
+                    print_error("%s %s failed to insert location into chimera DB %s, %s" %
+                                (label, f["pnfs_id"], location, str(e),))
+                    pass
+
+        except psycopg2.IntegrityError:
+        #except Exception as e:
+            result["errors"] += 1
+            print_error("%s, failed to insert archive_file, multiple pnfsid, skipping %s" %
+                        (label, f["pnfs_id"], ))
+            continue
+        except KeyError as e:
+            result["errors"] += 1
+            print_error("%s, failed to insert archive_file %s, %s" %
+                        (label, f["pnfs_id"], e.args[0], ))
+            continue
+
+
+def insert_copy_tapes(cta_db, label, files, config, added_copy_volumes,
+                      dimensions, result):
+    """
+    Insert tapes holding copies of files that are not inserted yet
+    """
+    for f in files:
+        copy_label = f.get("label")
+        if not copy_label or copy_label in added_copy_volumes:
+            continue
+        added_copy_volumes.add(copy_label)
+        try:
+            insert_cta_tape(cta_db, f, config, dimensions)
+            print_message("%s added label containing "
+                          "copies  %s" % (label, copy_label,))
+        except psycopg2.IntegrityError:
+            pass
+        except KeyError as e:
+            result["errors"] += 1
+            print_error("%s failed to insert label containing "
+                        "copies %s, %s" % (label, copy_label, e.args[0],))
+
+
+def insert_files_batch(cta_db, chimera_db, label, files, config,
+                       added_copy_volumes, dimensions, result):
+    """
+    Insert Enstore files of a volume into CTA with a few multi row
+    statements in one transaction, archive_file_ids come back from
+    RETURNING. Raises on any failure, in which case nothing is
+    written to CTA and the caller falls back to insert_files
+    """
+    cta_label = label[:6]
+    insert_copy_tapes(cta_db, label, files, config, added_copy_volumes,
+                      dimensions, result)
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        rows = psycopg2.extras.execute_values(
+            cursor,
+            INSERT_ARCHIVE_FILES,
+            [archive_file_values(f, config, dimensions) for f in files],
+            template=ARCHIVE_FILE_TEMPLATE,
+            page_size=len(files),
+            fetch=True)
+        ids = dict(rows)
+        tape_files = [tape_file_values(f, cta_label, ids[f["pnfs_id"]])
+                      for f in files]
+        tape_files += [tape_file_copy_values(f, ids[f["pnfs_id"]])
+                       for f in files
+                       if f.get("label") and f["copy_deleted"] == "n"]
+        psycopg2.extras.execute_values(cursor,
+                                       INSERT_TAPE_FILES,
+                                       tape_files,
+                                       page_size=len(tape_files))
+        cta_db.commit()
+    except Exception:
+        cta_db.rollback()
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    if config["skip_locations"]:
+        return
+    locations = [("cta://cta/%s?archiveid=%d" % (f["pnfs_id"],
+                                                 ids[f["pnfs_id"]]),
+                  f["pnfs_id"])
+                 for f in files]
+    cursor = None
+    try:
+        cursor = chimera_db.cursor()
+        psycopg2.extras.execute_values(cursor,
+                                       INSERT_CHIMERA_LOCATIONS,
+                                       locations,
+                                       page_size=len(locations))
+        inserted = cursor.rowcount
+        chimera_db.commit()
+        result["locations_inserted"] += inserted
+        result["locations_skipped"] += len(locations) - inserted
+    except Exception as e:
+        chimera_db.rollback()
+        result["errors"] += len(locations)
+        print_error("%s failed to insert %d locations into chimera DB, %s" %
+                    (label, len(locations), str(e),))
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
+class EnstoreReader(object):
+    """
+    Reads Enstore volumes and their files from Enstore DB
+    """
+    def __init__(self, enstore_db, media_types):
+        self.enstore_db = enstore_db
+        self.media_types = media_types
+
+    def get_volume(self, label):
+        """
+        Volume row of label or None
+        """
+        volumes = select(self.enstore_db,
+                         "select * from volume where label=%s",
+                         (label,))
+        return volumes[0] if volumes else None
+
+    def get_files(self, label):
+        """
+        File rows of label sorted by pnfs_id
+        """
+        return select(self.enstore_db,
+                      SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY,
+                      {"label": label, "media_types": self.media_types})
+
+
+def open_enstore(config, tag=None):
+    """
+    Source of Enstore metadata: snapshot, volume cache or Enstore DB
+
+    :param config: migration configuration
+    :type config: dict
+    :param tag: appended to application_name of Enstore DB connection
+    :type tag: str
+    :return: reader and Enstore DB connection, None for snapshot
+    :rtype: tuple
+    """
+    if config.get("enstore_snapshot"):
+        return Snapshot(config.get("enstore_snapshot")), None
+    enstore_db = open_connection(config, "enstore_db", tag)
+    if config.get("volume_cache"):
+        return (VolumeCache(config.get("volume_cache"), enstore_db,
+                            get_enstore_media_types(config)),
+                enstore_db)
+    return EnstoreReader(enstore_db, get_enstore_media_types(config)), enstore_db
+
+
+def migrate_label(enstore, cta_db, chimera_db, label, config,
+                  added_copy_volumes, dimensions):
+    """
+    Migrate single Enstore volume
+
+    :param enstore: source of Enstore metadata
+    :type enstore: EnstoreReader or snapshot.Snapshot
+
+    :param label: Enstore volume label
+    :type label: str
+
+    :param config: migration configuration
+    :type config: dict
+
+    :param added_copy_volumes: copy volumes already inserted by the caller
+    :type added_copy_volumes: set
+
+    :param dimensions: CTA name to id maps
+    :type dimensions: CtaDimensions
+
+    :return: result, see label_result
+    :rtype: dict
+    """
+    print_message("Doing label %s" % (label, ))
+    enstore_volume = enstore.get_volume(label)
+    if not enstore_volume:
+        print_error("No such volume %s" % (label, ))
+        return label_result(label, "failed", message="no such volume")
+    try:
+        check_dimensions(enstore_volume, config, dimensions)
+        insert_cta_tape(cta_db, enstore_volume, config, dimensions)
+    except KeyError as e:
+        print_error("Failed to insert tape label %s, %s" % (enstore_volume["label"], e.args[0],))
+        return label_result(label, "failed", message=e.args[0])
+    except psycopg2.IntegrityError:
+        # except psycopg2.IntegrityError as e:
+        # print_error("%s already exist, skipping, %s " %
+        #             (enstore_volume["label"], str(e)))
+        print_error(f"{label} Done, aleady exists, skipping")
+        return label_result(label, "exists")
+    result = label_result(label, "done")
+    files = skip_duplicates(enstore.get_files(label), label, config, result)
+    result["files"] = len(files)
+    batch_size = config.get("batch_size", 1000)
+    for i in range(0, len(files), max(batch_size, 1)):
+        batch = files[i:i + max(batch_size, 1)]
+        if batch_size > 1:
+            try:
+                insert_files_batch(cta_db, chimera_db, label, batch, config,
+                                   added_copy_volumes, dimensions, result)
+                continue
+            except (psycopg2.Error, KeyError) as e:
+                print_error("%s, failed to insert %d files in one batch, %s, "
+                            "inserting one by one" %
+                            (label, len(batch), str(e).strip(), ))
+        insert_files(cta_db, chimera_db, label, batch, config,
+                     added_copy_volumes, dimensions, result)
+    if config["skip_locations"]:
+        print_message("%s Done, %d files" %(label, len(files),))
+    else:
+        print_message("%s Done, %d files, locations inserted %d, "
+                      "skipped %d (exist or no such file)" %
+                      (label, len(files),
+                       result["locations_inserted"],
+                       result["locations_skipped"],))
+    return result
+
+
+class Worker(multiprocessing.Process):
+    """
+    Class that processed individual enstore volume
+    """
+    def __init__(self, queue, config, result_queue=None):
+        super(Worker, self).__init__()
+        self.queue = queue
+        self.config = config
+        self.result_queue = result_queue
+        self.enstore_db, self.cta_db, self.chimera_db = None, None, None
+        self.enstore = None
+        self.dimensions = None
+        self.added_copy_volumes = set()
+
+    def connect(self):
+        """
+        Open database connections and load CTA name to id maps
+        """
+        # enstore db or its snapshot
+        self.enstore, self.enstore_db = open_enstore(self.config, self.name)
+        # cta db
+        self.cta_db = open_connection(self.config, "cta_db", self.name)
+        # chimera_db
+        self.chimera_db = open_connection(self.config, "chimera_db", self.name)
+
+        self.dimensions = CtaDimensions(self.cta_db)
+
+    def close(self):
+        for i in (self.enstore_db, self.cta_db, self.chimera_db):
+            if i:
+                try:
+                    i.close()
+                except:
+                    pass
+        self.enstore_db, self.cta_db, self.chimera_db = None, None, None
+
+    def set_label(self, label):
+        """
+        Show label being processed in application_name of connections
+        """
+        application_name = get_application_name(self.config, self.name, label)
+        for i in (self.enstore_db, self.cta_db, self.chimera_db):
+            if i:
+                set_application_name(i, application_name)
+
+    def recover(self):
+        """
+        Roll back transactions left open by a failed label, reconnect
+        if a connection is broken
+        """
+        try:
+            for i in (self.enstore_db, self.cta_db, self.chimera_db):
+                if i:
+                    i.rollback()
+        except psycopg2.Error:
+            self.close()
+            self.connect()
+
+    def process(self, label, *args):
+        """
+        Migrate label, a failure fails the label and not the worker.
+        Extra arguments are passed to do_label
+
+        :return: result, see label_result
+        :rtype: dict
+        """
+        try:
+            self.set_label(label)
+            return self.do_label(label, *args)
+        except Exception as e:
+            print_error("%s failed, %s" % (label, str(e).strip()))
+            self.recover()
+            return label_result(label, "failed", message=str(e).strip())
+
+    def run(self):
+        try:
+            self.connect()
+            stats = QueueStats("worker %s" % (self.name, ), "get",
+                               self.config.get("telemetry_interval", 60))
+            while True:
+                t0 = time.time()
+                label = self.queue.get()
+                stats.waited(time.time() - t0)
+                if label is None:
+                    break
+                if os.path.exists(STOPPER):
+                    print_error(f"Found {STOPPER} file. Quitting...")
+                    break
+                stats.report()
+                t0 = time.time()
+                result = self.process(label)
+                stats.worked(time.time() - t0)
+                if self.result_queue is not None:
+                    self.result_queue.put(result)
+            stats.summary()
+            if isinstance(self.enstore, VolumeCache):
+                print_message("worker %s: volume cache %d hits, %d misses" %
+                              (self.name, self.enstore.hits,
+                               self.enstore.misses))
+        except Exception as e:
+            print_message("Exception %s" % (str(e)))
+        finally:
+            self.close()
+
+    def do_label(self, label):
+        """
+        Migrate single Enstore volume using this worker's connections
+        """
+        t0 = time.time()
+        result = migrate_label(self.enstore, self.cta_db, self.chimera_db,
+                               label, self.config, self.added_copy_volumes,
+                               self.dimensions)
+        result["seconds"] = time.time() - t0
+        return result
+
+
+def migrate_labels(labels, config, concurrency=None, update_copy_counts=True,
+                   worker_class=Worker):
+    """
+    Migrate Enstore volumes to CTA. CTA objects (VOs, pools, storage
+    classes, ...) are expected to exist, see bootstrap_cta and preflight.
+
+    :param labels: Enstore volume labels
+    :type labels: list
+
+    :param config: migration configuration, same keys as enstore2cta.yaml
+    :type config: dict
+
+    :param concurrency: number of worker processes, default is cpu count,
+                        0 runs migration in the calling process
+    :type concurrency: int
+
+    :param update_copy_counts: recalculate tape copy counts when done
+    :type update_copy_counts: bool
+
+    :param worker_class: Worker or its subclass processing a label
+    :type worker_class: class
+
+    :return: one result per label in the order of labels, see label_result
+    :rtype: list
+    """
+    config = dict(config)
+    config.setdefault("skip_locations", False)
+    config.setdefault("tape_pool_naming", "storage_class")
+    config.setdefault("telemetry_interval", 60)
+    config.setdefault("batch_size", 1000)
+    if config["tape_pool_naming"] not in TAPE_POOL_NAMING:
+        raise ValueError("Unknown tape_pool_naming %s, expected one of %s" %
+                         (config["tape_pool_naming"],
+                          ", ".join(sorted(TAPE_POOL_NAMING.keys()))))
+    problems = check_media_types(config)
+    if problems:
+        raise ValueError(", ".join(problems))
+    if concurrency is None:
+        concurrency = multiprocessing.cpu_count()
+
+    results = {}
+    if concurrency == 0:
+        worker = worker_class(None, config)
+        try:
+            worker.connect()
+            for label in labels:
+                if os.path.exists(STOPPER):
+                    print_error(f"Found {STOPPER} file. Quitting...")
+                    break
+                results[label] = worker.process(label)
+        finally:
+            worker.close()
+    else:
+        queue = multiprocessing.Queue(10000)
+        result_queue = multiprocessing.Queue()
+        workers = []
+        for i in range(concurrency):
+            worker = worker_class(queue, config, result_queue)
+            workers.append(worker)
+            worker.start()
+
+        stats = QueueStats("producer", "put", config["telemetry_interval"])
+        for label in labels:
+            t0 = time.time()
+            queue.put(label)
+            stats.waited(time.time() - t0)
+            stats.report()
+        stats.summary()
+
+        for i in range(concurrency):
+            queue.put(None)
+
+        # drain results while workers run, a process does not exit
+        # until everything it put on a queue has been consumed
+        while True:
+            try:
+                result = result_queue.get(timeout=1)
+                results[result["label"]] = result
+            except Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+
+        for worker in workers:
+            worker.join()
+
+        while True:
+            try:
+                result = result_queue.get(timeout=0.1)
+                results[result["label"]] = result
+            except Empty:
+                break
+
+    if update_copy_counts and not os.path.exists(STOPPER):
+        print_message("Finished file migration, bootstrapping tapes copies counts")
+        cta_db = open_connection(config, "cta_db")
+        try:
+            update_cta_copy_counts(cta_db)
+        finally:
+            cta_db.close()
+
+    return [results.get(label, label_result(label, "not_processed"))
+            for label in labels]
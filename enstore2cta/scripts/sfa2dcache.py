@@ -7,15 +7,23 @@ This script does Enstore SFA -> dCache SFA
 
 from __future__ import print_function
 import argparse
+import array
+import collections
+import csv
 import errno
 import multiprocessing
 import os
-import re
 import socket
 import subprocess
 import sys
 import time
 import yaml
+import zlib
+
+try:
+    from queue import Empty, Full
+except ImportError:
+    from Queue import Empty, Full
 
 import psycopg2
 import psycopg2.extras
@@ -25,6 +33,13 @@ try:
 except ModuleNotFoundError:
     import urllib.parse as urlparse
 
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+from enstore2cta.util import QueueStats, print_error, print_message
+
 
 CONFIG_FILE = os.getenv("MIGRATION_CONFIG")
 if not CONFIG_FILE:
@@ -34,10 +49,11 @@ HOSTNAME = socket.getfqdn()
 
 PNFS_HOME = "/pnfs/fs/usr"
 
-printLock = multiprocessing.Lock()
-
 CRC_SWITCH = '2019-08-21 09:54:26'
 
+# seconds between liveness checks while waiting on a queue
+POLL_INTERVAL = 5
+
 
 def get_switch_epoch():
     """
@@ -78,40 +94,6 @@ def execute_command(cmd):
     return rc
 
 
-def print_error(text):
-    """
-    Print text string to stderr prefixed with timestamp
-    and ERROR keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stderr.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" ERROR : " + text + "\n")
-        sys.stderr.flush()
-
-
-def print_message(text):
-    """
-    Print text string to stdout prefixed with timestamp
-    and INFO keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stdout.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" INFO : " + text + "\n")
-        sys.stdout.flush()
-
-
 def get_path(pnfsid):
     """
     Get path for pnfsid
@@ -135,7 +117,7 @@ def get_pnfsid(path):
 
 
 # create DB connection from URI
-def create_connection(uri):
+def create_connection(uri, readonly=False):
     result = urlparse.urlparse(uri)
     connection = psycopg2.connect(
         database=result.path[1:],
@@ -143,12 +125,21 @@ def create_connection(uri):
         password=result.password,
         host=result.hostname,
         port=result.port)
+    if readonly:
+        connection.set_session(readonly=True)
     return connection
 
-INSERT_LOCATION = """
+#
+# insert locations of all children of a package at once,
+# children missing in chimera and already existing locations
+# are skipped
+#
+INSERT_LOCATIONS = """
 insert into t_locationinfo
 (inumber , itype, ipriority, ictime, iatime, istate, ilocation)
-values ((select inumber from t_inodes where ipnfsid = %s), %s, %s, now(), now(), %s, %s)
+select inumber, 0, 10, now(), now(), 1, 'sfa://sfa/'||ipnfsid||'?packageid='||%s
+from t_inodes where ipnfsid = any(%s)
+on conflict do nothing
 """
 
 DELETE_LOCATION = """
@@ -162,128 +153,508 @@ INSERT_CHECKSUM = """
 insert into t_inodes_checksum
 (inumber, itype, isum)
 values (%s, 1, %s)
+on conflict do nothing
 """
 
-class SfaWorker(multiprocessing.Process):
-    """
-    This class is responsible for setting AL/RP = NEARLINE/CUSTODIAL
-    setting files precious on location.
-    """
-    def __init__(self, queue, configuration):
-        super().__init__()
-        self.queue = queue
-        self.configuration = configuration
-
-    def run(self):
-        # db connection pool to enstore db
-        enstore_db = create_connection(self.configuration.get("enstore_db"))
-        # chimera_db
-        chimera_db = create_connection(self.configuration.get("chimera_db"))
-
-        Q = "select f.*, v.storage_group from file f inner join volume v on v.id = f.volume  where bfid = %s"
-
-        for data in iter(self.queue.get, None):
-            inumber = data.get("ino")
-            file_name = data.get("path")
-            pnfsid = data.get("pnfsid")
-            chimera_file_size = int(data.get("fsize"))
-            chimera_file_family = data.get("file_family")
-            bfid = data.get("bfid")
+SELECT_ENSTORE_FILES = """
+select f.*, v.storage_group from file f inner join volume v on v.id = f.volume  where bfid = any(%s)
+"""
 
-            if not bfid:
-                print_error(f"file {pnfsid}, {file_name} has no bfid")
-                continue
+SELECT_PACKAGES_CHILDREN = """
+select package_id, pnfs_id from file where bfid != package_id and package_id = any(%s) and deleted = 'n'
+"""
 
-            csum_info = select(chimera_db,
-                               "select isum from t_inodes_checksum where inumber = %s and itype = 1",
-                               (inumber,))
+SELECT_CHECKSUMS = """
+select inumber, isum from t_inodes_checksum where inumber = any(%s) and itype = 1
+"""
 
-            chimera_file_csum = None
-            if csum_info:
-                chimera_file_csum = csum_info[0].get("isum")
+SELECT_CHILDREN_LOCATIONS = """
+select distinct i.ipnfsid
+from t_inodes i
+inner join t_locationinfo l on l.inumber = i.inumber
+where i.ipnfsid = any(%s) and
+      l.itype = 0 and
+      l.ilocation like 'sfa://%%'
+"""
 
-            file_infos = select(enstore_db,
-                                Q,
-                                (bfid, ))
-            if not file_infos:
-                print_error(f"file {pnfsid}, {file_name} {bfid} not found in enstore db")
-                continue
+REPORT_HEADER = ("category", "pnfsid", "path", "bfid", "chimera", "enstore")
 
-            file_info = file_infos[0]
 
-            enstore_bfid = file_info["bfid"]
-            enstore_file_size = int(file_info["size"])
-            enstore_file_csum = int(file_info["crc"])
-            enstore_file_create_time = int(enstore_bfid[4:14])
-            enstore_storage_group = file_info["storage_group"]
-            deleted = file_info["deleted"]
+class LRUCache(object):
+    """
+    Bounded cache that evicts least recently used entries
+    and counts hits and misses
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return cached value and mark it most recently used.
+        Raises KeyError if key is not cached
+
+        :param key: cache key
+        :type key: object
+        :return: cached value
+        :rtype: object
+        """
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store value, evict least recently used entry if cache is full
+
+        :param key: cache key
+        :type key: object
+        :param value: value to cache
+        :type value: object
+        :return: no value
+        :rtype: none
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return "cache size %d, hits %d, misses %d, hit ratio %.1f%%" % (
+            len(self.entries), self.hits, self.misses,
+            100. * self.hits / total if total else 0.)
+
+
+#
+# Chunks of chimera records are passed to workers through shared
+# memory as columns: integer columns as int64 arrays followed by,
+# for each string column, int64 array of end offsets and utf-8
+# encoded strings packed back to back. Only small descriptor
+# (segment name, number of records, sizes of string columns) goes
+# through the queue. None and empty string are not distinguished,
+# both are decoded as None. Segment names start with the pid of the
+# main process, segments left in SHM_DIRECTORY by dead workers or an
+# aborted run are unlinked by the main process at the end.
+#
+BATCH_INTEGERS = ("ino", "fsize")
+BATCH_STRINGS = ("pnfsid", "path", "bfid", "file_family")
+
+SHM_DIRECTORY = "/dev/shm"
+
+
+def get_segment_prefix(pid=None):
+    """
+    Prefix of names of shared memory segments of the run of the
+    main process pid
+    """
+    return "sfa2dcache_%d_" % (pid or os.getpid(), )
 
-            #print_message(f"{pnfsid} {file_name} storage_group =  {enstore_storage_group} file_family = {chimera_file_family}")
 
-            if deleted != "n":
-                print_error(f"file {pnfsid}, {file_name} BFID marked deleted {bfid}")
-                continue
+def unlink_segments(prefix):
+    """
+    Unlink shared memory segments of a run that were not consumed
 
-            if bfid != enstore_bfid:
-                print_error(f"file {pnfsid}, {file_name} BFID mismatch {bfid} != {enstore_bfid}")
-                continue
+    :param prefix: segment name prefix, see get_segment_prefix
+    :type prefix: str
+    :return: number of segments unlinked
+    :rtype: int
+    """
+    try:
+        names = [i for i in os.listdir(SHM_DIRECTORY) if i.startswith(prefix)]
+    except OSError:
+        return 0
+    for name in names:
+        try:
+            os.unlink(os.path.join(SHM_DIRECTORY, name))
+        except OSError:
+            pass
+    return len(names)
+
+
+def create_shared_memory(size, name=None):
+    """
+    Create shared memory segment that is not unlinked by the
+    resource tracker of the creating process; the consumer
+    unlinks it once the chunk is decoded
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size,
+                                          track=False)
+    except TypeError:
+        # track was added in python 3.13
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
 
-            if enstore_file_create_time < get_switch_epoch() and HOSTNAME.endswith(".fnal.gov"):
-                enstore_file_csum =  convert_0_adler32_to_1_adler32(enstore_file_csum,
-                                                                     enstore_file_size)
 
-            if chimera_file_size != enstore_file_size:
-                print_error(f"file {pnfsid}, {file_name} {bfid} size does not match {chimera_file_size} != {enstore_file_size}")
-                continue
+def encode_batch(rows, name=None):
+    """
+    Pack chimera records into shared memory segment
+
+    :param rows: chimera records
+    :type rows: list
+    :param name: segment name, random if not given
+    :type name: str
+    :return: descriptor (segment name, number of records,
+             sizes of string columns in bytes)
+    :rtype: tuple
+    """
+    integers = array.array("q")
+    for column in BATCH_INTEGERS:
+        integers.extend(int(r[column]) for r in rows)
+    ends = array.array("q")
+    strings = []
+    for column in BATCH_STRINGS:
+        values = [(r[column] or "").encode() for r in rows]
+        position = 0
+        for value in values:
+            position += len(value)
+            ends.append(position)
+        strings.append(b"".join(values))
+    sizes = tuple(len(i) for i in strings)
+    parts = [memoryview(integers).cast("B"), memoryview(ends).cast("B")] + strings
+    shm = create_shared_memory(max(1, sum(len(i) for i in parts)), name)
+    offset = 0
+    for part in parts:
+        shm.buf[offset:offset + len(part)] = part
+        offset += len(part)
+    name = shm.name
+    shm.close()
+    return (name, len(rows), sizes)
+
+
+def decode_batch(descriptor):
+    """
+    Unpack chimera records from shared memory segment
+    and unlink the segment
 
-            enstore_file_csum = hex(enstore_file_csum).lstrip("0x").zfill(8)
+    :param descriptor: descriptor returned by encode_batch
+    :type descriptor: tuple
+    :return: chimera records
+    :rtype: list
+    """
+    name, n, sizes = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        buf = shm.buf
+        offset = 8 * n * len(BATCH_INTEGERS)
+        integers = buf[:offset].cast("q")
+        ends = buf[offset:offset + 8 * n * len(BATCH_STRINGS)].cast("q")
+        offset += 8 * n * len(BATCH_STRINGS)
+        rows = [{} for i in range(n)]
+        for i, column in enumerate(BATCH_INTEGERS):
+            for j in range(n):
+                rows[j][column] = integers[i * n + j]
+        for i, column in enumerate(BATCH_STRINGS):
+            data = bytes(buf[offset:offset + sizes[i]])
+            offset += sizes[i]
+            start = 0
+            for j in range(n):
+                end = ends[i * n + j]
+                rows[j][column] = data[start:end].decode() or None
+                start = end
+        integers.release()
+        ends.release()
+        del buf
+        return rows
+    finally:
+        shm.close()
+        shm.unlink()
 
-            if not chimera_file_csum:
-                print_error(f"file {pnfsid}, {bfid} no chimera checksum, inserting")
-                insert(chimera_db,
-                       INSERT_CHECKSUM,
-                       (inumber,
-                        enstore_file_csum))
-            elif chimera_file_csum != enstore_file_csum:
-                print_error(f"file {pnfsid}, {file_name} {bfid} checksum does not match {chimera_file_csum} != {enstore_file_csum}")
-                continue
 
-            #
-            # get list of children
-            #
+def route(bfid, n):
+    """
+    Pick the worker responsible for a package. Stable across
+    processes, so every package is always handled by the same worker
+
+    :param bfid: package bfid
+    :type bfid: str
+    :param n: number of workers
+    :type n: int
+    :return: worker index
+    :rtype: int
+    """
+    return zlib.crc32((bfid or "").encode()) % n
 
-            package_files_count = file_info["package_files_count"]
-            enstore_children = select(enstore_db,
-                                      "select pnfs_id from file where bfid != package_id and package_id = %s and deleted = 'n'",
-                                      (bfid,))
 
-            pnfsids = [x["pnfs_id"] for x in enstore_children]
+class SfaWorker(multiprocessing.Process):
+    """
+    This class is responsible for setting AL/RP = NEARLINE/CUSTODIAL
+    setting files precious on location.
 
-            for child_pnfsid in pnfsids:
-#                insert(chimera_db,
-#                       DELETE_LOCATION,
-#                       (child_pnfsid,))
+    In verify only mode nothing is written, discrepancies
+    are sent back to the main process instead.
+    """
+    def __init__(self, queue, done_queue, configuration):
+        super().__init__()
+        self.queue = queue
+        self.done_queue = done_queue
+        self.configuration = configuration
+        self.verify_only = configuration.get("verify_only", False)
+        self.cache = LRUCache(configuration.get("cache_size", 10000))
+        self.counters = collections.Counter()
+
+    def get_packages(self, enstore_db, bfids):
+        """
+        Get Enstore file records and lists of active children pnfsids
+        of packages, cached per bfid. Packages that are not cached
+        are fetched with two queries
+
+        :param enstore_db: enstore database connection
+        :type enstore_db: Connection
+        :param bfids: package bfids
+        :type bfids: set
+        :return: dictionary bfid -> (file record, children pnfsids),
+                 None for bfids not found in Enstore
+        :rtype: dict
+        """
+        packages = {}
+        missing = []
+        for bfid in bfids:
+            try:
+                packages[bfid] = self.cache.get(bfid)
+            except KeyError:
+                missing.append(bfid)
+        if not missing:
+            return packages
+        file_infos = dict((row["bfid"], row) for row in
+                          select(enstore_db,
+                                 SELECT_ENSTORE_FILES,
+                                 (missing, )))
+        children = dict((bfid, []) for bfid in file_infos)
+        if file_infos:
+            for row in select(enstore_db,
+                              SELECT_PACKAGES_CHILDREN,
+                              (list(file_infos.keys()), )):
+                children[row["package_id"]].append(row["pnfs_id"])
+        for bfid in missing:
+            package = None
+            if bfid in file_infos:
+                package = (file_infos[bfid], children[bfid])
+            self.cache.put(bfid, package)
+            packages[bfid] = package
+        return packages
 
-                try:
-                    insert(chimera_db,
-                           INSERT_LOCATION,
-                           (child_pnfsid,
-                            0,
-                            10,
-                            1,
-                            #f"dcache://dcache/?store={enstore_storage_group}&group={chimera_file_family}&bfid={child_pnfsid}:{pnfsid}"
-                            f"sfa://sfa/{child_pnfsid}?packageid={pnfsid}"
-                           ))
-                except psycopg2.errors.NotNullViolation:
-                    #print_error(f"file {pnfsid} child {child_pnfsid} does not exist")
-                    pass
-                except psycopg2.errors.UniqueViolation:
-                    print_message(f"file  {pnfsid} child {child_pnfsid} location already exists")
-                    pass
+    def run(self):
+        # db connection pool to enstore db
+        enstore_db = create_connection(self.configuration.get("enstore_db"),
+                                       self.verify_only)
+        # chimera_db
+        chimera_db = create_connection(self.configuration.get("chimera_db"),
+                                       self.verify_only)
 
+        stats = QueueStats("worker %s" % (self.name, ), "get",
+                           self.configuration.get("telemetry_interval", 60))
+        while True:
+            t0 = time.time()
+            item = self.queue.get()
+            stats.waited(time.time() - t0)
+            if item is None:
+                break
+            t0 = time.time()
+            unit, rows = item
+            if self.configuration.get("transport") == "shm":
+                rows = decode_batch(rows)
+            mismatches = self.process(enstore_db, chimera_db, rows)
+            self.done_queue.put(("processed", unit, len(rows), mismatches))
+            stats.worked(time.time() - t0, len(rows))
+            stats.report()
+
+        stats.summary()
+        print_message("worker %s %s" % (self.name, self.cache.stats()))
+        if not self.verify_only:
+            print_message("worker %s checksums inserted %d, locations "
+                          "inserted %d, skipped %d (exist or no such file)" %
+                          (self.name,
+                           self.counters["checksums"],
+                           self.counters["inserted"],
+                           self.counters["skipped"]))
         enstore_db.close()
         chimera_db.close()
 
+    def process(self, enstore_db, chimera_db, rows):
+        """
+        Check chunk of chimera entries against Enstore and fill
+        locations of the package children. Lookups are done for the
+        whole chunk at once
+
+        :param enstore_db: enstore database connection
+        :type enstore_db: Connection
+        :param chimera_db: chimera database connection
+        :type chimera_db: Connection
+        :param rows: chimera entries
+        :type rows: list
+        :return: list of discrepancies (category, pnfsid, path, bfid,
+                 chimera value, enstore value)
+        :rtype: list
+        """
+        mismatches = []
+        checksums = {}
+        inumbers = [r["ino"] for r in rows if r["bfid"]]
+        if inumbers:
+            checksums = dict((row["inumber"], row["isum"]) for row in
+                             select(chimera_db,
+                                    SELECT_CHECKSUMS,
+                                    (inumbers, )))
+        packages = self.get_packages(enstore_db,
+                                     set(r["bfid"] for r in rows if r["bfid"]))
+
+        verified = []
+        for data in rows:
+            mismatch = self.check(chimera_db, data,
+                                  checksums.get(data.get("ino")),
+                                  packages.get(data.get("bfid")))
+            if mismatch:
+                if self.verify_only:
+                    mismatches.append(mismatch)
+                continue
+            if self.verify_only:
+                verified.append((data, packages[data.get("bfid")]))
+            else:
+                self.insert_locations(chimera_db, data,
+                                      packages[data.get("bfid")])
+        if verified:
+            mismatches += self.check_locations(chimera_db, verified)
+        return mismatches
+
+    def check(self, chimera_db, data, chimera_file_csum, package):
+        """
+        Compare chimera entry with Enstore package record, insert
+        missing checksum unless in verify only mode
+
+        :return: discrepancy if found, None otherwise
+        :rtype: tuple
+        """
+        inumber = data.get("ino")
+        file_name = data.get("path")
+        pnfsid = data.get("pnfsid")
+        chimera_file_size = int(data.get("fsize"))
+        bfid = data.get("bfid")
+
+        if not bfid:
+            return self.report("no_bfid", data,
+                               f"file {pnfsid}, {file_name} has no bfid")
+
+        if not package:
+            return self.report("not_in_enstore", data,
+                               f"file {pnfsid}, {file_name} {bfid} not found in enstore db")
+
+        file_info = package[0]
+
+        enstore_bfid = file_info["bfid"]
+        enstore_file_size = int(file_info["size"])
+        enstore_file_csum = int(file_info["crc"])
+        enstore_file_create_time = int(enstore_bfid[4:14])
+        deleted = file_info["deleted"]
+
+        if deleted != "n":
+            return self.report("deleted", data,
+                               f"file {pnfsid}, {file_name} BFID marked deleted {bfid}",
+                               enstore=deleted)
+
+        if bfid != enstore_bfid:
+            return self.report("bfid_mismatch", data,
+                               f"file {pnfsid}, {file_name} BFID mismatch {bfid} != {enstore_bfid}",
+                               bfid, enstore_bfid)
+
+        if enstore_file_create_time < get_switch_epoch() and HOSTNAME.endswith(".fnal.gov"):
+            enstore_file_csum =  convert_0_adler32_to_1_adler32(enstore_file_csum,
+                                                                 enstore_file_size)
+
+        if chimera_file_size != enstore_file_size:
+            return self.report("size_mismatch", data,
+                               f"file {pnfsid}, {file_name} {bfid} size does not match {chimera_file_size} != {enstore_file_size}",
+                               chimera_file_size, enstore_file_size)
+
+        enstore_file_csum = hex(enstore_file_csum).lstrip("0x").zfill(8)
+
+        if not chimera_file_csum:
+            if self.verify_only:
+                return self.report("no_checksum", data, None,
+                                   enstore=enstore_file_csum)
+            print_error(f"file {pnfsid}, {bfid} no chimera checksum, inserting")
+            self.counters["checksums"] += insert(chimera_db,
+                                                 INSERT_CHECKSUM,
+                                                 (inumber,
+                                                  enstore_file_csum))
+        elif chimera_file_csum != enstore_file_csum:
+            return self.report("checksum_mismatch", data,
+                               f"file {pnfsid}, {file_name} {bfid} checksum does not match {chimera_file_csum} != {enstore_file_csum}",
+                               chimera_file_csum, enstore_file_csum)
+        return None
+
+    def report(self, category, data, message, chimera=None, enstore=None):
+        """
+        Print discrepancy or, in verify only mode, return it as a
+        report record
+
+        :return: report record in verify only mode, True otherwise
+        :rtype: tuple
+        """
+        if not self.verify_only:
+            print_error(message)
+            return True
+        return (category,
+                data.get("pnfsid"),
+                data.get("path"),
+                data.get("bfid"),
+                chimera,
+                enstore)
+
+    def check_locations(self, chimera_db, verified):
+        """
+        Find package children that have no SFA location in chimera.
+        Locations of children of all packages of the chunk are looked
+        up with one query
+
+        :param verified: (chimera entry, package) of package files
+                         that passed the checks
+        :type verified: list
+        :return: list of discrepancies
+        :rtype: list
+        """
+        children = set()
+        for data, package in verified:
+            children.update(package[1])
+        if not children:
+            return []
+        existing = set(row["ipnfsid"] for row in
+                       select(chimera_db,
+                              SELECT_CHILDREN_LOCATIONS,
+                              (list(children), )))
+        return [("missing_location",
+                 child_pnfsid,
+                 None,
+                 data.get("bfid"),
+                 None,
+                 f"sfa://sfa/{child_pnfsid}?packageid={data.get('pnfsid')}")
+                for data, package in verified
+                for child_pnfsid in package[1] if child_pnfsid not in existing]
+
+    def insert_locations(self, chimera_db, data, package):
+        """
+        Insert SFA locations of package children into chimera
+        """
+        pnfsid = data.get("pnfsid")
+        file_info, pnfsids = package
+        if not pnfsids:
+            return
+        inserted = insert(chimera_db,
+                          INSERT_LOCATIONS,
+                          (pnfsid,
+                           pnfsids))
+        self.counters["inserted"] += inserted
+        self.counters["skipped"] += len(pnfsids) - inserted
+
+
 def select(con, sql, pars=None):
     """
     Select  database records
@@ -348,14 +719,15 @@ def insert(con, sql, pars):
     :param pars: query parameters
     :type pars: tuple
 
-    :return: result
-    :rtype: object
+    :return: number of rows inserted
+    :rtype: int
     """
     cursor = None
     try:
         cursor = con.cursor()
         cursor.execute(sql, pars)
         con.commit()
+        return cursor.rowcount
     except Exception:
         con.rollback()
         raise
@@ -368,6 +740,258 @@ def insert(con, sql, pars):
 
 
 
+TRAVERSE_SUBTREE = """
+WITH RECURSIVE paths(ino, path, pnfsid, fsize, ftype) AS (VALUES
+(pnfsid2inumber(%s), %s, '', 0::BIGINT, 16384)
+UNION SELECT i.inumber,
+             path||'/'||d.iname,
+             i.ipnfsid,
+             i.isize,
+             i.itype
+FROM
+    t_dirs d, t_inodes i, paths p
+WHERE p.ftype=16384 AND
+      d.iparent=p.ino AND
+      d.iname != '.' AND
+      d.iname != '..' AND
+      i.inumber=d.ichild)
+SELECT p.ino,
+       p.path,
+       p.pnfsid,
+       p.fsize,
+       encode(l1.ifiledata,'escape') as bfid,
+       ts.istoragesubgroup as file_family
+FROM paths p
+LEFT OUTER JOIN t_level_1 l1 ON (p.ino = l1.inumber)
+LEFT OUTER JOIN t_storageinfo ts ON (p.ino = ts.inumber)
+WHERE p.ftype = 32768
+"""
+
+#
+# files located directly in the root directory,
+# sub-directories are traversed as separate units
+#
+TRAVERSE_ROOT_FILES = """
+SELECT i.inumber as ino,
+       '/'||d.iname as path,
+       i.ipnfsid as pnfsid,
+       i.isize as fsize,
+       encode(l1.ifiledata,'escape') as bfid,
+       ts.istoragesubgroup as file_family
+FROM t_dirs d
+INNER JOIN t_inodes i ON (i.inumber = d.ichild)
+LEFT OUTER JOIN t_level_1 l1 ON (i.inumber = l1.inumber)
+LEFT OUTER JOIN t_storageinfo ts ON (i.inumber = ts.inumber)
+WHERE d.iparent = pnfsid2inumber(%s) AND
+      i.itype = 32768
+"""
+
+SELECT_SUBDIRECTORIES = """
+SELECT i.ipnfsid as pnfsid,
+       d.iname as name
+FROM t_dirs d
+INNER JOIN t_inodes i ON (i.inumber = d.ichild)
+WHERE d.iparent = pnfsid2inumber(%s) AND
+      d.iname != '.' AND
+      d.iname != '..' AND
+      i.itype = 16384
+ORDER BY d.iname
+"""
+
+
+class Traverser(multiprocessing.Process):
+    """
+    This class walks directory subtrees (units) in chimera and
+    feeds the files found to SfaWorkers. Each unit is a tuple
+    (root pnfsid, unit pnfsid, path, recursive). Files are routed
+    to workers by package bfid so that each package is looked up
+    in Enstore by one worker only
+    """
+    def __init__(self, units, queues, done_queue, configuration, aborted):
+        super().__init__()
+        self.units = units
+        self.queues = queues
+        self.done_queue = done_queue
+        self.configuration = configuration
+        self.aborted = aborted
+        self.parent = os.getpid()
+
+    def put(self, queue, item):
+        """
+        Put item into worker queue. A full queue is retried every
+        POLL_INTERVAL seconds until the run is aborted by the main
+        process or the main process is gone
+
+        :raises RuntimeError: if the run was aborted
+        """
+        while True:
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except Full:
+                if self.aborted.is_set() or os.getppid() != self.parent:
+                    raise RuntimeError("run aborted")
+
+    def run(self):
+        chimera_db = create_connection(self.configuration.get("chimera_db"),
+                                       self.configuration.get("verify_only", False))
+        chunk_size = self.configuration.get("chunk_size", 10000)
+        prefix = "%s%d_" % (get_segment_prefix(self.parent), os.getpid())
+        segments = 0
+        stats = QueueStats("traverser %s" % (self.name, ), "put",
+                           self.configuration.get("telemetry_interval", 60))
+        try:
+            for root, pnfsid, path, recursive in iter(self.units.get, None):
+                cursor = None
+                total = 0
+                try:
+                    cursor = chimera_db.cursor("cursor_sfa_%s" % (pnfsid, ),
+                                               cursor_factory=psycopg2.extras.RealDictCursor)
+                    if recursive:
+                        cursor.execute(TRAVERSE_SUBTREE, (pnfsid, path))
+                    else:
+                        cursor.execute(TRAVERSE_ROOT_FILES, (pnfsid, ))
+                    while True:
+                        t0 = time.time()
+                        res = cursor.fetchmany(chunk_size)
+                        if not res:
+                            break
+                        total += len(res)
+                        chunks = [[] for q in self.queues]
+                        for r in res:
+                            chunks[route(r["bfid"], len(self.queues))].append(r)
+                        if self.configuration.get("transport") == "shm":
+                            encoded = []
+                            for c in chunks:
+                                if c:
+                                    segments += 1
+                                    c = encode_batch(c, "%s%d" % (prefix, segments))
+                                encoded.append(c)
+                            chunks = encoded
+                        stats.worked(time.time() - t0, len(res))
+                        for q, chunk in zip(self.queues, chunks):
+                            if chunk:
+                                t0 = time.time()
+                                self.put(q, ((root, pnfsid), chunk))
+                                stats.waited(time.time() - t0)
+                        stats.report()
+                finally:
+                    if cursor:
+                        try:
+                            cursor.close()
+                        except Exception:
+                            pass
+                    chimera_db.rollback()
+                self.done_queue.put(("traversed", (root, pnfsid), total, None))
+        finally:
+            stats.summary()
+            chimera_db.close()
+
+
+def load_state(state_file):
+    """
+    Load completed roots and subtrees recorded by previous runs
+
+    :param state_file: path to state file
+    :type state_file: str
+    :return: set of completed entries, (root,) for roots and
+             (root, subtree) for subtrees
+    :rtype: set
+    """
+    done = set()
+    if not state_file or not os.path.exists(state_file):
+        return done
+    with open(state_file, "r") as f:
+        for line in f:
+            parts = line.split()
+            if parts:
+                done.add(tuple(parts))
+    return done
+
+
+def get_state_file(state_file, verify_only=False):
+    """
+    State file of the run. Verification keeps its own state so that
+    units that were only verified are not skipped by a later migration
+
+    :param state_file: path to state file given on command line
+    :type state_file: str
+    :param verify_only: run in --verify_only mode
+    :type verify_only: bool
+    :return: path to state file of the run or None
+    :rtype: str
+    """
+    if state_file and verify_only:
+        return state_file + ".verify"
+    return state_file
+
+
+def record_state(state_file, *entry):
+    """
+    Append completed root or subtree to the state file
+
+    :param state_file: path to state file
+    :type state_file: str
+    :param entry: root pnfsid, optionally followed by subtree pnfsid
+    :type entry: str
+    :return: no value
+    :rtype: none
+    """
+    if not state_file:
+        return
+    with open(state_file, "a") as f:
+        f.write(" ".join(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def get_units(chimera_db, root, done):
+    """
+    Split root directory into units of work: files located
+    directly in the root plus one unit per sub-directory.
+    Units recorded as done are skipped
+
+    :param chimera_db: chimera database connection
+    :type chimera_db: Connection
+    :param root: root directory pnfsid
+    :type root: str
+    :param done: completed entries loaded from state file
+    :type done: set
+    :return: list of (root pnfsid, unit pnfsid, path, recursive) tuples
+    :rtype: list
+    """
+    units = [(root, root, "", False)]
+    for row in select(chimera_db, SELECT_SUBDIRECTORIES, (root, )):
+        units.append((root, row["pnfsid"], "/" + row["name"], True))
+    return [u for u in units if (u[0], u[1]) not in done]
+
+
+def get_failed(workers, traversers):
+    """
+    Find processes that died. Workers only exit when told to after
+    all units are done, traversers exit with zero exit code once
+    there are no more units
+
+    :return: failed processes
+    :rtype: list
+    """
+    return ([w for w in workers if not w.is_alive()] +
+            [t for t in traversers if t.exitcode not in (None, 0)])
+
+
+def abort(processes, aborted):
+    """
+    Tell traversers the run is aborted, terminate all processes
+    still running and wait for them
+    """
+    aborted.set()
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+
 def main():
     """
     main function
@@ -376,7 +1000,28 @@ def main():
 
     parser.add_argument(
         "--dir",
-        help="top directory name")
+        help="comma separated list of top directory names")
+
+    parser.add_argument(
+        "--pnfsid",
+        help="comma separated list of top directory pnfsids")
+
+    parser.add_argument(
+        "--state_file",
+        help="file recording completed roots and subtrees, "
+        "these are skipped when the script is restarted. "
+        "--verify_only runs use the file with .verify appended")
+
+    parser.add_argument(
+        "--verify_only",
+        help="do not write anything, compare chimera with Enstore "
+        "and write discrepancies to report file",
+        action="store_true")
+
+    parser.add_argument(
+        "--report",
+        default="sfa2dcache_report.csv",
+        help="report file written in --verify_only mode")
 
     parser.add_argument(
         "--cpu_count",
@@ -385,11 +1030,49 @@ def main():
         default =  multiprocessing.cpu_count(),
         help="override cpu count - number of simultaneously processed labels")
 
+    parser.add_argument(
+        "--cache_size",
+        action  = "store",
+        type = int,
+        default = 10000,
+        help="number of Enstore packages cached by each worker")
 
+    parser.add_argument(
+        "--chunk_size",
+        action  = "store",
+        type = int,
+        default = 10000,
+        help="number of files fetched from chimera and passed to workers at once")
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--queue_depth",
+        action  = "store",
+        type = int,
+        default = 4,
+        help="number of chunks waiting in each worker queue")
 
+    parser.add_argument(
+        "--transport",
+        choices=("shm", "queue"),
+        default="shm" if shared_memory else "queue",
+        help="pass chunks to workers through shared memory or "
+        "pickled through the queue")
 
+    parser.add_argument(
+        "--telemetry_interval",
+        action  = "store",
+        type = int,
+        default = 60,
+        help="interval in seconds between queue wait time reports")
+
+    parser.add_argument(
+        "--traverser_count",
+        action  = "store",
+        type = int,
+        default = 4,
+        help="number of simultaneously traversed directories")
+
+    args = parser.parse_args()
 
     configuration = None
     try:
@@ -409,94 +1092,186 @@ def main():
         print_error("Failed to load configuration %s" % (CONFIG_FILE,))
         sys.exit(1)
 
+    configuration["cache_size"] = args.cache_size
+    configuration["chunk_size"] = args.chunk_size
+    configuration["transport"] = args.transport
+    configuration["telemetry_interval"] = args.telemetry_interval
+    configuration["verify_only"] = args.verify_only
+    if args.verify_only:
+        #
+        # verification can run against read replicas
+        #
+        for db in ("enstore_db", "chimera_db"):
+            if configuration.get(db + "_replica"):
+                configuration[db] = configuration.get(db + "_replica")
     print (configuration)
 
+    if not args.dir and not args.pnfsid:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
 
-#    if not args.dir:
-#        parser.print_help(sys.stderr)
-#        sys.exit(1)
-
-#    if not os.path.exists(PNFS_HOME):
-#        print_error("PNFS is not mounted. Quitting.")
-#        sys.exit(1)
-
-#    if not os.path.exists(args.dir):
-#        print_error("Directry %s does not exist. Quitting.")
-#        sys.exit(1)
+    roots = {}
+    if args.dir:
+        if not os.path.exists(PNFS_HOME):
+            print_error("PNFS is not mounted. Quitting.")
+            sys.exit(1)
+        for directory in args.dir.strip().split(","):
+            if not os.path.exists(directory):
+                print_error("Directory %s does not exist. Quitting." % (directory, ))
+                sys.exit(1)
+            roots[get_pnfsid(directory)] = directory
+    if args.pnfsid:
+        for pnfsid in args.pnfsid.strip().split(","):
+            roots[pnfsid.upper()] = pnfsid.upper()
+
+    state_file = get_state_file(args.state_file, args.verify_only)
+    done = load_state(state_file)
+
+    progress = {}
+    units = {}
+    chimera_db = None
+    try:
+        chimera_db = create_connection(configuration.get("chimera_db"))
+        for root, name in roots.items():
+            if (root, ) in done:
+                print_message("%s already done, skipping" % (name, ))
+                continue
+            root_units = get_units(chimera_db, root, done)
+            if not root_units:
+                record_state(state_file, root)
+                print_message("%s already done, skipping" % (name, ))
+                continue
+            progress[root] = {"name": name,
+                              "pending": set(),
+                              "files": 0}
+            for unit in root_units:
+                units[(unit[0], unit[1])] = {"unit": unit,
+                                             "traversed": None,
+                                             "processed": 0}
+                progress[root]["pending"].add((unit[0], unit[1]))
+    finally:
+        if chimera_db:
+            chimera_db.close()
 
-#    pnfsid = get_pnfsid(args.dir)
-    pnfsid = '00008ACFB7F5ADB641ED8596422F49DA5D50'
+    print_message("**** Start processing %d roots, %d units ***" %
+                  (len(progress), len(units)))
+    t0 = time.time()
 
-    print_message("**** Start processing ***")
+    cpu_count = args.cpu_count
 
-    queue = multiprocessing.Queue(20000)
+    queues = [multiprocessing.Queue(args.queue_depth) for i in range(cpu_count)]
+    done_queue = multiprocessing.Queue()
+    unit_queue = multiprocessing.Queue()
+    aborted = multiprocessing.Event()
     workers = []
 
-    cpu_count = args.cpu_count
-
-    for i in range(cpu_count):
-        worker = SfaWorker(queue, configuration)
+    for queue in queues:
+        worker = SfaWorker(queue, done_queue, configuration)
         workers.append(worker)
         worker.start()
 
-    QUERY = """
-    WITH RECURSIVE paths(ino, path, pnfsid, fsize, ftype) AS (VALUES
-    (pnfsid2inumber(%s),'','', 0::BIGINT, 16384)
-    UNION SELECT i.inumber,
-		 path||'/'||d.iname,
-		 i.ipnfsid,
-		 i.isize,
-		 i.itype
-    FROM
-        t_dirs d, t_inodes i, paths p
-    WHERE p.ftype=16384 AND
-          d.iparent=p.ino AND
-	  d.iname != '.' AND
-          d.iname != '..' AND
-	  i.inumber=d.ichild)
-    SELECT p.ino,
-           p.path,
-    	   p.pnfsid,
-	   p.fsize,
-	   encode(l1.ifiledata,'escape') as bfid,
-           ts.istoragesubgroup as file_family
-    FROM paths p
-    LEFT OUTER JOIN t_level_1 l1 ON (p.ino = l1.inumber)
-    LEFT OUTER JOIN t_storageinfo ts ON (p.ino = ts.inumber)
-    WHERE p.ftype = 32768
-    """
-
-    chimera_db = cursor = None
-    try:
-        chimera_db =  create_connection(configuration.get("chimera_db"))
-        cursor = chimera_db.cursor("cursor_sfa",
-                                   cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(QUERY, (pnfsid, ))
-
-        total = 0
-        t0 = time.time()
-
-        while True:
-            res = cursor.fetchmany(10000)
-            if not res:
-                break
-            total += len(res)
-            for r in res:
-                queue.put(r)
-            print_message("Processing %d,  queue size %d "%(total, queue.qsize()))
-    finally:
-        for i in (cursor, chimera_db):
-            try:
-                if i:
-                    i.close()
-            except:
-                pass
-
-    for i in range(cpu_count):
-        queue.put(None)
+    traverser_count = max(1, min(args.traverser_count, len(units)))
+    traversers = []
+    for i in range(traverser_count):
+        traverser = Traverser(unit_queue, queues, done_queue, configuration,
+                              aborted)
+        traversers.append(traverser)
+        traverser.start()
+
+    #
+    # interleave units of different roots so that all roots
+    # progress concurrently
+    #
+    pending_units = [sorted(v["pending"]) for v in progress.values()]
+    while any(pending_units):
+        for root_units in pending_units:
+            if root_units:
+                unit_queue.put(units[root_units.pop(0)]["unit"])
+    for i in range(traverser_count):
+        unit_queue.put(None)
+
+    report = writer = None
+    categories = collections.Counter()
+    if args.verify_only:
+        report = open(args.report, "w")
+        writer = csv.writer(report)
+        writer.writerow(REPORT_HEADER)
+
+    last_report = time.time()
+    remaining = set(units.keys())
+    failed = []
+    while remaining:
+        failed = get_failed(workers, traversers)
+        if failed:
+            break
+        try:
+            kind, key, count, mismatches = done_queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            continue
+        unit = units[key]
+        if kind == "traversed":
+            unit["traversed"] = count
+        else:
+            unit["processed"] += count
+            progress[key[0]]["files"] += count
+            if writer and mismatches:
+                writer.writerows(mismatches)
+                categories.update(m[0] for m in mismatches)
+        if unit["traversed"] is not None and unit["processed"] >= unit["traversed"]:
+            remaining.discard(key)
+            root_progress = progress[key[0]]
+            root_progress["pending"].discard(key)
+            record_state(state_file, *key)
+            if not root_progress["pending"]:
+                record_state(state_file, key[0])
+                print_message("%s Done, %d files" % (root_progress["name"],
+                                                     root_progress["files"]))
+        if time.time() - last_report > 10:
+            last_report = time.time()
+            for root_progress in progress.values():
+                if root_progress["pending"]:
+                    print_message("%s processed %d files, %d subtrees to go" %
+                                  (root_progress["name"],
+                                   root_progress["files"],
+                                   len(root_progress["pending"])))
+
+    if not failed:
+        for traverser in traversers:
+            traverser.join()
+        for queue, worker in zip(queues, workers):
+            while worker.is_alive():
+                try:
+                    queue.put(None, timeout=POLL_INTERVAL)
+                    break
+                except Full:
+                    continue
+        for worker in workers:
+            worker.join()
+        failed = [p for p in workers + traversers if p.exitcode != 0]
+        if args.transport == "shm":
+            unlink_segments(get_segment_prefix())
+
+    if failed:
+        for process in failed:
+            print_error("%s exited with code %s" % (process.name,
+                                                    process.exitcode))
+        abort(workers + traversers, aborted)
+        if args.transport == "shm":
+            print_message("Unlinked %d unprocessed shared memory segments" %
+                          (unlink_segments(get_segment_prefix()), ))
+        if report:
+            report.close()
+        print_error("**** Aborted, %d units not complete ***" %
+                    (len(remaining), ))
+        sys.exit(1)
 
-    for worker in workers:
-        worker.join()
+    if report:
+        report.close()
+        print_message("Wrote report %s" % (args.report, ))
+        for category, count in sorted(categories.items()):
+            print_message("%s: %d" % (category, count))
+        if not categories:
+            print_message("No discrepancies found")
 
     print_message("**** FINISH ****")
     print_message("Took %d seconds" % (int(time.time()-t0+0.5),))
@@ -0,0 +1,300 @@
+"""
+Migration of one label list by several hosts. Labels are put into a
+work table in CTA database and each worker claims the next label with
+SELECT ... FOR UPDATE SKIP LOCKED. A claim is a lease that the host
+renews while it is alive, labels of a host that went away are claimed
+by other hosts when their lease expires. Such labels may have been
+migrated in part, they are completed with sync.sync_label.
+"""
+from __future__ import print_function
+import os
+import threading
+import time
+
+from enstore2cta.db import insert, insert_returning, open_connection, select
+from enstore2cta.migration import (HOSTNAME, STOPPER, Worker, bootstrap_cta,
+                                   label_result, update_cta_copy_counts)
+from enstore2cta.sync import sync_label
+from enstore2cta.util import QueueStats, print_error, print_message
+
+
+# arbitrary key of the advisory lock serializing bootstrap between hosts
+COORDINATOR_LOCK = 0x656e3263
+
+CREATE_WORK_TABLE = """
+create table if not exists enstore2cta_work (
+  label varchar(100) primary key,
+  status varchar(20) not null default 'pending',
+  owner varchar(255),
+  lease_expires timestamp with time zone,
+  attempts integer not null default 0,
+  files bigint,
+  errors bigint,
+  message text,
+  updated timestamp with time zone not null default now()
+)
+"""
+
+INSERT_WORK = """
+insert into enstore2cta_work (label)
+select label from unnest(%s::varchar[]) as l(label)
+on conflict do nothing
+"""
+
+#
+# next pending label or a label which lease has expired
+#
+CLAIM_LABEL = """
+update enstore2cta_work w
+   set status = 'claimed',
+       owner = %(owner)s,
+       lease_expires = now() + %(lease)s * interval '1 second',
+       attempts = w.attempts + 1,
+       updated = now()
+where w.label = (
+   select label from enstore2cta_work
+   where status = 'pending'
+         or (status = 'claimed' and lease_expires < now())
+   order by label
+   limit 1
+   for update skip locked)
+"""
+
+RENEW_LEASES = """
+update enstore2cta_work
+   set lease_expires = now() + %(lease)s * interval '1 second'
+where owner = %(owner)s and status = 'claimed'
+"""
+
+COMPLETE_LABEL = """
+update enstore2cta_work
+   set status = %(status)s,
+       files = %(files)s,
+       errors = %(errors)s,
+       message = %(message)s,
+       lease_expires = null,
+       updated = now()
+where label = %(label)s and owner = %(owner)s and status = 'claimed'
+"""
+
+RELEASE_LABELS = """
+update enstore2cta_work
+   set status = 'pending',
+       owner = null,
+       lease_expires = null,
+       updated = now()
+where owner = %s and status = 'claimed'
+"""
+
+SELECT_WORK_SUMMARY = """
+select status, count(*) as count from enstore2cta_work group by status
+"""
+
+
+def get_owner():
+    """
+    Identity of this host's migration run recorded in claims
+    """
+    return "%s:%d" % (HOSTNAME, os.getpid())
+
+
+def prepare(enstore_db, cta_db, labels, config, skip_bootstrap=False,
+            snapshot=None):
+    """
+    Bootstrap CTA objects and add labels to the work table. Hosts
+    serialize on an advisory lock so that only the first one creates
+    CTA objects, labels that are already in the work table are kept
+    as they are
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param cta_db: cta database connection
+    :type cta_db: Connection
+    :param labels: Enstore volume labels
+    :type labels: list
+    :param config: configuration
+    :type config: dict
+    :param skip_bootstrap: do not create CTA objects (--add)
+    :type skip_bootstrap: bool
+    :param snapshot: bootstrap from snapshot instead of Enstore DB
+    :type snapshot: snapshot.Snapshot
+    :return: number of labels added to the work table
+    :rtype: int
+    """
+    select(cta_db, "select pg_advisory_lock(%s)", (COORDINATOR_LOCK, ))
+    cta_db.commit()
+    try:
+        if not skip_bootstrap:
+            bootstrap_cta(enstore_db, cta_db, config, snapshot)
+        insert(cta_db, CREATE_WORK_TABLE)
+        added = insert(cta_db, INSERT_WORK, (labels, ))
+    finally:
+        select(cta_db, "select pg_advisory_unlock(%s)", (COORDINATOR_LOCK, ))
+        cta_db.commit()
+    print_message("Work table: %d labels added, %s" %
+                  (added, ", ".join(["%s %d" % (row["status"], row["count"])
+                                     for row in select(cta_db,
+                                                       SELECT_WORK_SUMMARY)])))
+    cta_db.commit()
+    return added
+
+
+class Heartbeat(threading.Thread):
+    """
+    Renews leases of all labels claimed by this host
+    """
+    def __init__(self, config, owner):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.config = config
+        self.owner = owner
+        self.lease = config.get("shard_lease", 300)
+        self.stopped = threading.Event()
+
+    def run(self):
+        cta_db = None
+        try:
+            cta_db = open_connection(self.config, "cta_db", "heartbeat")
+            while not self.stopped.wait(self.lease / 3.):
+                insert(cta_db, RENEW_LEASES, {"lease": self.lease,
+                                              "owner": self.owner})
+        except Exception as e:
+            print_error("Heartbeat failed, %s. Claims of this host will "
+                        "expire" % (str(e), ))
+        finally:
+            if cta_db:
+                cta_db.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class ShardWorker(Worker):
+    """
+    Worker that claims labels from the work table instead of a queue
+    """
+    def __init__(self, config, owner):
+        super(ShardWorker, self).__init__(None, config)
+        self.owner = owner
+        self.lease = config.get("shard_lease", 300)
+
+    def claim(self):
+        """
+        Claim next label
+
+        :return: label and number of times it was claimed, (None, 0)
+                 if there are no labels left
+        :rtype: tuple
+        """
+        row = insert_returning(self.cta_db, CLAIM_LABEL,
+                               {"owner": self.owner, "lease": self.lease})
+        return (row["label"], row["attempts"]) if row else (None, 0)
+
+    def do_label(self, label, attempts=1):
+        """
+        Migrate label. A label claimed before by a host that went away,
+        or which tape already exists, may be migrated in part; it is
+        completed with sync_label and failed if that does not succeed
+        """
+        t0 = time.time()
+        if attempts == 1:
+            result = super(ShardWorker, self).do_label(label)
+            if result["status"] != "exists":
+                return result
+        print_message("%s claimed %d times or tape exists, completing it" %
+                      (label, attempts))
+        result = sync_label(self.enstore, self.cta_db, self.chimera_db,
+                            label, self.config, self.added_copy_volumes,
+                            self.dimensions, complete=True)
+        if result["status"] in ("synced", "done"):
+            result["status"] = "done"
+        elif result["status"] != "failed":
+            result = label_result(label, "failed", result["files"],
+                                  "not completed, %s" % (result["status"], ))
+        result["seconds"] = time.time() - t0
+        return result
+
+    def complete(self, result):
+        done = insert(self.cta_db, COMPLETE_LABEL,
+                      {"status": result["status"],
+                       "files": result["files"],
+                       "errors": result["errors"],
+                       "message": result["message"],
+                       "label": result["label"],
+                       "owner": self.owner})
+        if not done:
+            print_error("%s lease was lost, label was claimed by another "
+                        "host" % (result["label"], ))
+
+    def run(self):
+        try:
+            self.connect()
+            stats = QueueStats("worker %s" % (self.name, ), "claim",
+                               self.config.get("telemetry_interval", 60))
+            while not os.path.exists(STOPPER):
+                t0 = time.time()
+                label, attempts = self.claim()
+                stats.waited(time.time() - t0)
+                if label is None:
+                    break
+                stats.report()
+                t0 = time.time()
+                result = self.process(label, attempts)
+                stats.worked(time.time() - t0)
+                self.complete(result)
+            stats.summary()
+        except Exception as e:
+            print_message("Exception %s" % (str(e)))
+        finally:
+            self.close()
+
+
+def migrate_shard(config, concurrency):
+    """
+    Migrate labels from the work table until there are none left
+    to claim. Can run on any number of hosts at the same time
+
+    :param config: migration configuration
+    :type config: dict
+    :param concurrency: number of worker processes on this host
+    :type concurrency: int
+    :return: results of labels migrated by this host, see label_result
+    :rtype: list
+    """
+    owner = get_owner()
+    print_message("Claiming labels as %s" % (owner, ))
+    heartbeat = Heartbeat(config, owner)
+    heartbeat.start()
+
+    workers = []
+    try:
+        for i in range(concurrency):
+            worker = ShardWorker(config, owner)
+            workers.append(worker)
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        heartbeat.stop()
+        #
+        # labels claimed by workers that died are given back
+        #
+        cta_db = open_connection(config, "cta_db")
+        try:
+            released = insert(cta_db, RELEASE_LABELS, (owner, ))
+            if released:
+                print_error("Released %d unfinished labels" % (released, ))
+            if not os.path.exists(STOPPER):
+                print_message("Finished file migration, bootstrapping "
+                              "tapes copies counts")
+                update_cta_copy_counts(cta_db)
+            results = select(cta_db,
+                             "select * from enstore2cta_work where owner = %s",
+                             (owner, ))
+        finally:
+            cta_db.close()
+    return [dict(label_result(row["label"], row["status"], row["files"] or 0,
+                              row["message"]),
+                 errors=row["errors"] or 0)
+            for row in results]
@@ -0,0 +1,443 @@
+"""
+Local snapshot of the Enstore metadata needed by the migration. The
+volume table and the file list of every volume are exported once with
+COPY TO and workers read them from local files instead of querying
+the production Enstore DB.
+
+Layout of snapshot directory::
+
+  snapshot.json        column names and types, time of export, VO,
+                       file family, library and media type combinations
+                       of active volumes
+  volume.tsv           volume rows
+  files/<label>.tsv    file rows of a volume, sorted by pnfs_id
+
+Files are in PostgreSQL COPY text format, not in a fixed width or
+binary layout: COPY TO writes it without a conversion pass, pnfs_id,
+bfid and path columns are variable length anyway, and the per-volume
+files sorted by pnfs_id are the index. A volume is read as a plain
+buffered stream line by line, workers share the files through the page
+cache; what is saved is the query on Enstore DB, parsing the lines
+costs little next to it. VolumeCache
+keeps file lists of volumes in the same format and exports them again
+when a volume changes.
+"""
+from __future__ import print_function
+import datetime
+import decimal
+import errno
+import hashlib
+import json
+import os
+import re
+import time
+
+from enstore2cta.db import select
+from enstore2cta.util import print_message
+
+
+#
+# same rows as migration.SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY for
+# many volumes, prefixed by label of the volume
+#
+SELECT_SNAPSHOT_FILES = """
+select v.label as snapshot_label,
+       f.*,
+       v.storage_group||'.'||v.file_family||'@cta' as storage_class,
+       v.wrapper as original_wrapper,
+       f1.bfid as copy_bfid,
+       f1.location_cookie as copy_location_cookie,
+       f1.deleted as copy_deleted,
+       v1.*
+from file f
+inner join volume v on v.id = f.volume
+left outer join file_copies_map fcm on fcm.bfid = f.bfid
+left outer join file f1 on f1.bfid = fcm.alt_bfid
+left outer join volume v1 on v1.id = f1.volume
+  where
+        v.media_type = any(%(media_types)s)
+        and v.system_inhibit_0 = 'none'
+        and v.label = any(%(labels)s)
+        and v.active_files > 0
+        and (f1.deleted is null or f1.deleted = 'n')
+        and f.deleted = 'n'
+        order by v.label, f.pnfs_id
+"""
+
+SELECT_SNAPSHOT_VOLUMES = """
+select * from volume where label = any(%s)
+"""
+
+#
+# same rows as migration.SELECT_ENSTORE_COMBINATIONS, bootstrap of CTA
+# objects is derived from them
+#
+SELECT_SNAPSHOT_COMBINATIONS = """
+select distinct storage_group, file_family, library, media_type
+from volume
+  where active_files>0
+        and system_inhibit_0 = 'none'
+        and library not like 'shelf%'
+"""
+
+METADATA = "snapshot.json"
+
+TIMESTAMP = re.compile(r"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(\.\d+)?")
+
+ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+
+def unescape(value):
+    return re.sub(r"\\(.)", lambda m: ESCAPES.get(m.group(1), m.group(1)),
+                  value)
+
+
+def escape(value):
+    """
+    Value in COPY text format
+    """
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace(
+        "\n", "\\n").replace("\r", "\\r")
+
+
+def to_bool(value):
+    return value == "t"
+
+
+def to_numeric(value):
+    return decimal.Decimal(value) if "." in value else int(value)
+
+
+def to_timestamp(value):
+    # time zone offset of timestamptz is dropped, the wall clock time in
+    # session time zone is kept like in datetime.timetuple() of psycopg2
+    seconds, fraction = TIMESTAMP.match(value).groups()
+    result = datetime.datetime.strptime(seconds, "%Y-%m-%d %H:%M:%S")
+    if fraction:
+        result = result.replace(microsecond=int(fraction[1:7].ljust(6, "0")))
+    return result
+
+
+def to_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+# PostgreSQL type oid -> converter from COPY text format
+CONVERTERS = {
+    16: to_bool,
+    20: int,
+    21: int,
+    23: int,
+    26: int,
+    700: float,
+    701: float,
+    1082: to_date,
+    1114: to_timestamp,
+    1184: to_timestamp,
+    1700: to_numeric,
+}
+
+
+def parse_row(line, columns):
+    """
+    Convert line in COPY text format to dictionary. Like RealDictCursor
+    the last of duplicate column names wins
+    """
+    row = {}
+    for (name, converter), value in zip(columns, line.split("\t")):
+        if value == "\\N":
+            row[name] = None
+            continue
+        if "\\" in value:
+            value = unescape(value)
+        row[name] = converter(value)
+    return row
+
+
+def read_rows(path, columns):
+    """
+    Read file in COPY text format line by line and convert its lines to
+    dictionaries, see the module docstring for why the format is text.
+    COPY escapes newlines in values, so a line is a row. Missing file
+    has no rows
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8", newline="\n") as f:
+        return [parse_row(line.rstrip("\n"), columns) for line in f]
+
+
+def describe(cursor, sql, pars):
+    cursor.execute("select * from (%s) as q limit 0" % (sql, ), pars)
+    return [(column.name, column.type_code) for column in cursor.description]
+
+
+class VolumeSplitter(object):
+    """
+    File-like object receiving COPY output sorted by label, writes
+    rows of each label to its own file without the label column
+    """
+    def __init__(self, directory, suffix=".tsv"):
+        self.directory = directory
+        self.suffix = suffix
+        self.label = None
+        self.out = None
+        self.rest = b""
+        self.volumes = 0
+        self.rows = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        lines = (self.rest + data).split(b"\n")
+        self.rest = lines.pop()
+        for line in lines:
+            label, row = line.split(b"\t", 1)
+            if label != self.label:
+                self.close()
+                self.label = label
+                self.out = open(os.path.join(self.directory,
+                                             label.decode("utf-8") + self.suffix),
+                                "wb")
+                self.volumes += 1
+            self.out.write(row + b"\n")
+            self.rows += 1
+
+    def close(self):
+        if self.out:
+            self.out.close()
+            self.out = None
+
+
+def export_snapshot(enstore_db, directory, labels, media_types):
+    """
+    Export volume rows and file lists of labels from Enstore DB into
+    directory. Export runs in one repeatable read transaction
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+    :param directory: snapshot directory, created if it does not exist
+    :type directory: str
+    :param labels: Enstore volume labels
+    :type labels: list
+    :param media_types: Enstore media types to migrate
+    :type media_types: list
+    :return: number of volumes with files and number of files exported
+    :rtype: tuple
+    """
+    t0 = time.time()
+    files_directory = os.path.join(directory, "files")
+    if not os.path.exists(files_directory):
+        os.makedirs(files_directory)
+    for name in os.listdir(files_directory):
+        os.unlink(os.path.join(files_directory, name))
+    metadata = os.path.join(directory, METADATA)
+    if os.path.exists(metadata):
+        os.unlink(metadata)
+
+    enstore_db.rollback()
+    enstore_db.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cursor = None
+    splitter = VolumeSplitter(files_directory)
+    pars = {"labels": labels, "media_types": media_types}
+    try:
+        combinations = [dict(row) for row in
+                        select(enstore_db, SELECT_SNAPSHOT_COMBINATIONS)]
+        cursor = enstore_db.cursor()
+        volume_columns = describe(cursor, SELECT_SNAPSHOT_VOLUMES, (labels, ))
+        file_columns = describe(cursor, SELECT_SNAPSHOT_FILES, pars)[1:]
+        with open(os.path.join(directory, "volume.tsv"), "wb") as f:
+            cursor.copy_expert("copy (%s) to stdout" %
+                               (cursor.mogrify(SELECT_SNAPSHOT_VOLUMES,
+                                               (labels, )).decode("utf-8"), ),
+                               f)
+        cursor.copy_expert("copy (%s) to stdout" %
+                           (cursor.mogrify(SELECT_SNAPSHOT_FILES,
+                                           pars).decode("utf-8"), ),
+                           splitter)
+    finally:
+        splitter.close()
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        enstore_db.rollback()
+        enstore_db.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+
+    with open(metadata, "w") as f:
+        json.dump({"exported": int(t0),
+                   "volume": volume_columns,
+                   "file": file_columns,
+                   "combinations": combinations}, f)
+    print_message("Exported %d volumes, %d files to %s in %d seconds" %
+                  (splitter.volumes, splitter.rows, directory,
+                   int(time.time() - t0 + 0.5)))
+    return splitter.volumes, splitter.rows
+
+
+class Snapshot(object):
+    """
+    Reads Enstore volumes and their files from a snapshot directory,
+    same interface as migration.EnstoreReader
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, METADATA), "r") as f:
+            metadata = json.load(f)
+        self.exported = metadata["exported"]
+        self.combinations = metadata.get("combinations")
+        self.volume_columns = [(name, CONVERTERS.get(oid, str))
+                               for name, oid in metadata["volume"]]
+        self.file_columns = [(name, CONVERTERS.get(oid, str))
+                             for name, oid in metadata["file"]]
+        self.volumes = None
+
+    def get_volume(self, label):
+        """
+        Volume row of label or None
+        """
+        return self.load_volumes().get(label)
+
+    def load_volumes(self):
+        """
+        Volume rows of the snapshot by label
+        """
+        if self.volumes is None:
+            self.volumes = {}
+            with open(os.path.join(self.directory, "volume.tsv"), "r") as f:
+                for line in f:
+                    row = parse_row(line.rstrip("\n"), self.volume_columns)
+                    self.volumes[row["label"]] = row
+        return self.volumes
+
+    def get_volumes(self):
+        """
+        All volume rows of the snapshot sorted by label
+        """
+        volumes = self.load_volumes()
+        return [volumes[label] for label in sorted(volumes)]
+
+    def get_combinations(self):
+        """
+        Rows of migration.SELECT_ENSTORE_COMBINATIONS at time of export
+        """
+        if self.combinations is None:
+            raise ValueError("snapshot %s has no volume combinations, "
+                             "export it again" % (self.directory, ))
+        return self.combinations
+
+    def get_files(self, label):
+        """
+        File rows of label sorted by pnfs_id
+        """
+        return read_rows(os.path.join(self.directory, "files", label + ".tsv"),
+                         self.file_columns)
+
+
+SELECT_VOLUME = """
+select * from volume where label = %s
+"""
+
+
+def get_fingerprint(enstore_volume):
+    """
+    Fingerprint of volume row that changes when files on the volume change
+    """
+    return hashlib.sha1(("%s|%s|%s|%s" %
+                         (enstore_volume["active_files"],
+                          enstore_volume["active_bytes"],
+                          enstore_volume["eod_cookie"],
+                          enstore_volume["last_access"])).encode("utf-8")
+                        ).hexdigest()[:16]
+
+
+class VolumeCache(object):
+    """
+    Reads Enstore volumes from Enstore DB and their files from
+    a local cache directory, same interface as migration.EnstoreReader.
+    File list of a volume is cached as <label>.<fingerprint>.tsv, files
+    of a volume that changed since it was cached are exported again
+    """
+    def __init__(self, directory, enstore_db, media_types):
+        self.directory = directory
+        self.enstore_db = enstore_db
+        self.media_types = media_types
+        self.file_columns = None
+        self.fingerprints = {}
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def get_volume(self, label):
+        """
+        Volume row of label or None
+        """
+        volumes = select(self.enstore_db, SELECT_VOLUME, (label, ))
+        if not volumes:
+            return None
+        self.fingerprints[label] = get_fingerprint(volumes[0])
+        return volumes[0]
+
+    def load_columns(self):
+        path = os.path.join(self.directory, METADATA)
+        if not os.path.exists(path):
+            cursor = self.enstore_db.cursor()
+            try:
+                columns = describe(cursor, SELECT_SNAPSHOT_FILES,
+                                   {"labels": [],
+                                    "media_types": self.media_types})[1:]
+            finally:
+                cursor.close()
+                self.enstore_db.rollback()
+            tmp = "%s.%d" % (path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"exported": int(time.time()), "file": columns}, f)
+            os.rename(tmp, path)
+        with open(path, "r") as f:
+            self.file_columns = [(name, CONVERTERS.get(oid, str))
+                                 for name, oid in json.load(f)["file"]]
+
+    def get_files(self, label):
+        """
+        File rows of label sorted by pnfs_id
+        """
+        if self.file_columns is None:
+            self.load_columns()
+        if label not in self.fingerprints:
+            self.get_volume(label)
+        fingerprint = self.fingerprints.pop(label, None)
+        path = os.path.join(self.directory, "%s.%s.tsv" % (label, fingerprint))
+        if os.path.exists(path):
+            self.hits += 1
+            return read_rows(path, self.file_columns)
+
+        self.misses += 1
+        for name in os.listdir(self.directory):
+            if name.startswith(label + ".") and name.endswith(".tsv"):
+                os.unlink(os.path.join(self.directory, name))
+        suffix = ".%s.tsv.%d" % (fingerprint, os.getpid())
+        splitter = VolumeSplitter(self.directory, suffix)
+        cursor = self.enstore_db.cursor()
+        try:
+            pars = {"labels": [label], "media_types": self.media_types}
+            cursor.copy_expert("copy (%s) to stdout" %
+                               (cursor.mogrify(SELECT_SNAPSHOT_FILES,
+                                               pars).decode("utf-8"), ),
+                               splitter)
+        finally:
+            splitter.close()
+            cursor.close()
+            self.enstore_db.rollback()
+        tmp = os.path.join(self.directory, label + suffix)
+        if not os.path.exists(tmp):
+            open(tmp, "w").close()
+        os.rename(tmp, path)
+        return read_rows(path, self.file_columns)
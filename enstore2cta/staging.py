@@ -0,0 +1,469 @@
+"""
+Staged migration. Workers stage tape, archive_file and tape_file rows
+of their labels into UNLOGGED staging tables, one set per worker and
+run, so the hot path writes no WAL and checks no constraints. When all
+labels are staged each set is merged into tape, archive_file and
+tape_file with a few set based statements in one transaction. Duplicate
+pnfsids, already in CTA or staged more than once, are found with one
+query per pair and reported together instead of failing file by file.
+Chimera locations of merged files are inserted after the merge.
+"""
+from __future__ import print_function
+import io
+import os
+import re
+import time
+
+import psycopg2
+import psycopg2.extras
+
+from enstore2cta.db import open_connection, select, update
+from enstore2cta.migration import (INSERT_CHIMERA_LOCATIONS, INSERT_CTA_TAPE,
+                                   SELECT_ARCHIVE_FILE_IDS, STOPPER, Worker,
+                                   archive_file_values, check_dimensions,
+                                   cta_tape_values, insert_copy_tapes,
+                                   label_result,
+                                   migrate_labels, skip_duplicates,
+                                   tape_file_copy_values, tape_file_values,
+                                   update_cta_copy_counts)
+from enstore2cta.snapshot import escape
+from enstore2cta.util import print_error, print_message
+
+
+PREFIX = "enstore2cta_stage_"
+
+CREATE_STAGE_ARCHIVE_FILE = """
+create unlogged table if not exists {0}_archive_file (
+  label varchar(100) not null,
+  duplicate boolean not null default false,
+  like archive_file
+)
+"""
+
+CREATE_STAGE_TAPE = """
+create unlogged table if not exists {0}_tape (
+  label varchar(100) not null,
+  like tape including defaults
+)
+"""
+
+CREATE_STAGE_TAPE_FILE = """
+create unlogged table if not exists {0}_tape_file (
+  like tape_file
+)
+"""
+
+ARCHIVE_FILE_COLUMNS = ("label",
+                        "archive_file_id",
+                        "disk_instance_name",
+                        "disk_file_id",
+                        "disk_file_uid",
+                        "disk_file_gid",
+                        "size_in_bytes",
+                        "checksum_adler32",
+                        "storage_class_id",
+                        "creation_time",
+                        "reconciliation_time",
+                        "is_deleted")
+
+TAPE_FILE_COLUMNS = ("vid",
+                     "fseq",
+                     "block_id",
+                     "logical_size_in_bytes",
+                     "copy_nb",
+                     "creation_time",
+                     "archive_file_id")
+
+#
+# INSERT_CTA_TAPE into staging table, with label in front
+#
+STAGE_TAPE = INSERT_CTA_TAPE.replace(
+    "insert into tape (", "insert into {0}_tape (label, ", 1).replace(
+    "values (", "values (%s, ", 1)
+
+SELECT_TAPE = """
+select vid from tape where vid = %s
+"""
+
+SELECT_STAGING_TABLES = """
+select substr(tablename, 1, length(tablename) - length('_archive_file')) as name
+from pg_tables
+  where tablename like 'enstore2cta\\_stage\\_%\\_archive\\_file'
+order by tablename
+"""
+
+#
+# pnfsids already in CTA or staged more than once, the row with
+# the smallest archive_file_id of the latter is kept
+#
+MARK_DUPLICATES = """
+update {0}_archive_file s set duplicate = true
+from (select archive_file_id,
+             row_number() over (partition by disk_instance_name, disk_file_id
+                                order by archive_file_id) as n
+      from {0}_archive_file) d
+where d.archive_file_id = s.archive_file_id
+  and (d.n > 1
+       or exists (select 1 from archive_file af
+                  where af.disk_instance_name = s.disk_instance_name
+                    and af.disk_file_id = s.disk_file_id))
+returning s.label, s.disk_file_id
+"""
+
+MERGE_TAPES = """
+insert into tape ({1})
+select {1} from {0}_tape
+"""
+
+MERGE_ARCHIVE_FILES = """
+insert into archive_file ({1})
+select {1} from {0}_archive_file
+where not duplicate
+"""
+
+MERGE_TAPE_FILES = """
+insert into tape_file ({1})
+select {2} from {0}_tape_file t
+inner join {0}_archive_file s on s.archive_file_id = t.archive_file_id
+where not s.duplicate
+"""
+
+SELECT_STAGED_LABELS = """
+select label from {0}_tape
+union
+select label from {0}_archive_file
+"""
+
+SELECT_MERGED = """
+select label, disk_file_id, archive_file_id from {0}_archive_file
+where not duplicate
+order by label
+"""
+
+DROP_STAGING_TABLES = """
+drop table if exists {0}_tape_file, {0}_archive_file, {0}_tape
+"""
+
+
+def get_run_prefix(run):
+    """
+    Prefix of staging tables of all workers of run
+    """
+    return "%s%s_" % (PREFIX, run)
+
+
+def get_staging_table(run, name):
+    """
+    Prefix of staging tables of worker of run, so that rows left by an
+    interrupted run never end up in staging tables of another one
+
+    :param run: id of run, pid of the process running stage_labels
+    :type run: int
+    :param name: worker name
+    :type name: str
+    :return: prefix of staging tables
+    :rtype: str
+    """
+    return get_run_prefix(run) + re.sub(r"\W", "_", name).lower()
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    COPY rows into table
+    """
+    data = io.StringIO()
+    for row in rows:
+        data.write("\t".join([escape(value) for value in row]) + "\n")
+    data.seek(0)
+    cursor.copy_expert("copy %s (%s) from stdin" % (table, ", ".join(columns)),
+                       data)
+
+
+def stage_label(enstore, cta_db, label, config, added_copy_volumes,
+                dimensions, table):
+    """
+    Stage CTA tape of Enstore volume and COPY its files into staging
+    tables in one transaction, the tape is inserted into CTA when the
+    staging tables are merged. Arguments are the same as of
+    migration.migrate_label
+
+    :param table: prefix of staging tables
+    :type table: str
+    :return: result, see migration.label_result, status is staged
+    :rtype: dict
+    """
+    print_message("Staging label %s" % (label, ))
+    enstore_volume = enstore.get_volume(label)
+    if not enstore_volume:
+        print_error("No such volume %s" % (label, ))
+        return label_result(label, "failed", message="no such volume")
+    try:
+        check_dimensions(enstore_volume, config, dimensions)
+        tape_values = cta_tape_values(enstore_volume, config, dimensions)
+    except KeyError as e:
+        print_error("Failed to insert tape label %s, %s" % (label, e.args[0],))
+        return label_result(label, "failed", message=e.args[0])
+    exists = select(cta_db, SELECT_TAPE, (label[:6], ))
+    cta_db.rollback()
+    if exists:
+        print_error(f"{label} Done, aleady exists, skipping")
+        return label_result(label, "exists")
+    result = label_result(label, "staged")
+    files = skip_duplicates(enstore.get_files(label), label, config, result)
+    result["files"] = len(files)
+    if files:
+        insert_copy_tapes(cta_db, label, files, config, added_copy_volumes,
+                          dimensions, result)
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        cursor.execute(STAGE_TAPE.format(table), (label, ) + tape_values)
+        if files:
+            cursor.execute(SELECT_ARCHIVE_FILE_IDS, (len(files), ))
+            ids = [row[0] for row in cursor.fetchall()]
+            copy_rows(cursor, table + "_archive_file", ARCHIVE_FILE_COLUMNS,
+                      [(label, archive_file_id) +
+                       archive_file_values(f, config, dimensions)
+                       for f, archive_file_id in zip(files, ids)])
+            tape_files = [tape_file_values(f, label[:6], archive_file_id)
+                          for f, archive_file_id in zip(files, ids)]
+            tape_files += [tape_file_copy_values(f, archive_file_id)
+                           for f, archive_file_id in zip(files, ids)
+                           if f.get("label") and f["copy_deleted"] == "n"]
+            copy_rows(cursor, table + "_tape_file", TAPE_FILE_COLUMNS,
+                      tape_files)
+        cta_db.commit()
+    except (psycopg2.Error, KeyError) as e:
+        cta_db.rollback()
+        print_error("%s failed to stage files, %s" % (label, str(e).strip(), ))
+        return label_result(label, "failed", len(files), str(e).strip())
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+    print_message("%s Staged, %d files" % (label, len(files), ))
+    return result
+
+
+class StagingWorker(Worker):
+    """
+    Worker that stages labels into its own staging tables, named
+    after the run (configuration staging_run) and the worker
+    """
+    def connect(self):
+        super(StagingWorker, self).connect()
+        self.table = get_staging_table(self.config["staging_run"], self.name)
+        cursor = self.cta_db.cursor()
+        try:
+            cursor.execute(CREATE_STAGE_TAPE.format(self.table))
+            cursor.execute(CREATE_STAGE_ARCHIVE_FILE.format(self.table))
+            cursor.execute(CREATE_STAGE_TAPE_FILE.format(self.table))
+            self.cta_db.commit()
+        finally:
+            cursor.close()
+
+    def do_label(self, label):
+        t0 = time.time()
+        result = stage_label(self.enstore, self.cta_db, label, self.config,
+                             self.added_copy_volumes, self.dimensions,
+                             self.table)
+        result["seconds"] = time.time() - t0
+        return result
+
+
+def merge_table(cta_db, chimera_db, table, config):
+    """
+    Merge staging tables into tape, archive_file and tape_file in one
+    transaction, insert chimera locations of merged files and drop
+    staging tables
+
+    :return: dictionary label -> counters (errors, locations_inserted,
+             locations_skipped) and message if merge failed
+    :rtype: dict
+    """
+    t0 = time.time()
+    stats = {}
+
+    def counters(label):
+        return stats.setdefault(label, {"errors": 0,
+                                        "locations_inserted": 0,
+                                        "locations_skipped": 0,
+                                        "message": None})
+
+    archive_file_columns = ", ".join(ARCHIVE_FILE_COLUMNS[1:])
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        cursor.execute("analyze %s_archive_file" % (table, ))
+        cursor.execute("analyze %s_tape_file" % (table, ))
+        cursor.execute(MARK_DUPLICATES.format(table))
+        duplicates = cursor.fetchall()
+        cursor.execute("select * from %s_tape limit 0" % (table, ))
+        tape_columns = ", ".join([column[0] for column in cursor.description
+                                  if column[0] != "label"])
+        cursor.execute(MERGE_TAPES.format(table, tape_columns))
+        tapes = cursor.rowcount
+        cursor.execute(MERGE_ARCHIVE_FILES.format(table, archive_file_columns))
+        archive_files = cursor.rowcount
+        cursor.execute(MERGE_TAPE_FILES.format(
+            table,
+            ", ".join(TAPE_FILE_COLUMNS),
+            ", ".join(["t." + i for i in TAPE_FILE_COLUMNS])))
+        tape_files = cursor.rowcount
+        cursor.execute(SELECT_MERGED.format(table))
+        merged = cursor.fetchall()
+        cta_db.commit()
+    except psycopg2.Error as e:
+        cta_db.rollback()
+        print_error("Failed to merge %s, %s. Staging tables are kept" %
+                    (table, str(e).strip()))
+        for row in select(cta_db, SELECT_STAGED_LABELS.format(table)):
+            counters(row["label"])["message"] = "merge failed, %s" % (
+                str(e).strip(), )
+        cta_db.rollback()
+        return stats
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    for label, pnfs_id in duplicates:
+        counters(label)["errors"] += 1
+        print_error("%s, failed to insert archive_file, multiple pnfsid, "
+                    "skipping %s" % (label, pnfs_id, ))
+    print_message("Merged %s, %d tapes, %d archive files, %d tape files, "
+                  "%d duplicate pnfsids in %d seconds" %
+                  (table, tapes, archive_files, tape_files, len(duplicates),
+                   int(time.time() - t0 + 0.5)))
+
+    if not config["skip_locations"]:
+        locations = {}
+        for label, pnfs_id, archive_file_id in merged:
+            locations.setdefault(label, []).append(
+                ("cta://cta/%s?archiveid=%d" % (pnfs_id, archive_file_id),
+                 pnfs_id))
+        for label, values in locations.items():
+            cursor = None
+            try:
+                cursor = chimera_db.cursor()
+                psycopg2.extras.execute_values(cursor,
+                                               INSERT_CHIMERA_LOCATIONS,
+                                               values,
+                                               page_size=len(values))
+                inserted = cursor.rowcount
+                chimera_db.commit()
+                counters(label)["locations_inserted"] += inserted
+                counters(label)["locations_skipped"] += len(values) - inserted
+            except psycopg2.Error as e:
+                chimera_db.rollback()
+                counters(label)["errors"] += len(values)
+                print_error("%s failed to insert %d locations into chimera "
+                            "DB, %s" % (label, len(values), str(e).strip()))
+            finally:
+                if cursor:
+                    try:
+                        cursor.close()
+                    except Exception:
+                        pass
+
+    cursor = cta_db.cursor()
+    try:
+        cursor.execute(DROP_STAGING_TABLES.format(table))
+        cta_db.commit()
+    finally:
+        cursor.close()
+    return stats
+
+
+def drop_staging(config):
+    """
+    Drop staging tables left by interrupted or failed runs. Their tapes
+    were not merged, so their labels are staged again by this run
+
+    :param config: migration configuration
+    :type config: dict
+    :return: no value
+    :rtype: none
+    """
+    cta_db = open_connection(config, "cta_db", "merge")
+    try:
+        for row in select(cta_db, SELECT_STAGING_TABLES):
+            print_message("Dropping staging tables %s left by previous run" %
+                          (row["name"], ))
+            update(cta_db, DROP_STAGING_TABLES.format(row["name"]))
+        cta_db.rollback()
+    finally:
+        cta_db.close()
+
+
+def merge_staging(config):
+    """
+    Merge staging tables of this run (configuration staging_run),
+    one set of staging tables at a time
+
+    :param config: migration configuration
+    :type config: dict
+    :return: dictionary label -> counters, see merge_table
+    :rtype: dict
+    """
+    cta_db = open_connection(config, "cta_db", "merge")
+    chimera_db = None
+    if not config["skip_locations"]:
+        chimera_db = open_connection(config, "chimera_db", "merge")
+    prefix = get_run_prefix(config["staging_run"])
+    stats = {}
+    try:
+        tables = [row["name"] for row in select(cta_db, SELECT_STAGING_TABLES)
+                  if row["name"].startswith(prefix)]
+        cta_db.rollback()
+        for table in tables:
+            stats.update(merge_table(cta_db, chimera_db, table, config))
+    finally:
+        for i in (cta_db, chimera_db):
+            if i:
+                i.close()
+    return stats
+
+
+def stage_labels(labels, config, concurrency=None):
+    """
+    Same as migration.migrate_labels, but files are staged by workers
+    and merged into CTA when all labels are staged
+
+    :return: one result per label, see migration.label_result
+    :rtype: list
+    """
+    config = dict(config)
+    config.setdefault("skip_locations", False)
+    config["staging_run"] = os.getpid()
+    drop_staging(config)
+    results = migrate_labels(labels, config, concurrency,
+                             update_copy_counts=False,
+                             worker_class=StagingWorker)
+    stats = merge_staging(config)
+    for result in results:
+        label_stats = stats.get(result["label"])
+        if result["status"] != "staged" or not label_stats:
+            if result["status"] == "staged":
+                result["status"] = "done"
+            continue
+        if label_stats["message"]:
+            result["status"] = "failed"
+            result["message"] = label_stats["message"]
+            continue
+        result["status"] = "done"
+        for key in ("errors", "locations_inserted", "locations_skipped"):
+            result[key] += label_stats[key]
+
+    if not os.path.exists(STOPPER):
+        print_message("Finished file migration, bootstrapping tapes copies counts")
+        cta_db = open_connection(config, "cta_db")
+        try:
+            update_cta_copy_counts(cta_db)
+        finally:
+            cta_db.close()
+    return results
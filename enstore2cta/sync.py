@@ -0,0 +1,295 @@
+"""
+Incremental sync of volumes that changed in Enstore after they were
+migrated. For a label already in CTA the active Enstore files are
+compared with CTA as sets and only the difference is applied: new
+files are added, files deleted in Enstore are removed and missing
+copies are added, in one CTA transaction per label. Labels not yet in
+CTA are migrated as usual.
+"""
+from __future__ import print_function
+import getpass
+import time
+
+import psycopg2.extras
+
+from enstore2cta.db import select
+from enstore2cta.migration import (ARCHIVE_FILE_TEMPLATE, HOSTNAME,
+                                   INSERT_ARCHIVE_FILES,
+                                   INSERT_CHIMERA_LOCATIONS, INSERT_TAPE_FILES,
+                                   Worker, archive_file_values, extract_eod,
+                                   insert_copy_tapes, label_result,
+                                   migrate_label, migrate_labels,
+                                   skip_duplicates, tape_file_copy_values,
+                                   tape_file_values)
+from enstore2cta.util import print_error, print_message
+from enstore2cta.verify import get_actual
+
+
+#
+# all active primary files of the volume whatever the volume inhibits
+# and the state of their copies are, deleted copies included. Rows
+# with an active copy come last so that they win when a file has
+# more than one copy
+#
+SELECT_SYNC_FILES = """
+select f.*,
+       v.storage_group||'.'||v.file_family||'@cta' as storage_class,
+       v.wrapper as original_wrapper,
+       f1.bfid as copy_bfid,
+       f1.location_cookie as copy_location_cookie,
+       f1.deleted as copy_deleted,
+       v1.*
+from file f
+inner join volume v on v.id = f.volume
+left outer join file_copies_map fcm on fcm.bfid = f.bfid
+left outer join file f1 on f1.bfid = fcm.alt_bfid
+left outer join volume v1 on v1.id = f1.volume
+  where v.label = %s
+        and f.deleted = 'n'
+        order by f.pnfs_id, f1.deleted desc
+"""
+
+DELETE_TAPE_FILES = """
+delete from tape_file where archive_file_id = any(%s)
+"""
+
+DELETE_COPY_TAPE_FILES = """
+delete from tape_file where archive_file_id = any(%s) and copy_nb > 1
+"""
+
+DELETE_ARCHIVE_FILES = """
+delete from archive_file where archive_file_id = any(%s)
+"""
+
+UPDATE_TAPE = """
+update tape
+   set data_in_bytes = %(active_bytes)s,
+       master_data_in_bytes = %(active_bytes)s,
+       nb_master_files = %(active_files)s,
+       last_fseq = %(last_fseq)s,
+       last_update_user_name = %(user)s,
+       last_update_host_name = %(host)s,
+       last_update_time = %(time)s
+where vid = %(vid)s
+"""
+
+DELETE_CHIMERA_LOCATIONS = """
+delete from t_locationinfo where itype = 0 and ilocation = any(%s)
+"""
+
+
+def get_location(pnfs_id, archive_file_id):
+    return "cta://cta/%s?archiveid=%d" % (pnfs_id, archive_file_id)
+
+
+def get_delta(files, present, actual):
+    """
+    Changes to apply to CTA to bring it in line with Enstore volume
+
+    :param files: Enstore files to migrate by pnfs_id
+    :type files: dict
+    :param present: pnfs_ids of all active primary files of the volume,
+                    including those skipped as duplicates
+    :type present: set
+    :param actual: CTA state of the volume, see verify.get_actual
+    :type actual: dict
+    :return: new files, (pnfs_id, archive_file_id) of deleted files,
+             tape_file values of new copies and archive_file_ids of
+             deleted copies
+    :rtype: tuple
+    """
+    # like migration, files which copy was deleted are not added
+    new = [f for pnfs_id, f in files.items()
+           if pnfs_id not in actual and f["copy_deleted"] != "y"]
+    deleted = [(pnfs_id, actual[pnfs_id][4]) for pnfs_id in actual
+               if pnfs_id not in present]
+    new_copies = [tape_file_copy_values(f, actual[pnfs_id][4])
+                  for pnfs_id, f in files.items()
+                  if pnfs_id in actual and not actual[pnfs_id][3]
+                  and f.get("label") and f["copy_deleted"] == "n"]
+    deleted_copies = [actual[pnfs_id][4] for pnfs_id, f in files.items()
+                      if pnfs_id in actual and actual[pnfs_id][3]
+                      and f["copy_deleted"] == "y"]
+    return new, deleted, new_copies, deleted_copies
+
+
+def sync_label(enstore, cta_db, chimera_db, label, config,
+               added_copy_volumes, dimensions, complete=False):
+    """
+    Apply changes of Enstore volume to CTA and chimera, migrate it if
+    it is not in CTA yet. Arguments are the same as of
+    migration.migrate_label. With complete chimera locations of all
+    files of the tape are inserted, not only those of added files, to
+    finish a label a migration left half done
+
+    Deletions are decided from the primary files of the volume only,
+    with a query of its own: a deleted copy removes the copy tape file
+    and never the archive file. Volumes not accessible in Enstore
+    (system_inhibit_0 other than none) are not synced.
+
+    :return: result, see migration.label_result, with files_added,
+             files_deleted, copies_added and copies_deleted counters
+    :rtype: dict
+    """
+    if not select(cta_db, "select vid from tape where vid = %s", (label[:6], )):
+        cta_db.rollback()
+        return migrate_label(enstore, cta_db, chimera_db, label, config,
+                             added_copy_volumes, dimensions)
+
+    print_message("Syncing label %s" % (label, ))
+    enstore_volume = enstore.get_volume(label)
+    if not enstore_volume:
+        print_error("No such volume %s" % (label, ))
+        return label_result(label, "failed", message="no such volume")
+    if enstore_volume["system_inhibit_0"] != "none":
+        print_error("%s is %s in Enstore, not syncing" %
+                    (label, enstore_volume["system_inhibit_0"]))
+        return label_result(label, "failed",
+                            message="volume is %s" %
+                            (enstore_volume["system_inhibit_0"], ))
+    enstore_db = getattr(enstore, "enstore_db", None)
+    if enstore_db is None:
+        print_error("%s can not be synced from a snapshot" % (label, ))
+        return label_result(label, "failed",
+                            message="sync requires Enstore DB")
+    result = label_result(label, "synced")
+    enstore_files = list(dict((f["pnfs_id"], f) for f in
+                              select(enstore_db, SELECT_SYNC_FILES,
+                                     (label, ))).values())
+    enstore_db.rollback()
+    # files skipped as duplicates are not deleted if already in CTA
+    present = set([f["pnfs_id"] for f in enstore_files])
+    files = dict((f["pnfs_id"], f)
+                 for f in skip_duplicates(enstore_files, label, config,
+                                          result))
+    actual = get_actual(cta_db, label)
+    cta_db.rollback()
+
+    new, deleted, new_copies, deleted_copies = get_delta(files, present,
+                                                         actual)
+
+    result.update({"files": len(files),
+                   "files_added": len(new),
+                   "files_deleted": len(deleted),
+                   "copies_added": len(new_copies),
+                   "copies_deleted": len(deleted_copies)})
+    if (not new and not deleted and not new_copies and not deleted_copies
+            and not complete):
+        print_message("%s in sync, %d files" % (label, len(files), ))
+        return result
+
+    insert_copy_tapes(cta_db, label,
+                      [f for pnfs_id, f in files.items()
+                       if f["copy_deleted"] == "n"
+                       and (pnfs_id not in actual or not actual[pnfs_id][3])],
+                      config, added_copy_volumes, dimensions, result)
+    ids = {}
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        if deleted:
+            archive_file_ids = [i[1] for i in deleted]
+            cursor.execute(DELETE_TAPE_FILES, (archive_file_ids, ))
+            cursor.execute(DELETE_ARCHIVE_FILES, (archive_file_ids, ))
+        if deleted_copies:
+            cursor.execute(DELETE_COPY_TAPE_FILES, (deleted_copies, ))
+        if new:
+            rows = psycopg2.extras.execute_values(
+                cursor,
+                INSERT_ARCHIVE_FILES,
+                [archive_file_values(f, config, dimensions) for f in new],
+                template=ARCHIVE_FILE_TEMPLATE,
+                page_size=len(new),
+                fetch=True)
+            ids = dict(rows)
+            new_copies += [tape_file_copy_values(f, ids[f["pnfs_id"]])
+                           for f in new
+                           if f.get("label") and f["copy_deleted"] == "n"]
+        tape_files = [tape_file_values(f, label[:6], ids[f["pnfs_id"]])
+                      for f in new] + new_copies
+        if tape_files:
+            psycopg2.extras.execute_values(cursor,
+                                           INSERT_TAPE_FILES,
+                                           tape_files,
+                                           page_size=len(tape_files))
+        cursor.execute(UPDATE_TAPE,
+                       {"active_bytes": enstore_volume["active_bytes"],
+                        "active_files": enstore_volume["active_files"],
+                        "last_fseq": extract_eod(enstore_volume),
+                        "user": getpass.getuser(),
+                        "host": HOSTNAME,
+                        "time": int(time.time()),
+                        "vid": label[:6]})
+        cta_db.commit()
+    except (psycopg2.Error, KeyError) as e:
+        cta_db.rollback()
+        print_error("%s failed to sync, %s" % (label, str(e).strip(), ))
+        return label_result(label, "failed", len(files), str(e).strip())
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    if not config["skip_locations"]:
+        cursor = None
+        try:
+            cursor = chimera_db.cursor()
+            if deleted:
+                cursor.execute(DELETE_CHIMERA_LOCATIONS,
+                               ([get_location(*i) for i in deleted], ))
+            locations = [(get_location(f["pnfs_id"], ids[f["pnfs_id"]]),
+                          f["pnfs_id"])
+                         for f in new]
+            if complete:
+                locations += [(get_location(pnfs_id, actual[pnfs_id][4]),
+                               pnfs_id)
+                              for pnfs_id in files if pnfs_id in actual]
+            if locations:
+                psycopg2.extras.execute_values(cursor,
+                                               INSERT_CHIMERA_LOCATIONS,
+                                               locations,
+                                               page_size=len(locations))
+                result["locations_inserted"] = cursor.rowcount
+                result["locations_skipped"] = len(locations) - cursor.rowcount
+            chimera_db.commit()
+        except psycopg2.Error as e:
+            chimera_db.rollback()
+            result["errors"] += len(new) + len(deleted)
+            print_error("%s failed to sync locations in chimera DB, %s" %
+                        (label, str(e).strip(), ))
+        finally:
+            if cursor:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+    print_message("%s Synced, %d files, %d added, %d deleted, %d copies "
+                  "added, %d copies deleted" %
+                  (label, len(files), len(new), len(deleted),
+                   result["copies_added"], result["copies_deleted"]))
+    return result
+
+
+class SyncWorker(Worker):
+    """
+    Worker that syncs labels already in CTA and migrates the others
+    """
+    def do_label(self, label):
+        t0 = time.time()
+        result = sync_label(self.enstore, self.cta_db, self.chimera_db,
+                            label, self.config, self.added_copy_volumes,
+                            self.dimensions)
+        result["seconds"] = time.time() - t0
+        return result
+
+
+def sync_labels(labels, config, concurrency=None):
+    """
+    Same as migration.migrate_labels, but labels already in CTA are
+    synced instead of skipped
+    """
+    return migrate_labels(labels, config, concurrency,
+                          worker_class=SyncWorker)
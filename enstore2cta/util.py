@@ -0,0 +1,165 @@
+"""
+Logging and Enstore location/checksum helpers shared by the migration
+modules
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import sys
+import time
+
+
+printLock = multiprocessing.Lock()
+
+
+def print_error(text):
+    """
+    Print text string to stderr prefixed with timestamp
+    and ERROR keyword
+
+    :param text: text to be printed
+    :type text: str
+    :return: no value
+    :rtype: none
+    """
+    with printLock:
+        sys.stderr.write(time.strftime(
+            "%Y-%m-%d %H:%M:%S",
+            time.localtime(time.time()))+" ERROR : " + text + "\n")
+        sys.stderr.flush()
+
+
+def print_message(text):
+    """
+    Print text string to stdout prefixed with timestamp
+    and INFO keyword
+
+    :param text: text to be printed
+    :type text: str
+    :return: no value
+    :rtype: none
+    """
+    with printLock:
+        sys.stdout.write(time.strftime(
+            "%Y-%m-%d %H:%M:%S",
+            time.localtime(time.time()))+" INFO : " + text + "\n")
+        sys.stdout.flush()
+
+
+class QueueStats(object):
+    """
+    Accumulates time a producer or a consumer spends waiting on
+    a queue (put or get) and time it spends doing actual work,
+    reports both periodically and at the end
+    """
+    def __init__(self, name, kind, interval=60):
+        self.name = name
+        self.kind = kind
+        self.interval = interval
+        self.start = self.last = time.time()
+        self.current = [0., 0., 0]
+        self.total = [0., 0., 0]
+
+    def waited(self, seconds):
+        self.current[0] += seconds
+        self.total[0] += seconds
+
+    def worked(self, seconds, items=1):
+        self.current[1] += seconds
+        self.current[2] += items
+        self.total[1] += seconds
+        self.total[2] += items
+
+    def format(self, counters, period):
+        wait, busy, items = counters
+        return ("%s: %d items, %s wait %.1fs, busy %.1fs, "
+                "utilization %.0f%% over %ds" %
+                (self.name, items, self.kind, wait, busy,
+                 100. * busy / (wait + busy) if wait + busy else 0.,
+                 int(period + 0.5)))
+
+    def report(self):
+        """
+        Print counters accumulated since last report if
+        reporting interval has passed
+        """
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        print_message(self.format(self.current, now - self.last))
+        self.current = [0., 0., 0]
+        self.last = now
+
+    def summary(self):
+        """
+        Print counters accumulated since start
+        """
+        print_message(self.format(self.total, time.time() - self.start))
+
+
+def file_location_to_sequence(location):
+    return ( location - 2 ) / 3 + 1
+
+
+def extract_file_number(location_cookie, wrapper):
+    fseq = int(location_cookie.split("_")[2])
+    if wrapper == "cern":
+        #
+        # when CERN wrapper is used the records look like
+        # HFT ("HeaderFileTrailer")
+        # Enstore stores actual location of the file as location_cookie
+        # CTA stores so called sequence number, which is
+        # the triplet number on a tape:
+        #
+        # Enstore location cookie:  2  5  8
+        #                          HFTHFTHFT
+        # CTA sequence number:      1  2  3
+        #
+        fseq = file_location_to_sequence(fseq)
+    return fseq
+
+
+def extract_eod(enstore_volume):
+    """
+    enstore_volume is a dictionary
+    expected to have wrapper end eod_cookie fields
+    """
+    eod = int(enstore_volume["eod_cookie"].split("_")[2]) - 1
+    if enstore_volume["wrapper"] == "cern":
+        #
+        # when CERN wrapper is used the records look like
+        # HFT ("HeaderFileTrailer")
+        # Enstore stores actual location of the file as location_cookie
+        # CTA stores so called sequence number, which is
+        # the triplet number on a tape:
+        #
+        # Enstore location cookie:  2  5  8
+        #                          HFTHFTHFT
+        # CTA sequence number:      1  2  3
+        #
+        eod = file_location_to_sequence(eod)
+    return eod
+
+
+
+CRC_SWITCH = '2019-08-21 09:54:26'
+
+def get_switch_epoch():
+    """
+    Timestamp when the change from 0 to 1 based adler checksum happened
+    """
+    time_format = '%Y-%m-%d %H:%M:%S'
+    os.environ['TZ'] = 'America/Chicago'
+    epoch = int(time.mktime(time.strptime(CRC_SWITCH, time_format)))
+    return epoch
+
+
+def convert_0_adler32_to_1_adler32(crc, filesize):
+    BASE = 65521
+    size = filesize % BASE
+    s1 = (crc & 0xffff)
+    s2 = ((crc >> 16) & 0xffff)
+    s1 = (s1 + 1) % BASE
+    s2 = (size + s2) % BASE
+    new_adler = (s2 << 16) + s1
+    return new_adler
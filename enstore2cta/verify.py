@@ -0,0 +1,308 @@
+"""
+Post-migration consistency check. For every label the active Enstore
+files (pnfs_id, size, adler32, fseq, copy tape) are compared with CTA
+archive_file/tape_file and chimera t_locationinfo. Each database is
+queried once per label, files are compared as sets in memory.
+"""
+from __future__ import print_function
+import csv
+import multiprocessing
+import os
+import re
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from enstore2cta.db import (get_application_name, open_connection, select,
+                            set_application_name)
+from enstore2cta.migration import (STOPPER, enstore_checksum, open_enstore,
+                                   skip_duplicates, tape_file_copy_values,
+                                   tape_file_values)
+from enstore2cta.util import QueueStats, print_error, print_message
+
+
+REPORT_HEADER = ("label", "pnfsid", "category", "enstore", "cta")
+
+#
+# all tape files of archive files that have a copy on the volume
+#
+SELECT_CTA_FILES_FOR_VOLUME = """
+select af.disk_file_id,
+       af.archive_file_id,
+       af.size_in_bytes,
+       af.checksum_adler32,
+       tf.vid,
+       tf.fseq,
+       tf.copy_nb
+from tape_file tf
+inner join archive_file af on af.archive_file_id = tf.archive_file_id
+where tf.archive_file_id in (select archive_file_id from tape_file where vid = %s)
+"""
+
+SELECT_CHIMERA_LOCATIONS = """
+select i.ipnfsid, l.ilocation
+from t_inodes i
+inner join t_locationinfo l on l.inumber = i.inumber
+where i.ipnfsid = any(%s)
+      and l.itype = 0
+      and l.ilocation like 'cta://%%'
+"""
+
+ARCHIVE_ID = re.compile(r"archiveid=(\d+)")
+
+
+def get_expected(files, label):
+    """
+    Expected CTA state of Enstore files of a volume
+
+    :return: dictionary pnfs_id -> (size, adler32, fseq, (copy vid, copy fseq))
+    :rtype: dict
+    """
+    expected = {}
+    for f in files:
+        copy = None
+        if f.get("label") and f["copy_deleted"] == "n":
+            copy = tuple(tape_file_copy_values(f, None)[:2])
+        expected[f["pnfs_id"]] = (f["size"],
+                                  enstore_checksum(f),
+                                  tape_file_values(f, label[:6], None)[1],
+                                  copy)
+    return expected
+
+
+def get_actual(cta_db, label):
+    """
+    CTA state of archive files having a copy on the volume
+
+    :return: dictionary pnfs_id -> (size, adler32, fseq, (copy vid, copy fseq),
+             archive_file_id)
+    :rtype: dict
+    """
+    actual = {}
+    copies = {}
+    for row in select(cta_db, SELECT_CTA_FILES_FOR_VOLUME, (label[:6], )):
+        if row["copy_nb"] == 1:
+            actual[row["disk_file_id"]] = [row["size_in_bytes"],
+                                           row["checksum_adler32"],
+                                           row["fseq"],
+                                           None,
+                                           row["archive_file_id"]]
+        else:
+            copies[row["disk_file_id"]] = (row["vid"], row["fseq"])
+    for pnfs_id, copy in copies.items():
+        if pnfs_id in actual:
+            actual[pnfs_id][3] = copy
+    return dict((k, tuple(v)) for k, v in actual.items())
+
+
+def verify_label(enstore, cta_db, chimera_db, label, config):
+    """
+    Compare Enstore volume with CTA and chimera
+
+    :param enstore: source of Enstore metadata
+    :type enstore: migration.EnstoreReader, snapshot.Snapshot or
+                   snapshot.VolumeCache
+    :param label: Enstore volume label
+    :type label: str
+    :param config: migration configuration
+    :type config: dict
+    :return: summary and list of discrepancies (label, pnfsid, category,
+             enstore, cta)
+    :rtype: tuple
+    """
+    discrepancies = []
+
+    def report(pnfs_id, category, enstore_value=None, cta_value=None):
+        discrepancies.append((label, pnfs_id, category,
+                              enstore_value, cta_value))
+
+    files = skip_duplicates(enstore.get_files(label), label, config)
+    expected = get_expected(files, label)
+    actual = get_actual(cta_db, label)
+    if expected and not actual and not select(cta_db,
+                                              "select vid from tape where vid = %s",
+                                              (label[:6], )):
+        report(None, "tape_missing", label, None)
+
+    for pnfs_id in set(expected) - set(actual):
+        report(pnfs_id, "missing_in_cta")
+    for pnfs_id in set(actual) - set(expected):
+        report(pnfs_id, "extra_in_cta", None, actual[pnfs_id][4])
+
+    for pnfs_id in set(expected) & set(actual):
+        size, crc, fseq, copy = expected[pnfs_id]
+        cta_size, cta_crc, cta_fseq, cta_copy, archive_file_id = actual[pnfs_id]
+        if size != cta_size:
+            report(pnfs_id, "size_mismatch", size, cta_size)
+        if crc != cta_crc:
+            report(pnfs_id, "checksum_mismatch", crc, cta_crc)
+        if fseq != cta_fseq:
+            report(pnfs_id, "fseq_mismatch", fseq, cta_fseq)
+        if copy != cta_copy:
+            report(pnfs_id,
+                   "copy_missing" if copy and not cta_copy else "copy_mismatch",
+                   "%s:%s" % copy if copy else None,
+                   "%s:%s" % cta_copy if cta_copy else None)
+
+    if not config.get("skip_locations") and actual:
+        locations = {}
+        for row in select(chimera_db, SELECT_CHIMERA_LOCATIONS,
+                          (list(actual.keys()), )):
+            match = ARCHIVE_ID.search(row["ilocation"])
+            if match:
+                locations.setdefault(row["ipnfsid"], set()).add(int(match.group(1)))
+        for pnfs_id in set(expected) & set(actual):
+            archive_file_id = actual[pnfs_id][4]
+            if pnfs_id not in locations:
+                report(pnfs_id, "location_missing", None, archive_file_id)
+            elif archive_file_id not in locations[pnfs_id]:
+                report(pnfs_id, "location_mismatch",
+                       ",".join(map(str, sorted(locations[pnfs_id]))),
+                       archive_file_id)
+
+    summary = {"label": label,
+               "files": len(expected),
+               "cta_files": len(actual),
+               "discrepancies": len(discrepancies)}
+    return summary, discrepancies
+
+
+class VerifyWorker(multiprocessing.Process):
+    """
+    Verifies labels taken from queue, puts results on result queue
+    """
+    def __init__(self, queue, result_queue, config):
+        super(VerifyWorker, self).__init__()
+        self.queue = queue
+        self.result_queue = result_queue
+        self.config = config
+
+    def run(self):
+        enstore_db, cta_db, chimera_db = None, None, None
+        try:
+            enstore, enstore_db = open_enstore(self.config, self.name)
+            cta_db = open_connection(self.config, "cta_db", self.name)
+            cta_db.set_session(readonly=True)
+            if not self.config.get("skip_locations"):
+                chimera_db = open_connection(self.config, "chimera_db",
+                                             self.name)
+                chimera_db.set_session(readonly=True)
+            stats = QueueStats("verifier %s" % (self.name, ), "get",
+                               self.config.get("telemetry_interval", 60))
+            while True:
+                t0 = time.time()
+                label = self.queue.get()
+                stats.waited(time.time() - t0)
+                if label is None or os.path.exists(STOPPER):
+                    break
+                stats.report()
+                t0 = time.time()
+                try:
+                    application_name = get_application_name(
+                        self.config, self.name, "verify", label)
+                    for i in (enstore_db, cta_db, chimera_db):
+                        if i:
+                            set_application_name(i, application_name)
+                    result = verify_label(enstore, cta_db, chimera_db,
+                                          label, self.config)
+                except Exception as e:
+                    print_error("%s failed to verify, %s" % (label, str(e), ))
+                    result = ({"label": label, "files": 0, "cta_files": 0,
+                               "discrepancies": 1},
+                              [(label, None, "verify_failed", None, str(e))])
+                    for i in (enstore_db, cta_db, chimera_db):
+                        if i:
+                            i.rollback()
+                finally:
+                    stats.worked(time.time() - t0)
+                self.result_queue.put(result)
+            stats.summary()
+        except Exception as e:
+            print_error("Exception %s" % (str(e)))
+        finally:
+            for i in (enstore_db, cta_db, chimera_db):
+                if i:
+                    try:
+                        i.close()
+                    except Exception:
+                        pass
+
+
+def verify_labels(labels, config, concurrency=None, report_file=None):
+    """
+    Verify migrated labels in parallel and write discrepancies to
+    CSV report
+
+    :param labels: Enstore volume labels
+    :type labels: list
+    :param config: migration configuration
+    :type config: dict
+    :param concurrency: number of worker processes, default is cpu count
+    :type concurrency: int
+    :param report_file: path of discrepancy report, none if not given
+    :type report_file: str
+    :return: one summary per verified label
+    :rtype: list
+    """
+    if not concurrency:
+        concurrency = multiprocessing.cpu_count()
+    queue = multiprocessing.Queue(10000)
+    result_queue = multiprocessing.Queue()
+    workers = []
+    for i in range(concurrency):
+        worker = VerifyWorker(queue, result_queue, config)
+        workers.append(worker)
+        worker.start()
+
+    report = writer = None
+    if report_file:
+        report = open(report_file, "w")
+        writer = csv.writer(report)
+        writer.writerow(REPORT_HEADER)
+
+    summaries = []
+
+    def collect(timeout):
+        summary, discrepancies = result_queue.get(timeout=timeout)
+        summaries.append(summary)
+        if writer:
+            writer.writerows(discrepancies)
+        if discrepancies:
+            print_error("%s: %d files, %d in CTA, %d discrepancies" %
+                        (summary["label"], summary["files"],
+                         summary["cta_files"], summary["discrepancies"]))
+        else:
+            print_message("%s: %d files OK" % (summary["label"],
+                                               summary["files"]))
+
+    try:
+        for label in labels:
+            queue.put(label)
+            while True:
+                try:
+                    collect(0)
+                except Empty:
+                    break
+        for i in range(concurrency):
+            queue.put(None)
+        while True:
+            try:
+                collect(1)
+            except Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+        for worker in workers:
+            worker.join()
+        while True:
+            try:
+                collect(0.1)
+            except Empty:
+                break
+    finally:
+        if report:
+            report.close()
+            print_message("Wrote report %s" % (report_file, ))
+    return summaries
@@ -15,7 +15,12 @@ setup(
     author="Dmitry Litvintsev",
     url="https://github.com/DmitryLitvintsev/enstore2cta",
     license=license,
-    #packages=["enstore2cta",],
-    install_requires = ["psycopg2",],
-    scripts=["enstore2cta/scripts/enstore2cta.py",],
+    packages=find_packages(),
+    install_requires = ["psycopg2", "pyyaml",],
+    extras_require = {"async": ["psycopg>=3.1",],},
+    entry_points = {"console_scripts": [
+        "enstore2cta = enstore2cta.cli:main",
+        "enstore2cta_one_tape_pool_per_vo = "
+        "enstore2cta.cli:main_one_tape_pool_per_vo",],},
+    scripts=["enstore2cta/scripts/sfa2dcache.py",],
     )
@@ -0,0 +1,140 @@
+"""
+Fakes shared by the unit tests, standing in for Enstore DB, snapshots
+and CTA objects so that no database is needed
+"""
+import datetime
+
+import psycopg2
+
+from enstore2cta.migration import CtaDimensions
+
+
+def make_volume(**kwargs):
+    """
+    Enstore volume row of an active primary LTO8 volume of cms
+    """
+    volume = {"label": "VR0001L8",
+              "media_type": "LTO8",
+              "system_inhibit_0": "none",
+              "library": "LTO8",
+              "file_family": "raw",
+              "storage_group": "cms",
+              "wrapper": "cpio_odc",
+              "active_files": 10,
+              "active_bytes": 1000,
+              "eod_cookie": "0000_000000000_0000011",
+              "last_access": datetime.datetime(2024, 1, 2, 3, 4, 5)}
+    volume.update(kwargs)
+    return volume
+
+
+def make_file(pnfs_id, bfid, **kwargs):
+    """
+    Enstore file row as migration.SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY
+    returns it, without a copy
+    """
+    enstore_file = {"pnfs_id": pnfs_id,
+                    "bfid": bfid,
+                    "size": 100,
+                    "crc": 1,
+                    "uid": 1000,
+                    "gid": 1000,
+                    "location_cookie": "0000_000000000_0000001",
+                    "original_wrapper": "cpio_odc",
+                    "storage_class": "cms.raw@cta",
+                    "deleted": "n",
+                    "copy_bfid": None,
+                    "copy_location_cookie": None,
+                    "copy_deleted": None,
+                    "label": None}
+    enstore_file.update(kwargs)
+    return enstore_file
+
+
+class FakeSnapshot(object):
+    """
+    Enstore volumes and files held in memory, same interface as
+    snapshot.Snapshot and migration.EnstoreReader
+    """
+    def __init__(self, volumes=(), files=None, combinations=None):
+        self.volumes = dict((volume["label"], volume) for volume in volumes)
+        self.files = files or {}
+        self.combinations = combinations
+
+    def get_volume(self, label):
+        return self.volumes.get(label)
+
+    def get_volumes(self):
+        return [self.volumes[label] for label in sorted(self.volumes)]
+
+    def get_files(self, label):
+        return list(self.files.get(label, []))
+
+    def get_combinations(self):
+        return self.combinations
+
+
+def make_dimensions(**ids):
+    """
+    CtaDimensions with ids given per kind instead of read from CTA
+    """
+    dimensions = CtaDimensions.__new__(CtaDimensions)
+    dimensions.ids = ids
+    return dimensions
+
+
+class FakeCursor(object):
+    """
+    Cursor recording statements on its connection and fetching the
+    next of the results given to the connection
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, sql, pars=None):
+        if sql.strip().lower().startswith("copy") and self.connection.failing:
+            raise psycopg2.Error(self.connection.failing)
+        self.connection.statements.append((sql, pars))
+        self.rowcount = self.connection.rowcount
+
+    def copy_expert(self, sql, data):
+        self.execute(sql, data.read())
+
+    def fetchall(self):
+        return self.connection.results.pop(0)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """
+    Database connection counting commits and rollbacks, a broken one
+    fails rollbacks. Statements executed by its cursors are recorded,
+    results are fetched in the given order, statements affect rowcount
+    rows, COPY fails with message failing if given
+    """
+    def __init__(self, broken=False, results=(), failing=None, rowcount=0):
+        self.broken = broken
+        self.results = list(results)
+        self.failing = failing
+        self.rowcount = rowcount
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
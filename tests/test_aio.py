@@ -0,0 +1,104 @@
+"""
+Unit tests of enstore2cta.aio that do not need a database or psycopg 3
+"""
+import asyncio
+import threading
+
+from conftest import FakeSnapshot, make_volume
+from enstore2cta.aio import ConnectionPool, Lane
+
+
+class FakeAsyncConnection(object):
+
+    def __init__(self):
+        self.closed = False
+        self.application_names = []
+
+    async def execute(self, sql, pars=None):
+        self.application_names.append(pars[0])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+
+    def __init__(self, size):
+        super(FakePool, self).__init__({}, "cta_db", size)
+        self.connections = []
+
+    async def open_connection(self):
+        connection = FakeAsyncConnection()
+        self.connections.append(connection)
+        return connection
+
+
+def test_pool_is_bounded_and_shared():
+    pool = FakePool(2)
+    in_use = []
+    peak = []
+
+    async def use(label):
+        async with pool.connection(label) as connection:
+            in_use.append(connection)
+            peak.append(len(in_use))
+            await asyncio.sleep(0)
+            in_use.remove(connection)
+
+    async def run():
+        await asyncio.gather(*[use("VR%04dL8" % (i, )) for i in range(6)])
+        await pool.close()
+
+    asyncio.run(run())
+    assert max(peak) == 2
+    assert len(pool.connections) == 2
+    assert all(c.closed for c in pool.connections)
+    assert sum(len(c.application_names) for c in pool.connections) == 6
+    assert pool.connections[0].application_names[0] == "enstore2cta async VR0000L8"
+
+
+def test_pool_tags_connection_once_per_label():
+    pool = FakePool(1)
+
+    async def run():
+        for label in ("VR0001L8", "VR0001L8", "VR0002L8"):
+            async with pool.connection(label):
+                pass
+
+    asyncio.run(run())
+    assert pool.connections[0].application_names == [
+        "enstore2cta async VR0001L8", "enstore2cta async VR0002L8"]
+
+
+def test_pool_replaces_closed_connection():
+    pool = FakePool(1)
+
+    async def run():
+        async with pool.connection("VR0001L8") as connection:
+            connection.closed = True
+        async with pool.connection("VR0001L8") as connection:
+            return connection
+
+    assert asyncio.run(run()) is pool.connections[1]
+    assert len(pool.connections) == 2
+
+
+class ThreadSnapshot(FakeSnapshot):
+
+    def get_files(self, label):
+        self.thread = threading.current_thread()
+        return super(ThreadSnapshot, self).get_files(label)
+
+
+def test_lane_reads_snapshot_in_executor():
+    snapshot = ThreadSnapshot([make_volume()], {"VR0001L8": [{"bfid": "b"}]})
+    lane = Lane({}, None, (None, None, None), snapshot)
+
+    async def run():
+        return (await lane.get_volume("VR0001L8"),
+                await lane.get_files("VR0001L8"))
+
+    volume, files = asyncio.run(run())
+    assert volume["label"] == "VR0001L8"
+    assert files == [{"bfid": "b"}]
+    assert snapshot.thread is not threading.main_thread()
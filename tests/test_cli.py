@@ -0,0 +1,9 @@
+"""
+Unit tests of enstore2cta.cli that do not need a database
+"""
+from enstore2cta import cli
+
+
+def test_main_has_docstring():
+    assert cli.main.__doc__
+    assert cli.main_one_tape_pool_per_vo.__doc__
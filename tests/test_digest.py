@@ -0,0 +1,113 @@
+"""
+Parity of the Python digest of enstore2cta.digest with its SQL
+counterparts, emulated here expression by expression
+"""
+import hashlib
+import struct
+
+from conftest import FakeSnapshot, make_file
+from enstore2cta import digest
+from enstore2cta.digest import (SELECT_ENSTORE_DIGESTS, file_hash,
+                                get_enstore_digests, get_skip_fingerprint,
+                                get_snapshot_digests)
+from enstore2cta.util import convert_0_adler32_to_1_adler32, extract_file_number
+
+
+def sql_hash(text):
+    # ('x'||substr(md5(text), 1, 16))::bit(64)::bigint
+    return struct.unpack(">q", bytes.fromhex(
+        hashlib.md5(text.encode("utf-8")).hexdigest()[:16]))[0]
+
+
+def sql_adler32(size, crc):
+    # conversion of adler32 seeded with 0 in SELECT_ENSTORE_DIGESTS
+    return (((((size % 65521) + ((crc >> 16) & 65535)) % 65521) << 16)
+            + (((crc & 65535) + 1) % 65521))
+
+
+def sql_fseq(location_cookie, wrapper):
+    # fseq of SELECT_ENSTORE_DIGESTS, integer division of bigint
+    fseq = int(location_cookie.split("_")[2])
+    return (fseq - 2) // 3 + 1 if wrapper == "cern" else fseq
+
+
+def test_file_hash_matches_sql():
+    for pnfs_id, size, crc, fseq in (("0000A1B2C3", 0, 1, 1),
+                                     ("00008F3E2D1C0B", 1 << 40, 4294967295, 7),
+                                     ("0000FFFF", 123456789, 987654, 100000)):
+        text = "%s:%d:%d:%d" % (pnfs_id, size, crc, fseq)
+        assert file_hash(pnfs_id, size, crc, fseq) == sql_hash(text)
+
+
+def test_file_hash_is_signed_64_bit():
+    hashes = [file_hash("%08X" % (i, ), i, i, i) for i in range(200)]
+    assert all(-(1 << 63) <= h < (1 << 63) for h in hashes)
+    assert any(h < 0 for h in hashes) and any(h >= 0 for h in hashes)
+
+
+def test_adler32_conversion_matches_sql():
+    for size, crc in ((0, 0), (1, 1), (65521, 65520), (1 << 40, 4294967295),
+                      (123456789, 2882400018)):
+        assert convert_0_adler32_to_1_adler32(crc, size) == sql_adler32(size,
+                                                                         crc)
+
+
+def test_fseq_matches_sql():
+    for cookie in ("0000_000000000_0000002", "0000_000000000_0000005",
+                   "0000_000000000_0012347"):
+        for wrapper in ("cern", "cpio_odc"):
+            assert extract_file_number(cookie, wrapper) == sql_fseq(cookie,
+                                                                    wrapper)
+
+
+def expected_digest(files):
+    # crc is converted on Fermilab hosts only, taken as is here
+    return (len(files), sum([file_hash(f["pnfs_id"], f["size"], f["crc"],
+                                       sql_fseq(f["location_cookie"],
+                                                f["original_wrapper"]))
+                             for f in files]))
+
+
+def test_snapshot_digest_counts_file_once_and_skips_bfids():
+    single = make_file("0000A1", "CDMS1600000000")
+    copies = [make_file("0000A2", "CDMS1600000001",
+                        location_cookie="0000_000000000_0000002",
+                        label="VS0001L8", copy_bfid=bfid, copy_deleted="n")
+              for bfid in ("CDMS1600000002", "CDMS1600000003")]
+    skipped = make_file("0000A3", "CDMS1600000004",
+                        location_cookie="0000_000000000_0000003")
+    snapshot = FakeSnapshot(files={"VR0001L8": [single] + copies + [skipped]})
+    digests = get_snapshot_digests(snapshot, ["VR0001L8", "VR0002L8"],
+                                   set(["CDMS1600000004"]))
+    assert digests == {"VR0001L8": expected_digest([single, copies[0]])}
+    assert get_snapshot_digests(snapshot, ["VR0001L8"])["VR0001L8"][0] == 3
+
+
+def test_enstore_digest_query_excludes_skip_bfids(monkeypatch):
+    queries = []
+
+    def select(connection, sql, pars):
+        queries.append(pars)
+        return [{"label": "VR0001L8", "files": 1, "digest": 5}]
+
+    monkeypatch.setattr(digest, "select", select)
+    assert get_enstore_digests(None, ["VR0001L8"], ["LTO8"],
+                               set(["CDMS2", "CDMS1"])) == {
+        "VR0001L8": (1, 5)}
+    assert queries[0]["skip_bfids"] == ["CDMS1", "CDMS2"]
+    get_enstore_digests(None, ["VR0001L8"], ["LTO8"])
+    assert queries[1]["skip_bfids"] == []
+    # placeholders and escaped % signs are balanced
+    text = SELECT_ENSTORE_DIGESTS % dict((key, repr(value))
+                                         for key, value in queries[0].items())
+    assert "select distinct v.label, v.wrapper, f.bfid" in text
+    assert "not (f.bfid = any(['CDMS1', 'CDMS2']))" in text
+
+
+def test_skip_fingerprint():
+    assert get_skip_fingerprint("0123456789abcdef", None) == "0123456789abcdef"
+    assert get_skip_fingerprint("0123456789abcdef", set()) == "0123456789abcdef"
+    fingerprint = get_skip_fingerprint("0123456789abcdef", set(["b", "a"]))
+    assert len(fingerprint) == 16
+    assert fingerprint == get_skip_fingerprint("0123456789abcdef", ["a", "b"])
+    assert fingerprint != get_skip_fingerprint("0123456789abcdef", ["a"])
@@ -0,0 +1,79 @@
+"""
+Unit tests of enstore2cta.duplicates that do not need a database
+"""
+import pytest
+
+from conftest import FakeSnapshot, make_volume
+from enstore2cta.duplicates import find_duplicates, resolve_duplicates
+from enstore2cta.migration import skip_duplicates
+
+
+def row(bfid, label, storage_group, pnfs_id="0000A1"):
+    return {"pnfs_id": pnfs_id, "bfid": bfid, "label": label,
+            "storage_group": storage_group}
+
+
+DUPLICATES = {
+    "0000A1": [row("CDMS1600000000", "VR0001L8", "cms"),
+               row("CDMS1700000000", "VR0002L8", "dune"),
+               row("CDMS1650000000", "VR0003L8", "cms")],
+    "0000B2": [row("CDMS1500000000", "VR0001L8", "nova", "0000B2"),
+               row("CDMS1400000000", "VR0004L8", "nova", "0000B2")],
+}
+
+
+def test_policy_skip():
+    assert resolve_duplicates(DUPLICATES, "skip") == set(
+        r["bfid"] for rows in DUPLICATES.values() for r in rows)
+
+
+def test_policy_newest():
+    assert resolve_duplicates(DUPLICATES, "newest") == set(
+        ["CDMS1600000000", "CDMS1650000000", "CDMS1400000000"])
+
+
+def test_policy_vo():
+    assert resolve_duplicates(DUPLICATES, "vo", ["cms", "dune"]) == set(
+        ["CDMS1600000000", "CDMS1700000000", "CDMS1400000000"])
+    # no preferred VO among the files, newest is kept
+    assert resolve_duplicates(DUPLICATES, "vo", ["mu2e"]) == \
+        resolve_duplicates(DUPLICATES, "newest")
+
+
+def test_newest_with_malformed_bfid():
+    duplicates = {"0000A1": [row("CDMSxyz", "VR0001L8", "cms"),
+                             row("CDMS1000000000", "VR0002L8", "cms")]}
+    assert resolve_duplicates(duplicates, "newest") == set(["CDMSxyz"])
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        resolve_duplicates(DUPLICATES, "oldest")
+
+
+def test_skip_duplicates_counts_dropped_files():
+    files = [{"bfid": "CDMS1600000000"}, {"bfid": "CDMS1800000000"}]
+    result = {}
+    kept = skip_duplicates(files, "VR0001L8",
+                           {"skip_bfids": set(["CDMS1600000000"])}, result)
+    assert kept == [{"bfid": "CDMS1800000000"}]
+    assert result == {"duplicates": 1}
+    assert skip_duplicates(files, "VR0001L8", {}) == files
+
+
+def test_find_duplicates_in_snapshot():
+    snapshot = FakeSnapshot(
+        [make_volume(label="VR0001L8"),
+         make_volume(label="VR0002L8", storage_group="dune"),
+         make_volume(label="VR0003L8", system_inhibit_0="NOACCESS")],
+        {"VR0001L8": [{"pnfs_id": "0000A1", "bfid": "CDMS1"},
+                      {"pnfs_id": "0000B2", "bfid": "CDMS2"},
+                      {"pnfs_id": "", "bfid": "CDMS3"}],
+         "VR0002L8": [{"pnfs_id": "0000A1", "bfid": "CDMS4"},
+                      {"pnfs_id": "", "bfid": "CDMS5"}],
+         "VR0003L8": [{"pnfs_id": "0000B2", "bfid": "CDMS6"}]})
+    assert find_duplicates(None, ["VR0001L8"], ["LTO8"], {}, snapshot) == {
+        "0000A1": [row("CDMS1", "VR0001L8", "cms"),
+                   row("CDMS4", "VR0002L8", "dune")]}
+    assert find_duplicates(None, ["VR0001L8"], ["LTO8"], {"vo": "cms"},
+                           snapshot) == {}
@@ -0,0 +1,128 @@
+"""
+Unit tests of enstore2cta.freshload that do not need a database
+"""
+import pytest
+
+from conftest import FakeConnection
+from enstore2cta import freshload
+from enstore2cta.freshload import (FOREIGN_KEYS, INDEXES, KEPT,
+                                   UNIQUE_CONSTRAINTS, VIOLATIONS,
+                                   finish_fresh_load, get_deferred_objects,
+                                   prepare_fresh_load)
+from enstore2cta.migration import UPDATE_COPY_COUNTS, update_cta_copy_counts
+
+
+def all_objects():
+    return [{"kind": kind, "name": name, "valid": True}
+            for kind, name in sorted(get_deferred_objects())]
+
+
+def test_violations_are_checked_for_all_constraints():
+    assert set(VIOLATIONS) == set([i[1] for i in UNIQUE_CONSTRAINTS] +
+                                  [i[1] for i in FOREIGN_KEYS])
+    assert set([name for name, _ in INDEXES]) >= set(VIOLATIONS) & set(
+        [i[1] for i in UNIQUE_CONSTRAINTS])
+
+
+def test_prepare_drops_all_but_kept():
+    cta_db = FakeConnection(results=[all_objects(), []])
+    dropped = prepare_fresh_load(cta_db)
+    statements = [sql for sql, pars in cta_db.statements[2:]]
+    assert dropped == len(statements) == len(INDEXES) + len(FOREIGN_KEYS) + \
+        len(UNIQUE_CONSTRAINTS) - 2 * len(KEPT)
+    assert statements[:len(FOREIGN_KEYS)] == [
+        "alter table %s drop constraint %s" % (table, name)
+        for table, name, _ in FOREIGN_KEYS]
+    assert not [s for s in statements if "archive_file_din_dfi_un" in s]
+    assert "drop index if exists tape_file_vid_block_id_un" in statements
+    assert cta_db.commits == 1
+
+
+def test_prepare_refuses_loaded_catalogue():
+    cta_db = FakeConnection(results=[all_objects(), [{"archive_file_id": 1}]])
+    with pytest.raises(ValueError):
+        prepare_fresh_load(cta_db)
+    assert cta_db.commits == 0
+
+
+def test_prepare_resumes_without_emptiness_check():
+    objects = [row for row in all_objects()
+               if row["name"] != "tape_file_vid_idx"]
+    cta_db = FakeConnection(results=[objects])
+    assert prepare_fresh_load(cta_db) == len(objects) - 2 * len(KEPT)
+
+
+def finish(monkeypatch, objects, violations=None, errors=None):
+    executed = []
+
+    def execute(config, name, statement):
+        executed.append(statement)
+        return (errors or {}).get(name)
+
+    monkeypatch.setattr(freshload, "open_connection",
+                        lambda *args: FakeConnection())
+    monkeypatch.setattr(freshload, "get_objects", lambda cta_db: objects)
+    monkeypatch.setattr(freshload, "get_violations",
+                        lambda config, name: (violations or {}).get(name, []))
+    monkeypatch.setattr(freshload, "execute", execute)
+    return finish_fresh_load({}, 4), executed
+
+
+def test_finish_with_everything_in_place(monkeypatch):
+    objects = dict((i, True) for i in get_deferred_objects())
+    assert finish(monkeypatch, objects) == ([], [])
+
+
+def test_finish_builds_indexes_then_constraints(monkeypatch):
+    objects = {("index", "archive_file_din_dfi_un"): True,
+               ("constraint", "archive_file_din_dfi_un"): True}
+    problems, executed = finish(monkeypatch, objects)
+    assert problems == []
+    built = [name for name, _ in INDEXES if name not in KEPT]
+    assert executed[:len(built)] == [statement for name, statement in INDEXES
+                                     if name in built]
+    rest = executed[len(built):]
+    assert rest[0] == ("alter table tape_file add constraint "
+                       "tape_file_vid_block_id_un unique using index "
+                       "tape_file_vid_block_id_un ")
+    assert rest[1:] == (
+        ["alter table %s add constraint %s %s not valid" % fk
+         for fk in FOREIGN_KEYS] +
+        ["alter table %s validate constraint %s" % (table, name)
+         for table, name, _ in FOREIGN_KEYS])
+
+
+def test_finish_reports_violations(monkeypatch, capsys):
+    objects = dict((i, True) for i in get_deferred_objects()
+                   if i[1] not in ("tape_file_vid_block_id_un",
+                                   "tape_file_tape_fk"))
+    objects[("constraint", "tape_file_tape_fk")] = False
+    problems, executed = finish(
+        monkeypatch, objects,
+        violations={"tape_file_vid_block_id_un": [{"key": "VR0001:1",
+                                                   "nb_rows": 2}],
+                    "tape_file_tape_fk": [{"key": "VR0002", "nb_rows": 5}]})
+    assert problems == ["tape_file_tape_fk violated by 1 keys",
+                        "tape_file_vid_block_id_un violated by 1 keys"]
+    # violated unique index is not built, violated foreign key exists
+    # already and is left not validated
+    assert executed == []
+    assert "tape_file_tape_fk violated by 1 keys (5 rows), e.g. VR0002" in \
+        capsys.readouterr().err
+
+
+def test_finish_reports_failed_builds(monkeypatch):
+    objects = dict((i, True) for i in get_deferred_objects()
+                   if i[1] != "tape_file_vid_idx")
+    problems, executed = finish(monkeypatch, objects,
+                                errors={"tape_file_vid_idx": "disk full"})
+    assert problems == ["tape_file_vid_idx not built, disk full"]
+
+
+def test_copy_counts_are_recomputed_in_one_statement():
+    cta_db = FakeConnection(rowcount=3)
+    assert update_cta_copy_counts(cta_db) == 3
+    assert cta_db.statements == [(UPDATE_COPY_COUNTS, None)]
+    assert cta_db.commits == 1
+    assert "when tf.copy_nb = 1 then af.size_in_bytes" in UPDATE_COPY_COUNTS
+    assert "when tf.copy_nb > 1 then 1" in UPDATE_COPY_COUNTS
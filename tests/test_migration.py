@@ -0,0 +1,397 @@
+"""
+Unit tests of enstore2cta.migration that do not need a database
+"""
+import psycopg2
+import pytest
+
+from conftest import (FakeConnection, FakeSnapshot, make_dimensions,
+                      make_file, make_volume)
+from enstore2cta import migration
+from enstore2cta.migration import (BOOTSTRAP_ARCHIVE_ROUTES, BOOTSTRAP_VOS,
+                                   INSERT_CHIMERA_LOCATION,
+                                   INSERT_CHIMERA_LOCATIONS,
+                                   TAPE_POOL_NAMING, bootstrap_cta,
+                                   check_media_types, get_bootstrap_plan,
+                                   get_enstore_media_types, get_label_query,
+                                   get_labels, get_tape_pool_name,
+                                   get_volume_predicate,
+                                   get_volume_tape_pool_name,
+                                   insert_chimera_location, like, preflight)
+
+
+def test_pool_per_storage_class():
+    naming = TAPE_POOL_NAMING["storage_class"]
+    assert naming("cms", "raw", 1) == ("cms.raw", "Pool for cms.raw")
+    assert naming("cms", "raw", 2) == ("cms.raw_copy_1",
+                                       "Pool for cms.raw copy 1")
+
+
+def test_pool_per_vo():
+    naming = TAPE_POOL_NAMING["vo"]
+    assert naming("cms", "raw", 1) == ("Pool for cms copy 1",
+                                       "Pool for cms copy 1")
+    assert naming("cms", "other", 2)[0] == "Pool for cms copy 2"
+
+
+def test_tape_pool_name_of_copy_file_family():
+    assert get_tape_pool_name({}, "cms", "raw_copy_1")[0] == "cms.raw_copy_1"
+    assert get_tape_pool_name({"tape_pool_naming": "vo"},
+                              "cms", "raw_copy_1")[0] == "Pool for cms copy 2"
+    assert get_tape_pool_name({"tape_pool_naming": "vo"},
+                              "cms", "raw")[0] == "Pool for cms copy 1"
+
+
+def test_tape_pool_name_configuration_overrides_naming():
+    volume = {"storage_group": "cms", "file_family": "raw"}
+    assert get_volume_tape_pool_name(volume, {}) == "cms.raw"
+    assert get_volume_tape_pool_name(volume,
+                                     {"tape_pool_naming": "vo",
+                                      "tape_pool_name": "fixed"}) == "fixed"
+
+
+DIMENSIONS = make_dimensions(disk_instance={"eosctapublic": "eosctapublic"},
+                             storage_class={"cms.raw@cta": 1})
+
+
+def migrate(monkeypatch, files, batch_size, failing_batch=None,
+            dimensions=DIMENSIONS):
+    calls = []
+
+    def insert_files_batch(cta_db, chimera_db, label, batch, *args):
+        calls.append(("batch", [f["pnfs_id"] for f in batch]))
+        if batch[0]["pnfs_id"] == failing_batch:
+            raise psycopg2.Error("duplicate key")
+
+    def insert_files(cta_db, chimera_db, label, batch, *args):
+        calls.append(("one by one", [f["pnfs_id"] for f in batch]))
+
+    monkeypatch.setattr(migration, "insert_cta_tape",
+                        lambda *args: calls.append(("tape", args[1]["label"])))
+    monkeypatch.setattr(migration, "insert_files_batch", insert_files_batch)
+    monkeypatch.setattr(migration, "insert_files", insert_files)
+    enstore = FakeSnapshot([make_volume()], {"VR0001L8": files})
+    result = migration.migrate_label(enstore, None, None, "VR0001L8",
+                                     {"batch_size": batch_size,
+                                      "skip_locations": True,
+                                      "disk_instance_name": "eosctapublic"},
+                                     set(), dimensions)
+    return result, calls
+
+
+def test_migrate_label_falls_back_to_per_file_inserts(monkeypatch):
+    files = [{"pnfs_id": "p%d" % (i, ), "bfid": "CDMS%d" % (i, )}
+             for i in range(5)]
+    result, calls = migrate(monkeypatch, files, 2, failing_batch="p2")
+    assert calls == [("tape", "VR0001L8"),
+                     ("batch", ["p0", "p1"]),
+                     ("batch", ["p2", "p3"]),
+                     ("one by one", ["p2", "p3"]),
+                     ("batch", ["p4"])]
+    assert result["status"] == "done"
+    assert result["files"] == 5
+
+
+def test_migrate_label_batch_size_one_inserts_one_by_one(monkeypatch):
+    files = [{"pnfs_id": "p%d" % (i, ), "bfid": "CDMS%d" % (i, )}
+             for i in range(2)]
+    result, calls = migrate(monkeypatch, files, 1)
+    assert calls == [("tape", "VR0001L8"),
+                     ("one by one", ["p0"]),
+                     ("one by one", ["p1"])]
+
+
+def test_migrate_label_fails_fast_on_missing_storage_class(monkeypatch):
+    files = [{"pnfs_id": "p%d" % (i, ), "bfid": "CDMS%d" % (i, )}
+             for i in range(3)]
+    result, calls = migrate(monkeypatch, files, 2,
+                            dimensions=make_dimensions(
+                                disk_instance={"eosctapublic": "eosctapublic"},
+                                storage_class={}))
+    assert calls == []
+    assert result["status"] == "failed"
+    assert result["message"] == "storage_class cms.raw@cta does not exist in CTA"
+
+
+def test_like():
+    assert like("raw_copy_1", "%_copy_1")
+    assert not like("copy_1", "%_copy_1")
+    assert like("raw2024", "raw%")
+    assert not like("xraw", "raw%")
+    assert like("a_b", "a\\_b")
+    assert not like("axb", "a\\_b")
+    assert not like(None, "%")
+
+
+def test_volume_predicate_default_conditions():
+    predicate = get_volume_predicate({}, ["LTO8"])
+    assert predicate(make_volume())
+    assert not predicate(make_volume(media_type="LTO9"))
+    assert not predicate(make_volume(system_inhibit_0="NOACCESS"))
+    assert not predicate(make_volume(library="shelf-LTO8"))
+    assert not predicate(make_volume(file_family="raw_copy_1"))
+    assert not predicate(make_volume(active_files=0))
+
+
+def test_volume_predicate_filters():
+    predicate = get_volume_predicate({"vo": "cms,dune",
+                                      "file_family": "raw%",
+                                      "min_active_files": 5,
+                                      "max_active_files": "20",
+                                      "label_ranges": ["VR0000:VR0009"]},
+                                     ["LTO8"])
+    assert predicate(make_volume())
+    assert predicate(make_volume(storage_group="dune", label="VR0009L8"))
+    assert not predicate(make_volume(storage_group="nova"))
+    assert not predicate(make_volume(file_family="reco"))
+    assert not predicate(make_volume(active_files=4))
+    assert not predicate(make_volume(active_files=21))
+    assert not predicate(make_volume(label="VR0010L8"))
+
+
+def test_get_labels_from_snapshot():
+    snapshot = FakeSnapshot([make_volume(label="VR0001L8"),
+                             make_volume(label="VR0002L8",
+                                         storage_group="nova"),
+                             make_volume(label="VR0003L8", active_files=0)])
+    assert get_labels(None, ["LTO8"], {}, snapshot) == ["VR0001L8", "VR0002L8"]
+    assert get_labels(None, ["LTO8"], {"vo": ["nova"]},
+                      snapshot) == ["VR0002L8"]
+
+
+def test_check_media_types():
+    config = {"media_type_map": {"LTO8": "LTO8", "M8": "LTO7M"},
+              "media_types": {"LTO8": {"cartridge": "LTO-8",
+                                       "capacity_in_bytes": 12 * 10**12},
+                              "LTO7M": {"cartridge": "LTO-7"},
+                              "LTO9": None}}
+    assert check_media_types(config) == [
+        "media type LTO7M: capacity_in_bytes is not configured",
+        "media type LTO9: cartridge is not configured",
+        "media type LTO9: capacity_in_bytes is not configured"]
+    assert check_media_types({}) == ["media_type_map is not configured"]
+    assert get_enstore_media_types(config) == ["LTO8", "M8"]
+
+
+def render(sql, pars):
+    # same placeholder syntax as psycopg2, fails on unbalanced % signs
+    return sql % dict((key, repr(value)) for key, value in pars.items())
+
+
+def test_label_query_without_filters():
+    sql, pars = get_label_query({}, ["LTO8"])
+    assert pars == {"media_types": ["LTO8"]}
+    text = render(sql, pars)
+    assert "library not like 'shelf%'" in text
+    assert "file_family not like '%_copy_1'" in text
+    assert "storage_group" not in text
+
+
+def test_label_query_filters():
+    sql, pars = get_label_query({"vo": "cms, dune",
+                                 "library": ["LTO8"],
+                                 "file_family": "raw%",
+                                 "min_active_files": "5",
+                                 "max_active_files": None,
+                                 "media_type": [],
+                                 "label_ranges": "vr0000:vr0009,VS00:VS01"},
+                                ["LTO8"])
+    assert pars == {"media_types": ["LTO8"],
+                    "vo": ["cms", "dune"],
+                    "library": ["LTO8"],
+                    "file_family": "raw%",
+                    "min_active_files": 5,
+                    "label_from_0": "VR0000",
+                    "label_to_0": "VR0009",
+                    "label_from_1": "VS00",
+                    "label_to_1": "VS01"}
+    text = render(sql, pars)
+    assert "storage_group = any(['cms', 'dune'])" in text
+    assert "file_family like 'raw%'" in text
+    assert "active_files >= 5" in text
+    assert "active_files <=" not in text
+    assert "media_type = any([])" not in text
+    assert ("(label >= 'VR0000' and left(label, length('VR0009')) <= "
+            "'VR0009') or (label >= 'VS00'") in text
+
+
+@pytest.mark.parametrize("filters", [{"label_ranges": "VR0000"},
+                                     {"label_ranges": ":VR0009"},
+                                     {"owner": "cms"}])
+def test_label_query_invalid_filters(filters):
+    with pytest.raises(ValueError):
+        get_label_query(filters, ["LTO8"])
+
+
+class FailingWorker(migration.Worker):
+
+    def __init__(self, failing, broken=False):
+        super(FailingWorker, self).__init__(None, {})
+        self.failing = failing
+        self.connections = []
+        self.cta_db = FakeConnection(broken)
+
+    def connect(self):
+        self.cta_db = FakeConnection()
+        self.connections.append(self.cta_db)
+
+    def set_label(self, label):
+        pass
+
+    def do_label(self, label):
+        if label in self.failing:
+            raise psycopg2.errors.lookup("40P01")("deadlock detected")
+        return migration.label_result(label, "done")
+
+
+def test_worker_failure_fails_label_not_worker():
+    worker = FailingWorker(["VR0001L8"])
+    cta_db = worker.cta_db
+    result = worker.process("VR0001L8")
+    assert result["status"] == "failed"
+    assert result["message"] == "deadlock detected"
+    assert cta_db.rollbacks == 1
+    assert worker.process("VR0002L8")["status"] == "done"
+
+
+def test_worker_reconnects_after_broken_connection():
+    worker = FailingWorker(["VR0001L8"], broken=True)
+    assert worker.process("VR0001L8")["status"] == "failed"
+    assert len(worker.connections) == 1
+    assert worker.process("VR0002L8")["status"] == "done"
+
+
+@pytest.mark.parametrize("sql", [INSERT_CHIMERA_LOCATION,
+                                 INSERT_CHIMERA_LOCATIONS])
+def test_chimera_location_inserts_are_idempotent(sql):
+    assert sql.strip().endswith("on conflict do nothing")
+
+
+@pytest.mark.parametrize("rowcount", [1, 0])
+def test_insert_chimera_location_counts_inserted_rows(rowcount):
+    chimera_db = FakeConnection(rowcount=rowcount)
+    location = "cta://cta/0000A1?archiveid=11"
+    assert insert_chimera_location(chimera_db, make_file("0000A1", "CDMS1"),
+                                   location) == rowcount
+    assert chimera_db.statements == [(INSERT_CHIMERA_LOCATION,
+                                      (location, "0000A1"))]
+    assert (chimera_db.commits, chimera_db.rollbacks) == (1, 0)
+
+
+BOOTSTRAP_CONFIG = {"media_type_map": {"LTO8": "LTO8"},
+                    "media_types": {"LTO8": {"cartridge": "LTO-8",
+                                             "capacity_in_bytes": 12 * 10**12}},
+                    "disk_instance_name": "eosctapublic"}
+
+
+def combination(storage_group, file_family, library="LTO8",
+                media_type="LTO8"):
+    return {"storage_group": storage_group, "file_family": file_family,
+            "library": library, "media_type": media_type}
+
+
+BOOTSTRAP_SNAPSHOT = FakeSnapshot(combinations=[
+    combination("cms", "raw"),
+    combination("cms", "raw_copy_1", "LTO8C"),
+    combination("dune", "reco"),
+    combination("nova", "raw", "T10K", "T10KD")])
+
+
+def test_bootstrap_plan_from_combinations():
+    plan = get_bootstrap_plan(None, BOOTSTRAP_CONFIG, BOOTSTRAP_SNAPSHOT)
+    assert list(plan["media_type"]) == ["LTO8"]
+    assert plan["disk_instance"] == {"eosctapublic": None}
+    # VO of unmapped media type still exists, its storage classes do not
+    assert set(plan["virtual_organization"]) == set(["cms", "dune", "nova"])
+    assert set(plan["logical_library"]) == set(["LTO8", "LTO8C"])
+    assert plan["storage_class"] == {"cms.raw@cta": (2, "cms"),
+                                     "dune.reco@cta": (1, "dune")}
+    assert plan["tape_pool"] == {"cms.raw": ("cms", "Pool for cms.raw"),
+                                 "cms.raw_copy_1": ("cms",
+                                                    "Pool for cms.raw copy 1"),
+                                 "dune.reco": ("dune", "Pool for dune.reco")}
+    assert sorted(plan["archive_route"]) == ["cms.raw@cta:1", "cms.raw@cta:2",
+                                             "dune.reco@cta:1"]
+    assert plan["archive_route"]["cms.raw@cta:2"][:3] == ("cms.raw@cta", 2,
+                                                          "cms.raw_copy_1")
+
+
+def test_bootstrap_plan_library_map_replaces_libraries():
+    config = dict(BOOTSTRAP_CONFIG, library_map={"LTO8": "CTA_LTO8",
+                                                 "LTO8C": "CTA_LTO8"})
+    plan = get_bootstrap_plan(None, config, BOOTSTRAP_SNAPSHOT)
+    assert plan["logical_library"] == {"CTA_LTO8": None}
+
+
+def test_bootstrap_creates_only_missing_objects_in_one_transaction():
+    existing = [{"kind": "media_type", "name": "LTO8"},
+                {"kind": "disk_instance", "name": "eosctapublic"},
+                {"kind": "virtual_organization", "name": "cms"},
+                {"kind": "logical_library", "name": "LTO8"},
+                {"kind": "logical_library", "name": "LTO8C"},
+                {"kind": "storage_class", "name": "cms.raw@cta"},
+                {"kind": "storage_class", "name": "dune.reco@cta"},
+                {"kind": "tape_pool", "name": "cms.raw"},
+                {"kind": "tape_pool", "name": "cms.raw_copy_1"},
+                {"kind": "tape_pool", "name": "dune.reco"},
+                {"kind": "archive_route", "name": "cms.raw@cta:1"},
+                {"kind": "archive_route", "name": "dune.reco@cta:1"}]
+    cta_db = FakeConnection(results=[existing], rowcount=1)
+    created = bootstrap_cta(None, cta_db, BOOTSTRAP_CONFIG, BOOTSTRAP_SNAPSHOT)
+    assert created == {"media_type": 0, "disk_instance": 0,
+                       "virtual_organization": 1, "logical_library": 0,
+                       "storage_class": 0, "tape_pool": 0,
+                       "archive_route": 1}
+    statements = cta_db.statements[1:]
+    assert [sql for sql, pars in statements] == [BOOTSTRAP_VOS,
+                                                 BOOTSTRAP_ARCHIVE_ROUTES]
+    assert sorted(statements[0][1]["names"]) == ["dune", "nova"]
+    assert statements[1][1]["copies"] == [2]
+    assert statements[1][1]["pools"] == ["cms.raw_copy_1"]
+    assert cta_db.commits == 1
+
+
+CTA_OBJECTS = {"logical_library": set(["CTA_LTO8"]),
+               "media_type": set(["LTO8"]),
+               "tape_pool": set(["cms.raw"]),
+               "storage_class": set(["cms.raw@cta"])}
+
+PREFLIGHT_CONFIG = {"media_type_map": {"LTO8": "LTO8"},
+                    "library_map": {"LTO8": "CTA_LTO8"}}
+
+
+def run_preflight(monkeypatch, volumes, labels, expected=None):
+    monkeypatch.setattr(migration, "get_cta_objects",
+                        lambda cta_db: dict((kind, set(names)) for kind, names
+                                            in CTA_OBJECTS.items()))
+    return preflight(None, None, labels, PREFLIGHT_CONFIG, expected,
+                     FakeSnapshot(volumes))
+
+
+def test_preflight_passes_and_prints_plan(monkeypatch, capsys):
+    volumes = [make_volume(label="VR0001L8"), make_volume(label="VR0002L8")]
+    assert run_preflight(monkeypatch, volumes, ["VR0001L8", "VR0002L8"]) == []
+    plan = [line for line in capsys.readouterr().out.splitlines()
+            if "cms.raw" in line or "TOTAL" in line]
+    assert plan[0].split()[-6:] == ["cms", "cms.raw", "CTA_LTO8", "2", "20",
+                                    "2000"]
+    assert plan[1].split()[-4:] == ["TOTAL", "2", "20", "2000"]
+
+
+def test_preflight_reports_unmapped_and_missing_objects(monkeypatch):
+    volumes = [make_volume(label="VR0001L8", library="T10K"),
+               make_volume(label="VR0002L8", media_type="M8"),
+               make_volume(label="VR0003L8", storage_group="dune")]
+    assert run_preflight(monkeypatch, volumes,
+                         ["VR0001L8", "VR0002L8", "VR0003L8", "VR0004L8"]) == [
+        "VR0004L8: no such volume in Enstore",
+        "VR0001L8: no library_map entry for library T10K",
+        "VR0002L8: no media_type_map entry for media type M8",
+        "VR0003L8: tape pool dune.raw does not exist in CTA",
+        "VR0003L8: storage class dune.raw@cta does not exist in CTA"]
+
+
+def test_preflight_counts_objects_bootstrap_creates(monkeypatch):
+    volumes = [make_volume(storage_group="dune")]
+    assert run_preflight(monkeypatch, volumes, ["VR0001L8"],
+                         {"tape_pool": {"dune.raw": None},
+                          "storage_class": {"dune.raw@cta": None}}) == []
@@ -0,0 +1,119 @@
+"""
+Unit tests of the parts of sfa2dcache.py that do not need a database
+"""
+import importlib.util
+import os
+
+import pytest
+
+from conftest import FakeConnection
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "enstore2cta", "scripts", "sfa2dcache.py")
+
+spec = importlib.util.spec_from_file_location("sfa2dcache", SCRIPT)
+sfa2dcache = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sfa2dcache)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = sfa2dcache.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    with pytest.raises(KeyError):
+        cache.get("b")
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_cache_put_refreshes_existing_key():
+    cache = sfa2dcache.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 10)
+    cache.put("c", 3)
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.get("a") == 10
+
+
+def test_route_is_stable_and_in_range():
+    assert sfa2dcache.route("CDMS123", 7) == sfa2dcache.route("CDMS123", 7)
+    assert all(0 <= sfa2dcache.route("CDMS%d" % i, 7) < 7 for i in range(100))
+    assert sfa2dcache.route(None, 3) == sfa2dcache.route("", 3)
+
+
+requires_shared_memory = pytest.mark.skipif(
+    sfa2dcache.shared_memory is None or
+    not os.path.isdir(sfa2dcache.SHM_DIRECTORY),
+    reason="no shared memory")
+
+
+@requires_shared_memory
+def test_encode_decode_batch_round_trip():
+    rows = [{"ino": 1, "fsize": 1 << 40, "pnfsid": "0000A1",
+             "path": "/pnfs/fs/usr/data/été", "bfid": "CDMS1",
+             "file_family": "raw"},
+            {"ino": 2, "fsize": 0, "pnfsid": "0000A2", "path": "",
+             "bfid": None, "file_family": "raw"}]
+    descriptor = sfa2dcache.encode_batch(rows)
+    assert descriptor[1] == 2
+    decoded = sfa2dcache.decode_batch(descriptor)
+    assert decoded[0] == rows[0]
+    # empty strings and None both come back as None
+    assert decoded[1] == dict(rows[1], path=None)
+
+
+@requires_shared_memory
+def test_encode_batch_empty_and_decode_unlinks_segment():
+    prefix = sfa2dcache.get_segment_prefix(os.getpid()) + "test_"
+    name = prefix + "0"
+    descriptor = sfa2dcache.encode_batch([], name)
+    assert os.path.exists(os.path.join(sfa2dcache.SHM_DIRECTORY, name))
+    assert sfa2dcache.decode_batch(descriptor) == []
+    assert sfa2dcache.unlink_segments(prefix) == 0
+
+
+@requires_shared_memory
+def test_unlink_segments_of_run():
+    prefix = sfa2dcache.get_segment_prefix(os.getpid()) + "test_"
+    for i in range(3):
+        sfa2dcache.encode_batch([{"ino": i, "fsize": i, "pnfsid": "p",
+                                  "path": "f", "bfid": "b",
+                                  "file_family": "ff"}],
+                                "%s%d" % (prefix, i))
+    assert sfa2dcache.unlink_segments(prefix) == 3
+    assert sfa2dcache.unlink_segments(prefix) == 0
+
+
+def test_verify_only_keeps_separate_state(tmp_path):
+    state_file = str(tmp_path / "state")
+    verify_state_file = sfa2dcache.get_state_file(state_file, True)
+    assert verify_state_file == state_file + ".verify"
+    assert sfa2dcache.get_state_file(state_file) == state_file
+    assert sfa2dcache.get_state_file(None, True) is None
+    sfa2dcache.record_state(verify_state_file, "0000A1", "0000B2")
+    sfa2dcache.record_state(verify_state_file, "0000A1")
+    assert sfa2dcache.load_state(verify_state_file) == set(
+        [("0000A1", "0000B2"), ("0000A1", )])
+    assert sfa2dcache.load_state(state_file) == set()
+
+
+@pytest.mark.parametrize("sql", ["INSERT_LOCATIONS", "INSERT_CHECKSUM"])
+def test_chimera_inserts_are_idempotent(sql):
+    assert getattr(sfa2dcache, sql).strip().endswith("on conflict do nothing")
+
+
+def test_insert_locations_counts_inserted_and_skipped():
+    worker = sfa2dcache.SfaWorker(None, None, {})
+    chimera_db = FakeConnection(rowcount=2)
+    worker.insert_locations(chimera_db, {"pnfsid": "0000P1"},
+                            ({}, ["0000C1", "0000C2", "0000C3"]))
+    worker.insert_locations(chimera_db, {"pnfsid": "0000P2"}, ({}, []))
+    assert chimera_db.statements == [(sfa2dcache.INSERT_LOCATIONS,
+                                      ("0000P1",
+                                       ["0000C1", "0000C2", "0000C3"]))]
+    assert (worker.counters["inserted"], worker.counters["skipped"]) == (2, 1)
@@ -0,0 +1,47 @@
+"""
+Unit tests of enstore2cta.shard that do not need a database
+"""
+from conftest import FakeConnection
+from enstore2cta.migration import label_result
+from enstore2cta.shard import ShardWorker
+
+
+class FakeShardWorker(ShardWorker):
+
+    def __init__(self, claims, failing):
+        super(FakeShardWorker, self).__init__({"telemetry_interval": 3600},
+                                              "host:1")
+        self.claims = list(claims)
+        self.failing = failing
+        self.completed = []
+
+    def connect(self):
+        self.cta_db = FakeConnection()
+
+    def close(self):
+        pass
+
+    def set_label(self, label):
+        pass
+
+    def claim(self):
+        return self.claims.pop(0) if self.claims else (None, 0)
+
+    def do_label(self, label, attempts=1):
+        if label in self.failing:
+            raise ValueError("bad label")
+        return label_result(label, "done")
+
+    def complete(self, result):
+        # COMPLETE_LABEL must not run in an aborted transaction
+        self.completed.append((result["label"], result["status"],
+                               self.cta_db.rollbacks))
+
+
+def test_failed_label_is_completed_and_worker_goes_on():
+    worker = FakeShardWorker([("VR0001L8", 1), ("VR0002L8", 2),
+                              ("VR0003L8", 1)], ["VR0002L8"])
+    worker.run()
+    assert worker.completed == [("VR0001L8", "done", 0),
+                                ("VR0002L8", "failed", 1),
+                                ("VR0003L8", "done", 1)]
@@ -0,0 +1,110 @@
+"""
+Unit tests of enstore2cta.snapshot that do not need a database
+"""
+import datetime
+import decimal
+import json
+
+from enstore2cta.snapshot import (CONVERTERS, METADATA, Snapshot, VolumeCache,
+                                  escape, get_fingerprint, parse_row,
+                                  read_rows, unescape)
+
+
+COLUMNS = [("bfid", str),
+           ("size", CONVERTERS[20]),
+           ("crc", CONVERTERS[1700]),
+           ("update", CONVERTERS[1184]),
+           ("deleted", str),
+           ("pnfs_path", str)]
+
+
+def test_escape_unescape_round_trip():
+    value = "a\tb\nc\\d\re"
+    assert "\t" not in escape(value) and "\n" not in escape(value)
+    assert unescape(escape(value)) == value
+    assert escape(None) == "\\N"
+    assert escape(12) == "12"
+
+
+def test_parse_row_converts_columns():
+    line = "\t".join(["CDMS1", "1099511627776", "12.5",
+                      "2024-01-02 03:04:05.5+01", "\\N",
+                      escape("/pnfs/a\tb")])
+    row = parse_row(line, COLUMNS)
+    assert row == {"bfid": "CDMS1",
+                   "size": 1 << 40,
+                   "crc": decimal.Decimal("12.5"),
+                   "update": datetime.datetime(2024, 1, 2, 3, 4, 5, 500000),
+                   "deleted": None,
+                   "pnfs_path": "/pnfs/a\tb"}
+
+
+def test_parse_row_last_duplicate_column_wins():
+    columns = [("label", str), ("label", str)]
+    assert parse_row("VR0001\t\\N", columns) == {"label": None}
+
+
+def test_read_rows(tmp_path):
+    path = tmp_path / "VR0001.tsv"
+    path.write_text("CDMS1\t1\t2\t2024-01-02 03:04:05\tn\t/a\n"
+                    "CDMS2\t3\t4\t2024-01-02 03:04:06\tn\t/b\n")
+    rows = read_rows(str(path), COLUMNS)
+    assert [row["bfid"] for row in rows] == ["CDMS1", "CDMS2"]
+    assert read_rows(str(tmp_path / "missing.tsv"), COLUMNS) == []
+
+
+def test_read_rows_keeps_escaped_line_breaks(tmp_path):
+    path = tmp_path / "VR0002.tsv"
+    path.write_bytes("CDMS1\t1\t2\t2024-01-02 03:04:05\tn\t/a\\r\\nb\n"
+                     "CDMS2\t3\t4\t2024-01-02 03:04:06\tn\t/été\n".encode("utf-8"))
+    rows = read_rows(str(path), COLUMNS)
+    assert [row["pnfs_path"] for row in rows] == ["/a\r\nb", "/été"]
+    path.write_bytes(b"")
+    assert read_rows(str(path), COLUMNS) == []
+
+
+VOLUME = {"label": "VR0001L8", "active_files": 10, "active_bytes": 1000,
+          "eod_cookie": "0000_000000000_0000011",
+          "last_access": datetime.datetime(2024, 1, 2, 3, 4, 5)}
+
+
+def test_fingerprint_changes_with_volume():
+    fingerprint = get_fingerprint(VOLUME)
+    assert len(fingerprint) == 16
+    assert get_fingerprint(dict(VOLUME)) == fingerprint
+    assert get_fingerprint(dict(VOLUME, label="other")) == fingerprint
+    for key, value in (("active_files", 11),
+                       ("active_bytes", 1001),
+                       ("eod_cookie", "0000_000000000_0000012"),
+                       ("last_access", datetime.datetime(2024, 1, 3))):
+        assert get_fingerprint(dict(VOLUME, **{key: value})) != fingerprint
+
+
+def test_volume_cache_hit_reads_cached_file(tmp_path):
+    with open(str(tmp_path / METADATA), "w") as f:
+        json.dump({"exported": 0, "file": [["bfid", 25], ["size", 20]]}, f)
+    cache = VolumeCache(str(tmp_path), None, ["LTO8"])
+    cache.fingerprints["VR0001L8"] = get_fingerprint(VOLUME)
+    (tmp_path / ("VR0001L8.%s.tsv" % (get_fingerprint(VOLUME), ))).write_text(
+        "CDMS1\t5\n")
+    assert cache.get_files("VR0001L8") == [{"bfid": "CDMS1", "size": 5}]
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_snapshot_volumes_and_combinations(tmp_path):
+    combinations = [{"storage_group": "cms", "file_family": "raw",
+                     "library": "LTO8", "media_type": "LTO8"}]
+    with open(str(tmp_path / METADATA), "w") as f:
+        json.dump({"exported": 0,
+                   "volume": [["label", 25], ["active_files", 23]],
+                   "file": [["bfid", 25]],
+                   "combinations": combinations}, f)
+    (tmp_path / "volume.tsv").write_text("VR0002L8\t2\nVR0001L8\t1\n")
+    snapshot = Snapshot(str(tmp_path))
+    assert snapshot.get_volume("VR0001L8") == {"label": "VR0001L8",
+                                               "active_files": 1}
+    assert snapshot.get_volume("VR0003L8") is None
+    assert [v["label"] for v in snapshot.get_volumes()] == ["VR0001L8",
+                                                            "VR0002L8"]
+    assert snapshot.get_combinations() == combinations
+    assert snapshot.get_files("VR0001L8") == []
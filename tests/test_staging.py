@@ -0,0 +1,83 @@
+"""
+Unit tests of enstore2cta.staging that do not need a database
+"""
+import datetime
+
+from conftest import (FakeConnection, FakeSnapshot, make_dimensions,
+                      make_file, make_volume)
+from enstore2cta.staging import (STAGE_TAPE, get_run_prefix,
+                                 get_staging_table, stage_label)
+
+
+TABLE = get_staging_table(1234, "StagingWorker-1")
+
+CONFIG = {"media_type_map": {"LTO8": "LTO8"},
+          "disk_instance_name": "eosctapublic"}
+
+DIMENSIONS = make_dimensions(disk_instance={"eosctapublic": "eosctapublic"},
+                             storage_class={"cms.raw@cta": 1},
+                             media_type={"LTO8": 2},
+                             logical_library={"LTO8": 3},
+                             tape_pool={"cms.raw": 4})
+
+VOLUME = make_volume(declared=datetime.datetime(2020, 1, 2, 3, 4, 5),
+                     sum_rd_access=3, sum_wr_access=2, sum_mounts=4,
+                     comment="")
+
+
+def stage(cta_db, files=()):
+    enstore = FakeSnapshot([VOLUME], {"VR0001L8": list(files)})
+    return stage_label(enstore, cta_db, "VR0001L8", CONFIG, set(), DIMENSIONS,
+                       TABLE)
+
+
+def test_staging_tables_are_per_run_and_worker():
+    assert TABLE == "enstore2cta_stage_1234_stagingworker_1"
+    assert TABLE.startswith(get_run_prefix(1234))
+    assert not TABLE.startswith(get_run_prefix(123))
+
+
+def test_existing_tape_is_not_staged():
+    cta_db = FakeConnection(results=[[{"vid": "VR0001"}]])
+    assert stage(cta_db)["status"] == "exists"
+    assert len(cta_db.statements) == 1
+    assert cta_db.commits == 0
+
+
+def test_tape_is_staged_with_files_in_one_transaction():
+    files = [make_file("0000A1", "CDMS1600000000"),
+             make_file("0000A2", "CDMS1600000001",
+                       location_cookie="0000_000000000_0000002")]
+    cta_db = FakeConnection(results=[[], [(11, ), (12, )]])
+    result = stage(cta_db, files)
+    assert result["status"] == "staged"
+    assert result["files"] == 2
+    tape = cta_db.statements[1]
+    assert tape[0] == STAGE_TAPE.format(TABLE)
+    assert tape[1][:5] == ("VR0001L8", "VR0001", 2, 3, 4)
+    copies = [sql for sql, pars in cta_db.statements[3:]]
+    assert copies[0].startswith("copy %s_archive_file (label, " % (TABLE, ))
+    assert copies[1].startswith("copy %s_tape_file (vid, " % (TABLE, ))
+    archive_files = cta_db.statements[3][1].splitlines()
+    assert [row.split("\t")[:3] for row in archive_files] == [
+        ["VR0001L8", "11", "eosctapublic"], ["VR0001L8", "12", "eosctapublic"]]
+    assert cta_db.commits == 1
+
+
+def test_tape_without_files_is_staged():
+    cta_db = FakeConnection(results=[[]])
+    result = stage(cta_db)
+    assert result["status"] == "staged"
+    assert result["files"] == 0
+    assert [sql for sql, pars in cta_db.statements][1:] == [
+        STAGE_TAPE.format(TABLE)]
+    assert cta_db.commits == 1
+
+
+def test_failed_copy_stages_nothing():
+    cta_db = FakeConnection(results=[[], [(11, )]], failing="disk full")
+    result = stage(cta_db, [make_file("0000A1", "CDMS1600000000")])
+    assert result["status"] == "failed"
+    assert result["message"] == "disk full"
+    assert cta_db.commits == 0
+    assert cta_db.rollbacks == 2
@@ -0,0 +1,89 @@
+"""
+Unit tests of enstore2cta.sync that do not need a database
+"""
+from conftest import FakeConnection, FakeSnapshot, make_file, make_volume
+from enstore2cta import sync
+from enstore2cta.sync import get_delta, get_location, sync_label
+
+
+def cookie(fseq):
+    return "0000_000000000_%07d" % (fseq, )
+
+
+def with_copy(pnfs_id, bfid, copy_deleted="n"):
+    return make_file(pnfs_id, bfid, label="VS0001L8", wrapper="cpio_odc",
+                     copy_bfid=bfid + "0000000000",
+                     copy_location_cookie=cookie(7),
+                     copy_deleted=copy_deleted)
+
+
+def test_delta():
+    files = {"0000A1": make_file("0000A1", "CDMS1"),
+             "0000A2": with_copy("0000A2", "CDMS2"),
+             "0000A3": with_copy("0000A3", "CDMS3", "y"),
+             "0000A4": with_copy("0000A4", "CDMS4", "y"),
+             "0000A6": with_copy("0000A6", "CDMS6")}
+    # 0000A7 is skipped as duplicate, present but not migrated
+    present = set(files) | set(["0000A7"])
+    actual = {"0000A2": (100, 1, 2, None, 12),
+              "0000A3": (100, 1, 3, ("VS0001", 8), 13),
+              "0000A5": (100, 1, 5, None, 15),
+              "0000A6": (100, 1, 6, ("VS0001", 7), 16),
+              "0000A7": (100, 1, 7, None, 17)}
+    new, deleted, new_copies, deleted_copies = get_delta(files, present,
+                                                         actual)
+    # a file which copy was deleted is not added
+    assert [f["pnfs_id"] for f in new] == ["0000A1"]
+    assert deleted == [("0000A5", 15)]
+    assert new_copies == [("VS0001", 7, 7, 100, 2, 2000000000, 12)]
+    assert deleted_copies == [13]
+
+
+def test_delta_of_volume_in_sync():
+    files = {"0000A1": make_file("0000A1", "CDMS1")}
+    assert get_delta(files, set(files),
+                     {"0000A1": (100, 1, 1, None, 11)}) == ([], [], [], [])
+
+
+def test_location():
+    assert get_location("0000A1", 11) == "cta://cta/0000A1?archiveid=11"
+
+
+class EnstoreReader(FakeSnapshot):
+
+    def __init__(self, volume, rows):
+        super(EnstoreReader, self).__init__([volume])
+        self.enstore_db = FakeConnection(results=[rows])
+
+
+def test_label_not_in_cta_is_migrated(monkeypatch):
+    monkeypatch.setattr(sync, "migrate_label",
+                        lambda *args: {"status": "done", "label": args[3]})
+    cta_db = FakeConnection(results=[[]])
+    assert sync_label(None, cta_db, None, "VR0001L8", {}, set(),
+                      None) == {"status": "done", "label": "VR0001L8"}
+
+
+def test_inhibited_volume_and_snapshot_are_not_synced():
+    cta_db = FakeConnection(results=[[{"vid": "VR0001"}]])
+    enstore = EnstoreReader(make_volume(system_inhibit_0="NOACCESS"), [])
+    result = sync_label(enstore, cta_db, None, "VR0001L8", {}, set(), None)
+    assert result["message"] == "volume is NOACCESS"
+    cta_db = FakeConnection(results=[[{"vid": "VR0001"}]])
+    result = sync_label(FakeSnapshot([make_volume()]), cta_db, None,
+                        "VR0001L8", {}, set(), None)
+    assert result["message"] == "sync requires Enstore DB"
+
+
+def test_volume_in_sync_writes_nothing():
+    enstore = EnstoreReader(make_volume(), [make_file("0000A1", "CDMS1")])
+    cta_db = FakeConnection(results=[
+        [{"vid": "VR0001"}],
+        [{"disk_file_id": "0000A1", "archive_file_id": 11,
+          "size_in_bytes": 100, "checksum_adler32": 1, "vid": "VR0001",
+          "fseq": 1, "copy_nb": 1}]])
+    result = sync_label(enstore, cta_db, None, "VR0001L8", {}, set(), None)
+    assert result["status"] == "synced"
+    assert (result["files_added"], result["files_deleted"]) == (0, 0)
+    assert cta_db.commits == 0
+    assert len(cta_db.statements) == 2
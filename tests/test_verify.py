@@ -0,0 +1,72 @@
+"""
+Unit tests of enstore2cta.verify that do not need a database
+"""
+from conftest import FakeConnection, FakeSnapshot, make_file
+from enstore2cta.verify import get_actual, get_expected, verify_label
+
+
+def cta_row(pnfs_id, archive_file_id, fseq, vid="VR0001", copy_nb=1,
+            size=100, crc=1):
+    return {"disk_file_id": pnfs_id, "archive_file_id": archive_file_id,
+            "size_in_bytes": size, "checksum_adler32": crc, "vid": vid,
+            "fseq": fseq, "copy_nb": copy_nb}
+
+
+def cookie(fseq):
+    return "0000_000000000_%07d" % (fseq, )
+
+
+FILES = [make_file("0000A1", "CDMS1600000001", location_cookie=cookie(1)),
+         make_file("0000A2", "CDMS1600000002", location_cookie=cookie(2),
+                   label="VS0001L8", copy_bfid="CDMS1600000012",
+                   copy_location_cookie=cookie(7), copy_deleted="n",
+                   wrapper="cpio_odc"),
+         make_file("0000A3", "CDMS1600000003", location_cookie=cookie(3)),
+         make_file("0000A4", "CDMS1600000004", location_cookie=cookie(4))]
+
+
+def test_expected_and_actual_state():
+    assert get_expected(FILES[:2], "VR0001L8") == {
+        "0000A1": (100, 1, 1, None),
+        "0000A2": (100, 1, 2, ("VS0001", 7))}
+    cta_db = FakeConnection(results=[[cta_row("0000A2", 12, 7, "VS0001", 2),
+                                      cta_row("0000A1", 11, 1),
+                                      cta_row("0000A2", 12, 2)]])
+    assert get_actual(cta_db, "VR0001L8") == {
+        "0000A1": (100, 1, 1, None, 11),
+        "0000A2": (100, 1, 2, ("VS0001", 7), 12)}
+    assert cta_db.statements[0][1] == ("VR0001", )
+
+
+def test_verify_label_reports_discrepancies():
+    cta_db = FakeConnection(results=[[cta_row("0000A1", 11, 1, size=99),
+                                      cta_row("0000A2", 12, 2, crc=2),
+                                      cta_row("0000A3", 13, 3),
+                                      cta_row("0000A5", 15, 5)]])
+    chimera_db = FakeConnection(results=[[
+        {"ipnfsid": "0000A1", "ilocation": "cta://cta/0000A1?archiveid=11"},
+        {"ipnfsid": "0000A2", "ilocation": "cta://cta/0000A2?archiveid=99"}]])
+    summary, discrepancies = verify_label(
+        FakeSnapshot(files={"VR0001L8": FILES}), cta_db, chimera_db,
+        "VR0001L8", {"skip_bfids": set(["CDMS1600000003"])})
+    assert summary == {"label": "VR0001L8", "files": 3, "cta_files": 4,
+                       "discrepancies": 7}
+    assert sorted(discrepancies, key=lambda d: (d[1], d[2])) == [
+        ("VR0001L8", "0000A1", "size_mismatch", 100, 99),
+        ("VR0001L8", "0000A2", "checksum_mismatch", 1, 2),
+        ("VR0001L8", "0000A2", "copy_missing", "VS0001:7", None),
+        ("VR0001L8", "0000A2", "location_mismatch", "99", 12),
+        ("VR0001L8", "0000A3", "extra_in_cta", None, 13),
+        ("VR0001L8", "0000A4", "missing_in_cta", None, None),
+        ("VR0001L8", "0000A5", "extra_in_cta", None, 15)]
+
+
+def test_verify_label_reports_missing_tape():
+    cta_db = FakeConnection(results=[[], []])
+    summary, discrepancies = verify_label(
+        FakeSnapshot(files={"VR0001L8": FILES[:1]}), cta_db, None,
+        "VR0001L8", {"skip_locations": True})
+    assert discrepancies == [("VR0001L8", None, "tape_missing", "VR0001L8",
+                              None),
+                             ("VR0001L8", "0000A1", "missing_in_cta", None,
+                              None)]